@@ -1,8 +1,70 @@
+from asyncio import create_task, CancelledError
+from contextlib import asynccontextmanager, suppress
+from logging import getLogger
+from urllib.parse import urlsplit
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from backend.router import categorization, books
+from sqlalchemy import exc
+from backend.router import categorization, books, status, metrics
+from backend.metrics import MetricsMiddleware
+from backend.compression import CompressionMiddleware, ENCODERS
+from backend.category_index import load_category_index, listen_for_category_changes
+from backend.config import config_value
+from backend.database import warm_async_pool, close_pools
 
-api = FastAPI()
+logger = getLogger(__name__)
+
+# Requested once at startup so their responses are cached before traffic arrives.
+# The frontend lists every book with a bare /list.
+WARM_UP_PATHS = [it.strip() for it in config_value("WARM_UP_PATHS", "/api/v1/books/list", str).split(",") if it.strip() != ""]
+
+async def warm_up_request(app, url: str) -> int:
+    """Send a GET through the whole app without a server, returning the status"""
+    parts = urlsplit(url)
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": parts.path,
+        "raw_path": parts.path.encode("ascii"),
+        "query_string": parts.query.encode("ascii"),
+        "root_path": "",
+        # Also caches the response compressed as most clients will ask for it
+        "headers": [(b"host", b"localhost"), (b"accept-encoding", ", ".join(ENCODERS).encode("ascii"))],
+        "client": None,
+        "server": None,
+    }
+    status = None
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+    await app(scope, receive, send)
+    return status
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm the pool, category index and hot responses before serving,
+    # the listener keeps the index current
+    try:
+        await warm_async_pool()
+        await load_category_index()
+        for it in WARM_UP_PATHS:
+            logger.info("Warmed %s: %s", it, await warm_up_request(app, it))
+    except (OSError, exc.DBAPIError) as e:
+        logger.warning("Not warmed up at startup: %s", e)
+    listener = create_task(listen_for_category_changes())
+    yield
+    listener.cancel()
+    with suppress(CancelledError):
+        await listener
+    await close_pools()
+
+api = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost",
@@ -17,6 +79,14 @@ api.add_middleware(
     allow_headers=["*"],
 )
 
+# Responses the cache already compressed are passed through
+api.add_middleware(CompressionMiddleware)
+
+# Added last so it also times the other middleware
+api.add_middleware(MetricsMiddleware)
+
 # Router Endpoints
 api.include_router(categorization.router)
 api.include_router(books.router)
+api.include_router(status.router)
+api.include_router(metrics.router)
@@ -0,0 +1,226 @@
+from asyncio import Lock, sleep
+from bisect import bisect_left
+from logging import getLogger
+
+import psycopg
+from fastapi import HTTPException
+from sqlalchemy import select, exc
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .category_map import CategoryMap
+from .database import database_url, get_async_sessionmaker
+from .models import CategoriesTB, TableVersionsTB
+
+logger = getLogger(__name__)
+
+# Channel notified by manageDatabase whenever the categories table changes
+CHANGE_CHANNEL = "categories_changed"
+
+class CategoryNode:
+    """One level of the category hierarchy. Intermediate levels may have no cat_id."""
+    def __init__(self, path: tuple):
+        self.path = path
+        self.cat_id: str = None
+        self.children: dict[str, "CategoryNode"] = {}
+
+    @property
+    def name(self) -> str:
+        return " / ".join(self.path)
+
+    def describe(self) -> dict:
+        return {"id": self.cat_id, "name": self.name, "has_children": len(self.children) > 0}
+
+class CategoryEntry:
+    """A category with its search tokens precomputed per segment, leaf first"""
+    __slots__ = ["cat_id", "cat_path", "name", "segments"]
+
+    def __init__(self, cat_id: str, cat_path: str):
+        self.cat_id = cat_id
+        self.cat_path = cat_path
+        self.name = cat_path.replace("|", " / ")
+        self.segments = [
+            [token for token in segment.lower().split(" ") if token != ""]
+            for segment in reversed(cat_path.split("|"))
+        ]
+
+class CategoryIndex(CategoryMap):
+    """In memory category tree and token to category inverted index
+
+    Built from (id, cat_id, cat_path) rows, it also maps between them.
+    version is the categories table version the rows were read at, None when
+    not known.
+    """
+    def __init__(self, rows, version: int = None):
+        rows = list(rows)
+        super().__init__(rows)
+        self.version = version
+        self.root = CategoryNode(())
+        self.entries: dict[str, CategoryEntry] = {}
+        self.nodes: dict[tuple, CategoryNode] = {(): self.root}
+        postings: dict[str, set] = {}
+
+        for _, cat_id, cat_path in rows:
+            entry = CategoryEntry(cat_id, cat_path)
+            self.entries[cat_id] = entry
+            for segment in entry.segments:
+                for token in segment:
+                    postings.setdefault(token, set()).add(cat_id)
+
+            node = self.root
+            for segment in cat_path.split("|"):
+                if segment not in node.children:
+                    node.children[segment] = CategoryNode(node.path + (segment,))
+                    self.nodes[node.children[segment].path] = node.children[segment]
+                node = node.children[segment]
+            node.cat_id = cat_id
+
+        self.postings = postings
+        self.tokens = sorted(postings)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _prefixed(self, word: str):
+        """Tokens starting with word, found by binary search of the sorted tokens"""
+        idx = bisect_left(self.tokens, word)
+        while idx < len(self.tokens) and self.tokens[idx].startswith(word):
+            yield self.tokens[idx]
+            idx += 1
+
+    def matches(self, words: tuple) -> set:
+        """Categories with a path segment or word starting with any of the words"""
+        hits = set()
+        for word in words:
+            if "|" in word:
+                # Spans segments, which the token index cannot answer
+                hits |= {
+                    it.cat_id for it in self.entries.values()
+                    if it.cat_path.lower().startswith(word) or f"|{word}" in it.cat_path.lower() or f" {word}" in it.cat_path.lower()
+                }
+                continue
+            for token in self._prefixed(word):
+                hits |= self.postings[token]
+        return hits
+
+    @staticmethod
+    def rank(entry: CategoryEntry, words: tuple) -> float:
+        """Hits close to the leaf rank first, as do paths with fewer levels"""
+        return sum(
+            2**idx / (sum(1 for token in segment if token.startswith(words)) + 1)**-idx
+            for idx, segment in enumerate(entry.segments)
+        )
+
+    def search(self, query_list: list[str], limit: int = None) -> list[dict]:
+        words = tuple(it.lower() for it in query_list)
+        hits = [self.entries[it] for it in self.matches(words)]
+        ranked = sorted(hits, key=lambda it: (self.rank(it, words), it.cat_path))
+        return [{"id": it.cat_id, "name": it.name} for it in ranked[:limit]]
+
+    def children(self, path: tuple) -> list[dict]:
+        node = self.nodes.get(path)
+        if node is None:
+            return None
+        return [it.describe() for _, it in sorted(node.children.items())]
+
+    def subtree(self, cat_ids: list[str]) -> set:
+        """The given categories along with every category below them"""
+        found = set()
+        pending = [self.nodes[self.path_of(it)] for it in cat_ids if it in self.entries]
+        while len(pending) > 0:
+            node = pending.pop()
+            if node.cat_id is not None:
+                found.add(node.cat_id)
+            pending.extend(node.children.values())
+        return found
+
+    def path_of(self, cat_id: str) -> tuple:
+        entry = self.entries.get(cat_id)
+        return tuple(entry.cat_path.split("|")) if entry is not None else None
+
+_current: CategoryIndex = None
+_load_lock = Lock()
+
+def set_category_index(index: CategoryIndex):
+    global _current
+    _current = index
+
+def invalidate_category_index():
+    set_category_index(None)
+
+def current_category_index() -> CategoryIndex:
+    """The index being served, None until loaded or after invalidation"""
+    return _current
+
+async def categories_version(db: AsyncSession) -> int:
+    """Version of the categories table, None for databases without table_versions"""
+    sql_query = select(TableVersionsTB.version).where(TableVersionsTB.name == "categories")
+    try:
+        return (await db.execute(sql_query)).scalar() or 0
+    except exc.ProgrammingError:
+        await db.rollback()
+        return None
+
+async def load_category_index() -> CategoryIndex:
+    """Read the categories table and replace the current index"""
+    async with _load_lock:
+        async with get_async_sessionmaker()() as db:
+            # Read first, so a change committed meanwhile makes the index look older, not newer
+            version = await categories_version(db)
+            rows = (await db.execute(select(CategoriesTB.id, CategoriesTB.cat_id, CategoriesTB.cat_path))).all()
+        set_category_index(CategoryIndex(rows, version))
+        logger.info("Loaded %d categories", len(rows))
+        return _current
+
+async def get_category_index() -> CategoryIndex:
+    if _current is not None:
+        return _current
+    try:
+        return await load_category_index()
+    except exc.OperationalError as e:
+        raise HTTPException(status_code=503, detail="categories unavailable")
+
+async def resolve_categories(db: AsyncSession, index: CategoryIndex, cat_ids) -> dict[str, int]:
+    """Table ids of the known codes among cat_ids
+
+    Codes missing from the index are looked up in the database, in case they
+    were added since it was built. Finding any marks the index for reloading.
+    """
+    resolved = index.resolve(cat_ids)
+    missing = set(cat_ids) - set(resolved)
+    if len(missing) > 0:
+        sql_query = select(CategoriesTB.cat_id, CategoriesTB.id).where(CategoriesTB.cat_id.in_(missing))
+        found = dict((await db.execute(sql_query)).all())
+        if len(found) > 0:
+            resolved.update(found)
+            invalidate_category_index()
+    return resolved
+
+async def category_names(db: AsyncSession, index: CategoryIndex, version: int) -> CategoryMap:
+    """Category names matching data read at the given categories version
+
+    The index is rebuilt once a change is notified, so for a moment it can be
+    older than the data. Names are then read with the session of the data,
+    keeping responses cached under the new version right, and the index is
+    marked for reloading.
+    """
+    if version is None or (index.version is not None and index.version >= version):
+        return index
+    rows = (await db.execute(select(CategoriesTB.id, CategoriesTB.cat_id, CategoriesTB.cat_path))).all()
+    invalidate_category_index()
+    return CategoryMap(rows)
+
+async def listen_for_category_changes(retry_after: float = 5.0):
+    """Rebuild the index whenever categories are changed by another process"""
+    conninfo = database_url().render_as_string(hide_password=False)
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(conninfo, autocommit=True) as conn:
+                await conn.execute(f"LISTEN {CHANGE_CHANNEL}")
+                # Changes made before listening would otherwise be missed
+                await load_category_index()
+                async for _ in conn.notifies():
+                    # The old index keeps serving until the new one is built
+                    await load_category_index()
+        except (OSError, psycopg.Error, exc.SQLAlchemyError) as e:
+            logger.warning("Category change listener disconnected: %s", e)
+            await sleep(retry_after)
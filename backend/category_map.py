@@ -0,0 +1,29 @@
+from sqlalchemy import text
+
+# Shared by the api and manageDatabase, so written without the models
+CATEGORY_MAP_QUERY = text("SELECT id, cat_id, cat_path FROM categories")
+
+class CategoryMap:
+    """Lookups between category codes, table ids and paths"""
+    def __init__(self, rows):
+        self.ids: dict[str, int] = {}
+        self.cat_ids: dict[int, str] = {}
+        self.paths: dict[int, str] = {}
+        self.names: dict[int, str] = {}
+        for id, cat_id, cat_path in rows:
+            self.add(id, cat_id, cat_path)
+
+    def add(self, id: int, cat_id: str, cat_path: str):
+        cat_id = cat_id.strip()
+        self.ids[cat_id] = id
+        self.cat_ids[id] = cat_id
+        self.paths[id] = cat_path
+        self.names[id] = cat_path.replace("|", " / ")
+
+    def resolve(self, cat_ids) -> dict[str, int]:
+        """Table ids of the known codes among cat_ids"""
+        return {it: self.ids[it] for it in cat_ids if it in self.ids}
+
+    def name_of(self, id: int) -> str:
+        """Display name of a category table id"""
+        return self.names.get(id) if id is not None else None
@@ -0,0 +1,133 @@
+from gzip import compress as gzip_compress
+
+from fastapi.concurrency import run_in_threadpool
+
+from .config import config_value
+
+# brotli and zstandard are optional, only gzip is offered without them
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Smaller bodies are sent as they are, compressing them gains little
+COMPRESS_MIN_BYTES = config_value("COMPRESS_MIN_BYTES", 1024)
+
+COMPRESSIBLE_TYPES = ["application/json", "text/"]
+
+def _encoders() -> dict:
+    """Available encodings, most preferred first"""
+    encoders = {}
+    if zstandard is not None:
+        level = config_value("COMPRESS_ZSTD_LEVEL", 6)
+        encoders["zstd"] = lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+    if brotli is not None:
+        quality = config_value("COMPRESS_BROTLI_QUALITY", 5)
+        encoders["br"] = lambda data: brotli.compress(data, quality=quality)
+    level = config_value("COMPRESS_GZIP_LEVEL", 6)
+    encoders["gzip"] = lambda data: gzip_compress(data, compresslevel=level, mtime=0)
+    return encoders
+
+ENCODERS = _encoders()
+
+def negotiate(accept_encoding: str) -> str:
+    """Encoding to answer an Accept-Encoding header with, None for identity
+
+    The client's highest q-value wins, ties go to the server's preference
+    with identity last. Identity only competes when the header lists it or
+    "*", otherwise it is what is sent when no encoding is acceptable.
+    """
+    if accept_encoding is None or accept_encoding.strip() == "":
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+
+    ranked = [
+        (weights.get(it, weights.get("*", 0.0)), -idx, it)
+        for idx, it in enumerate(ENCODERS)
+    ]
+    ranked.append((weights.get("identity", weights.get("*", 0.0)), -len(ENCODERS), None))
+    weight, _, encoding = max(ranked)
+    return encoding if weight > 0 else None
+
+def compressible(content_type: str, size: int) -> bool:
+    return size >= COMPRESS_MIN_BYTES and any(content_type.startswith(it) for it in COMPRESSIBLE_TYPES)
+
+def compress(body: bytes, encoding: str) -> bytes:
+    return ENCODERS[encoding](body)
+
+def encoded_etag(etag: bytes, encoding: str) -> bytes:
+    """Strong ETag of the body once compressed, weak ones stay as they are"""
+    if etag.startswith(b"W/") or not etag.endswith(b'"'):
+        return etag
+    return etag[:-1] + f"-{encoding}".encode("ascii") + b'"'
+
+class CompressionMiddleware:
+    """Compresses JSON and text responses in the encoding the client prefers
+
+    Responses that already carry a Content-Encoding, such as the precompressed
+    ones kept by the response cache, are passed through.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        encoding = negotiate(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        chunks = []
+        async def compressing_send(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or start is None:
+                await send(message)
+                return
+
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            body = b"".join(chunks)
+            names = {k.lower(): v for k, v in start["headers"]}
+            content_type = names.get(b"content-type", b"").decode("latin-1")
+            if b"content-encoding" in names or not compressible(content_type, len(body)):
+                await send(start)
+                await send({"type": "http.response.body", "body": body})
+                return
+
+            # Off the event loop, the codecs release the GIL while compressing
+            body = await run_in_threadpool(compress, body, encoding)
+            vary = names.get(b"vary", b"")
+            response_headers = [(k, v) for k, v in start["headers"] if k.lower() not in [b"content-length", b"vary", b"etag"]]
+            if b"etag" in names:
+                response_headers.append((b"etag", encoded_etag(names[b"etag"], encoding)))
+            response_headers += [
+                (b"content-encoding", encoding.encode("ascii")),
+                (b"content-length", str(len(body)).encode("ascii")),
+                (b"vary", vary + b", Accept-Encoding" if vary != b"" else b"Accept-Encoding"),
+            ]
+            await send({**start, "headers": response_headers})
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, compressing_send)
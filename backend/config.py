@@ -1,3 +1,12 @@
 from dotenv import dotenv_values
 
 config = dotenv_values(".env")
+
+def config_value(key: str, default, cast=int):
+    """Read an optional setting from .env, falling back to default"""
+    value = config.get(key)
+    if value is None or value.strip() == "":
+        return default
+    if cast is bool:
+        return value.strip().lower() in ["1", "true", "yes", "on"]
+    return cast(value)
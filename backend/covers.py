@@ -0,0 +1,68 @@
+from base64 import b64decode, b64encode
+from binascii import Error as DecodeError
+from hashlib import sha256
+from re import fullmatch
+
+# Cover images are stored once in the covers table keyed by the sha256 of
+# their bytes. Books only hold that key.
+
+CONTENT_TYPES = {
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "gif": "image/gif",
+    "webp": "image/webp",
+}
+EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/gif": "gif",
+    "image/webp": "webp",
+}
+COVER_URL = "/api/v1/books/{book_id}/cover?v={cover_id}"
+THUMBNAIL_URL = COVER_URL + "&size={size}"
+
+def cover_hash(data: bytes) -> str:
+    return sha256(data).hexdigest()
+
+def sniff_content_type(data: bytes, ext: str = None) -> str:
+    """Content type from the image signature, falling back to the extension"""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"GIF8"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return CONTENT_TYPES.get((ext or "").lower().lstrip("."), "application/octet-stream")
+
+def parse_data_url(url: str) -> tuple[str, bytes]:
+    """Split a base64 image data url into its content type and bytes"""
+    value = fullmatch(r"data:image/(?P<ext>[a-z+.-]+);base64,(?P<encoding>.+)", url)
+    if value is None:
+        raise ValueError("Cover art must be a base64 encoded image data url")
+    try:
+        data = b64decode(value.group("encoding"), validate=True)
+    except DecodeError as e:
+        raise ValueError("Cover art is not valid base64") from e
+    return sniff_content_type(data, value.group("ext")), data
+
+def to_data_url(content_type: str, data: bytes) -> str:
+    return f"data:{content_type};base64,{b64encode(data).decode('utf-8')}"
+
+def parse_cover_url(url: str) -> str:
+    """Cover id referenced by a url from cover_url, None for anything else"""
+    value = fullmatch(r"(?:https?://[^/]+)?/api/v1/books/[0-9a-fA-F-]+/cover\?v=(?P<cover_id>[0-9a-f]{64})(?:&size=[0-9]+)?", url)
+    return value.group("cover_id") if value is not None else None
+
+def cover_url(book_id, cover_id: str, size: int = None) -> str:
+    """Link to the cover endpoint, versioned by content so it can be cached forever"""
+    if cover_id is None:
+        return None
+    if size is not None:
+        return THUMBNAIL_URL.format(book_id=book_id, cover_id=cover_id, size=size)
+    return COVER_URL.format(book_id=book_id, cover_id=cover_id)
+
+def cover_extension(content_type: str) -> str:
+    return EXTENSIONS.get(content_type, "bin")
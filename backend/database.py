@@ -1,21 +1,290 @@
-from sqlalchemy import create_engine, URL
+from functools import cache
+from logging import getLogger
+from os import getpid
+from threading import Lock
+from time import monotonic, perf_counter, time
+
+from fastapi import Depends, Request, Response
+from sqlalchemy import create_engine, exc, URL
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
 
-from .config import config
+from .config import config, config_value
+from .metrics import instrument_engine
 
-def get_db():
-    url = URL.create(
-        "postgresql",
-        username=config["DB_USER"],
-        password=config["DB_PASS"],
-        host=config["DB_HOST"],
-        database=config["DB_NAME"],
-        port=config["DB_PORT"]
+logger = getLogger(__name__)
+
+def database_url(drivername: str = "postgresql", host: str = None, port: str = None) -> URL:
+    """Address of the primary, or of a replica given its host and port"""
+    return URL.create(
+        drivername,
+        username=config.get("DB_USER"),
+        password=config.get("DB_PASS"),
+        host=host or config.get("DB_HOST"),
+        database=config.get("DB_NAME"),
+        port=port or config.get("DB_PORT")
     )
-    engine = create_engine(url)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    db = SessionLocal()
+
+def replica_hosts() -> list[tuple[str, str]]:
+    """(host, port) of the read replicas in DB_REPLICA_HOSTS, port being optional"""
+    hosts = []
+    for it in config_value("DB_REPLICA_HOSTS", "", str).split(","):
+        if it.strip() != "":
+            host, _, port = it.strip().partition(":")
+            hosts.append((host, port or None))
+    return hosts
+
+# Clients that wrote this recently read from the primary, which has their change
+READ_YOUR_WRITES_SECONDS = config_value("READ_YOUR_WRITES_SECONDS", 5)
+PRIMARY_COOKIE = "db_primary_until"
+
+def pool_options() -> dict:
+    """Connection pool settings shared by every engine of the process"""
+    return {
+        "pool_size": config_value("DB_POOL_SIZE", 5),
+        "max_overflow": config_value("DB_POOL_MAX_OVERFLOW", 10),
+        "pool_timeout": config_value("DB_POOL_TIMEOUT", 30.0, float),
+        "pool_recycle": config_value("DB_POOL_RECYCLE", 1800),
+        "pool_pre_ping": config_value("DB_POOL_PRE_PING", True, bool),
+    }
+
+class PoolMonitor:
+    """Running statistics about connection checkouts from the pool"""
+    def __init__(self, warn_after: float):
+        self.warn_after = warn_after
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.total_wait = 0.0
+            self.max_wait = 0.0
+            self.slow_checkouts = 0
+
+    def record(self, wait: float, pool=None):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            if wait > self.warn_after:
+                self.slow_checkouts += 1
+        if wait > self.warn_after:
+            logger.warning(
+                "Waited %.3fs for a database connection (%s)",
+                wait, pool.status() if pool is not None else "no pool"
+            )
+
+    def snapshot(self, pools: tuple = (), max_overflow: int = 0) -> dict:
+        with self._lock:
+            stats = {
+                "checkouts": self.checkouts,
+                "slow_checkouts": self.slow_checkouts,
+                "avg_wait": self.total_wait / self.checkouts if self.checkouts else 0.0,
+                "max_wait": self.max_wait,
+            }
+        if len(pools) == 0:
+            return {**stats, "initialized": False}
+
+        size = sum(it.size() for it in pools)
+        checked_out = sum(it.checkedout() for it in pools)
+        capacity = size + max_overflow * len(pools)
+        return {
+            **stats,
+            "initialized": True,
+            "size": size,
+            "max_overflow": max_overflow * len(pools),
+            "checked_out": checked_out,
+            "checked_in": sum(it.checkedin() for it in pools),
+            "overflow": sum(max(it.overflow(), 0) for it in pools),
+            "saturation": checked_out / capacity if capacity else 0.0,
+        }
+
+pool_monitor = PoolMonitor(warn_after=config_value("DB_POOL_WARN_WAIT", 0.1, float))
+
+@cache
+def get_engine():
+    """Process wide engine, created on first use"""
+    engine = create_engine(database_url(), **pool_options())
+    instrument_engine(engine)
+    return engine
+
+@cache
+def get_sessionmaker():
+    return sessionmaker(autocommit=False, autoflush=False, bind=get_engine())
+
+@cache
+def get_async_engine():
+    """Process wide asyncio engine used by the API routes"""
+    engine = create_async_engine(database_url("postgresql+psycopg"), **pool_options())
+    instrument_engine(engine.sync_engine)
+    return engine
+
+@cache
+def get_async_sessionmaker():
+    return async_sessionmaker(get_async_engine(), autoflush=False, expire_on_commit=False)
+
+class ReplicaSet:
+    """Read replicas taken in turn, skipping any that failed within retry_after seconds"""
+    def __init__(self, hosts: list[tuple[str, str]], retry_after: float):
+        self.hosts = hosts
+        self.retry_after = retry_after
+        self._lock = Lock()
+        self._next = 0
+        self._down_until = [0.0] * len(hosts)
+        # Reads served by each replica and by the primary
+        self.reads = [0] * len(hosts)
+        self.primary_reads = 0
+
+    def __len__(self) -> int:
+        return len(self.hosts)
+
+    def candidates(self) -> list[int]:
+        """Healthy replicas, in the order to try them for one request"""
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % max(len(self.hosts), 1)
+        now = monotonic()
+        order = [(start + it) % len(self.hosts) for it in range(len(self.hosts))]
+        return [it for it in order if self._down_until[it] <= now]
+
+    def mark_down(self, idx: int, error: Exception):
+        self._down_until[idx] = monotonic() + self.retry_after
+        logger.warning("Replica %s unavailable for %gs: %s", self.hosts[idx][0], self.retry_after, error)
+
+    def served(self, idx: int = None):
+        """Count a read served by replica idx, or by the primary when None"""
+        with self._lock:
+            if idx is None:
+                self.primary_reads += 1
+            else:
+                self.reads[idx] += 1
+
+    def status(self) -> list[dict]:
+        now = monotonic()
+        return [
+            {"host": host if port is None else f"{host}:{port}", "healthy": self._down_until[idx] <= now, "reads": self.reads[idx]}
+            for idx, (host, port) in enumerate(self.hosts)
+        ]
+
+replicas = ReplicaSet(replica_hosts(), config_value("DB_REPLICA_RETRY", 30.0, float))
+
+@cache
+def get_replica_engines() -> list:
+    engines = []
+    for host, port in replicas.hosts:
+        engine = create_async_engine(database_url("postgresql+psycopg", host, port), **pool_options())
+        instrument_engine(engine.sync_engine)
+        engines.append(engine)
+    return engines
+
+@cache
+def get_replica_sessionmakers() -> list:
+    return [async_sessionmaker(it, autoflush=False, expire_on_commit=False) for it in get_replica_engines()]
+
+def async_engines() -> list:
+    """Asyncio engines created so far, the primary's first"""
+    engines = [get_async_engine()] if get_async_engine.cache_info().currsize > 0 else []
+    if get_replica_engines.cache_info().currsize > 0:
+        engines.extend(get_replica_engines())
+    return engines
+
+async def warm_async_pool():
+    """Open pool_size connections up front, so early requests do not wait on connecting"""
+    engines = [get_async_engine()] + (get_replica_engines() if len(replicas) > 0 else [])
+    for idx, engine in enumerate(engines):
+        connections = []
+        try:
+            for _ in range(pool_options()["pool_size"]):
+                connections.append(await engine.connect())
+        except (OSError, exc.OperationalError) as e:
+            if idx == 0:
+                raise
+            replicas.mark_down(idx - 1, e)
+        finally:
+            # Back to the pool, also those opened before a failure
+            for it in connections:
+                await it.close()
+
+async def close_pools():
+    """Close the connections of every engine created by the process"""
+    for it in async_engines():
+        await it.dispose()
+    if get_engine.cache_info().currsize > 0:
+        get_engine().dispose()
+
+def pool_status() -> dict:
+    pools = [get_engine().pool] if get_engine.cache_info().currsize > 0 else []
+    pools.extend(it.pool for it in async_engines())
+    # Each worker process has its own pools, the pid tells their reports apart
+    status = {"worker": getpid(), **pool_monitor.snapshot(pools, pool_options()["max_overflow"])}
+    if len(replicas) > 0:
+        status["replicas"] = replicas.status()
+        status["primary_reads"] = replicas.primary_reads
+    return status
+
+def get_db():
+    db = get_sessionmaker()()
     try:
+        # Check out the connection up front so the wait on the pool is measured
+        start = perf_counter()
+        db.connection()
+        pool_monitor.record(perf_counter() - start, get_engine().pool)
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with get_async_sessionmaker()() as db:
+        start = perf_counter()
+        await db.connection()
+        pool_monitor.record(perf_counter() - start, get_async_engine().pool)
+        yield db
+
+async def get_async_write_db(response: Response, db: AsyncSession = Depends(get_async_db)):
+    """Primary session for routes that write, keeping the client on the primary for a while"""
+    if len(replicas) > 0:
+        response.set_cookie(
+            PRIMARY_COOKIE, str(int(time()) + READ_YOUR_WRITES_SECONDS + 1),
+            max_age=READ_YOUR_WRITES_SECONDS + 1, httponly=True, samesite="lax"
+        )
+    yield db
+
+def reads_primary(request: Request) -> bool:
+    """Whether the client wrote recently enough that a replica may not have it yet"""
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) > time()
+    except ValueError:
+        return False
+
+async def get_async_read_db(request: Request):
+    """Session for routes that only read, on a replica when any are configured
+
+    Replicas are taken in turn. One that cannot be connected to is skipped for
+    DB_REPLICA_RETRY seconds, and the primary serves reads when none are left.
+    """
+    if not reads_primary(request):
+        for idx in replicas.candidates():
+            engine = get_replica_engines()[idx]
+            db = get_replica_sessionmakers()[idx]()
+            try:
+                start = perf_counter()
+                await db.connection()
+                pool_monitor.record(perf_counter() - start, engine.pool)
+            except (OSError, exc.OperationalError) as e:
+                await db.close()
+                replicas.mark_down(idx, e)
+                continue
+            replicas.served(idx)
+            try:
+                yield db
+            finally:
+                await db.close()
+            return
+
+    async with get_async_sessionmaker()() as db:
+        start = perf_counter()
+        await db.connection()
+        pool_monitor.record(perf_counter() - start, get_async_engine().pool)
+        replicas.served()
+        yield db
@@ -1,122 +1,511 @@
 #!/usr/bin/env python3
-from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, ArgumentTypeError
 from dotenv import dotenv_values
-from sqlalchemy import create_engine, URL, select, or_
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, URL, select, or_, inspect, text, exc
+from sqlalchemy.dialects.postgresql import insert
 from csv import DictWriter, DictReader
-from base64 import b64encode, b64decode
 from os.path import splitext
 from os import environ
-from models import Base, CategoriesTB, BooksTB
-from uuid import uuid4
-from re import compile, fullmatch
+from models import Base, CategoriesTB, BooksTB, CoversTB
+from migrations import load_migrations
+from category_map import CategoryMap, CATEGORY_MAP_QUERY
+from covers import cover_hash, cover_extension, parse_data_url, sniff_content_type
+from thumbnails import THUMBNAIL_SIZES, make_thumbnail, thumbnail_cache
+from uuid import UUID, uuid5
+from itertools import islice
+from json import dumps, loads
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from re import compile
 from pathlib import Path
 
+# Namespace of the ids given to csv books without one
+CSV_BOOK_NAMESPACE = UUID("6f1c2e0a-8d4b-5c3e-9a7f-2b6d4e8c1a35")
+
 if Path(".env").exists():
     config = dotenv_values(".env")
 else:
     config = {it: environ[it] for it in ["DB_USER", "DB_PASS", "DB_PORT", "DB_NAME"]}
 
+def create_db_engine(host, echo=False):
+    # psycopg 3 is required for the COPY based loaders
+    url = URL.create("postgresql+psycopg", username=config["DB_USER"], password=config["DB_PASS"], host=host, port=config["DB_PORT"], database=config["DB_NAME"])
+    return create_engine(url, echo=echo)
+
 def init_db(host):
     """Initialize the database from defined models"""
-    url = URL.create("postgresql", username=config["DB_USER"], password=config["DB_PASS"], host=host, port=config["DB_PORT"], database=config["DB_NAME"])
-    engine = create_engine(url, echo=True)
+    engine = create_db_engine(host, echo=True)
     Base.metadata.create_all(engine)
+    run_migrations(engine)
     
 def drop_db_tables(host):
     """Drop all tables from defined models"""
-    url = URL.create("postgresql", username=config["DB_USER"], password=config["DB_PASS"], host=host, port=config["DB_PORT"], database=config["DB_NAME"])
-    engine = create_engine(url, echo=True)
+    engine = create_db_engine(host, echo=True)
     Base.metadata.drop_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS schema_migrations, ingest_checkpoints"))
     Base.metadata.create_all(engine)
+    run_migrations(engine)
+    with engine.begin() as conn:
+        notify_category_change(conn)
+
+def migrate_db(host, to: int = None, show: bool = False):
+    """Apply pending migrations, or roll back those after version to"""
+    engine = create_db_engine(host)
+    if show:
+        with engine.begin() as conn:
+            applied = applied_migrations(conn)
+        for it in load_migrations():
+            print(f"{'applied' if it.version in applied else 'pending'}  {it}")
+        return
+    run_migrations(engine, to)
+
+def applied_migrations(conn) -> set:
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, "
+        "applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now())"
+    ))
+    return set(conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+
+def run_migrations(engine, to: int = None):
+    """Bring the schema to version to, the latest when not given"""
+    migrations = load_migrations()
+    if to is None:
+        to = max((it.version for it in migrations), default=0)
+    with engine.begin() as conn:
+        applied = applied_migrations(conn)
+
+    # Checked before changing anything, so a refused rollback leaves the schema as it was
+    fixed = [it for it in migrations if it.version > to and it.version in applied and not it.reversible]
+    if len(fixed) > 0:
+        raise RuntimeError(f"{fixed[-1]} cannot be rolled back, migrate to {fixed[-1].version} or later")
+
+    for it in migrations:
+        if it.version <= to and it.version not in applied and install_extensions(engine, it):
+            apply_migration(engine, it)
+    for it in reversed(migrations):
+        if it.version > to and it.version in applied:
+            apply_migration(engine, it, rollback=True)
+
+def install_extensions(engine, migration) -> bool:
+    """Install the extensions a migration needs, False when the server cannot"""
+    try:
+        with engine.begin() as conn:
+            for it in migration.extensions:
+                conn.execute(text(f"CREATE EXTENSION IF NOT EXISTS {it}"))
+    except exc.DBAPIError as e:
+        print(f"\nLeaving {migration} pending, it needs {', '.join(migration.extensions)}: {e.orig}\n")
+        return False
+    return True
+
+def apply_migration(engine, migration, rollback: bool = False):
+    print(f"{'Rolling back' if rollback else 'Applying'} {migration}")
+    statements = migration.down if rollback else migration.up
+    if rollback:
+        record = text("DELETE FROM schema_migrations WHERE version = :version")
+    else:
+        record = text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)")
 
-def ingest_db(host, filename, type):
+    if migration.transactional:
+        with engine.begin() as conn:
+            for it in statements:
+                conn.exec_driver_sql(it)
+            conn.execute(record, {"version": migration.version, "name": migration.name})
+        return
+
+    # Concurrent index builds cannot run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        try:
+            for it in statements:
+                conn.exec_driver_sql(it)
+        except exc.DBAPIError as e:
+            if not rollback:
+                # A failed concurrent build leaves an invalid index that IF NOT EXISTS would keep
+                print(f"\n{migration} failed, undoing its partial changes: {e.orig}\n")
+                for it in migration.down:
+                    conn.exec_driver_sql(it)
+            raise
+        conn.execute(record, {"version": migration.version, "name": migration.name})
+
+def notify_category_change(conn):
+    """Tell running api processes to rebuild their category index, sent on commit"""
+    conn.execute(text("NOTIFY categories_changed"))
+
+def ingest_db(host, filename, type, mode, thumbnails, batch_size, resume, workers):
     if type == "categories":
-        ingest_db_categories(host, filename)
+        ingest_db_categories(host, filename, mode)
     elif type == "books":
-        ingest_db_books(host, filename)
+        ingest_db_books(host, filename, mode, thumbnails, batch_size, resume, workers)
     else:
         raise KeyError()
 
-def ingest_db_categories(host, filename):
-    """Ingest all category data from csv file"""
-    # Collect any malformed values from csv
-    with open(filename, "r") as infile:
-        dict_reader = DictReader(infile)
-        category_pattern = compile(r"[A-Z]{3}[0-9]{6}")
-        malformed = {it["cat_id"] for it in dict_reader if category_pattern.fullmatch(it["cat_id"]) is None}
+def ingest_db_categories(host, filename: Path, mode: str = "insert"):
+    """Ingest all category data from csv file
 
-    # Read all values and construct table rows
-    with open(filename, "r") as infile:
-        dict_reader = DictReader(infile)
-        rows = [CategoriesTB(
-            cat_id=it["cat_id"],
-            cat_path=it["cat_path"].replace(" / ", "|")
-        ) for it in dict_reader if it["cat_id"] not in malformed]
-        
-    if len(malformed) > 0:
-        message = ["The following entries are malformed and were not added:"] + malformed
-        print("\n" + "\n    ".join(message) + "\n")
+    Rows are validated while streaming them into a staging table with COPY,
+    then merged in one statement. Malformed ids, ids or paths repeated in the
+    file and paths that belong to another category are written to
+    <name>.rejected.csv instead of aborting the load. In insert mode existing
+    categories are rejected too, in upsert mode they are renamed when their
+    path changed.
+    """
+    category_pattern = compile(r"[A-Z]{3}[0-9]{6}")
+    rejected = RejectedRows(filename.with_name(filename.stem + ".rejected.csv"))
 
-    url = URL.create("postgresql", username=config["DB_USER"], password=config["DB_PASS"], host=host, port=config["DB_PORT"], database=config["DB_NAME"])
-    engine = create_engine(url, echo=False)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    with SessionLocal() as session:
-        session.add_all(rows)
-        session.commit()
+    engine = create_db_engine(host)
+    with engine.begin() as conn, conn.connection.driver_connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMP TABLE categories_staging "
+            "(line integer, cat_id text, cat_path text, error text) ON COMMIT DROP"
+        )
+        with open(filename, "r", newline="") as infile, \
+             cursor.copy("COPY categories_staging (line, cat_id, cat_path) FROM STDIN") as copy:
+            for line, it in enumerate(DictReader(infile), start=2):
+                cat_id, cat_path = (it.get("cat_id") or "").strip(), (it.get("cat_path") or "").strip()
+                if category_pattern.fullmatch(cat_id) is None:
+                    rejected.write(it, "malformed cat_id")
+                elif cat_path == "":
+                    rejected.write(it, "missing cat_path")
+                else:
+                    copy.write_row((line, cat_id, cat_path.replace(" / ", "|")))
 
-def ingest_db_books(host, filename: Path):
+        # The first occurrence in the file wins
+        for column in ["cat_id", "cat_path"]:
+            cursor.execute(
+                f"UPDATE categories_staging s SET error = 'duplicate {column}' "
+                f"FROM (SELECT line, row_number() OVER (PARTITION BY {column} ORDER BY line) AS n "
+                f"      FROM categories_staging WHERE error IS NULL) d "
+                f"WHERE d.line = s.line AND d.n > 1"
+            )
+        cursor.execute(
+            "UPDATE categories_staging s SET error = 'cat_path belongs to ' || c.cat_id "
+            "FROM categories c WHERE s.error IS NULL AND c.cat_path = s.cat_path AND c.cat_id <> s.cat_id"
+        )
+        if mode == "upsert":
+            conflict = (
+                "ON CONFLICT (cat_id) DO UPDATE SET cat_path = EXCLUDED.cat_path "
+                "WHERE categories.cat_path IS DISTINCT FROM EXCLUDED.cat_path"
+            )
+        else:
+            cursor.execute(
+                "UPDATE categories_staging s SET error = 'cat_id already exists' "
+                "FROM categories c WHERE s.error IS NULL AND c.cat_id = s.cat_id"
+            )
+            conflict = "ON CONFLICT (cat_id) DO NOTHING"
+        cursor.execute(
+            "INSERT INTO categories (cat_id, cat_path) "
+            "SELECT cat_id, cat_path FROM categories_staging WHERE error IS NULL ORDER BY line " + conflict
+        )
+        changed = cursor.rowcount
+
+        cursor.execute("SELECT cat_id, cat_path, error FROM categories_staging WHERE error IS NOT NULL ORDER BY line")
+        for cat_id, cat_path, error in cursor:
+            rejected.write({"cat_id": cat_id, "cat_path": cat_path.replace("|", " / ")}, error)
+
+        if changed > 0:
+            notify_category_change(conn)
+
+    rejected.close()
+    print(f"{changed} categories added or changed, {rejected.count} rejected")
+    if rejected.count > 0:
+        print(f"\nRejected rows were written to {rejected.path}\n")
+
+def ingest_db_books(host, filename: Path, mode: str = "insert", thumbnails: bool = False, batch_size: int = 1000, resume: bool = False, workers: int = 1):
     """Ingest all book data from csv file
     
     cover art should be file path relative to csv file
+
+    Rows are streamed in batches of batch_size, each loaded with COPY and
+    committed on its own. The number of rows read so far is recorded in the
+    ingest_checkpoints table by the same transaction, so an interrupted load
+    can continue with resume without loading any batch twice.
+    Rows that cannot be loaded are written to <name>.rejected.csv with the reason.
+
+    With more than one worker, covers are read and hashed in a process pool
+    while earlier batches are written to the database.
+
+    In insert mode books that already exist are rejected. In upsert mode they
+    are updated, unless the stored row_hash shows nothing changed. Cover file
+    hashes are remembered in <name>.covers.json so files whose size and mtime
+    are unchanged are not read again, and covers already stored are not sent.
     """
-    # Construct Category Map
-    url = URL.create("postgresql", username=config["DB_USER"], password=config["DB_PASS"], host=host, port=config["DB_PORT"], database=config["DB_NAME"])
-    engine = create_engine(url, echo=False)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    with SessionLocal() as session:
-        res = session.execute(select(CategoriesTB.cat_id, CategoriesTB.id)).mappings().all()
-        category_mapping = {it.cat_id.strip(): it.id for it in res}
-
-    with open(filename, "r") as infile:
+    engine = create_db_engine(host)
+    checkpoint = str(filename.resolve())
+    with engine.begin() as conn:
+        category_mapping = CategoryMap(conn.execute(CATEGORY_MAP_QUERY)).ids
+        checkpointed = ingest_checkpoint(conn, checkpoint)
+    done = checkpointed if resume else 0
+    rejected = RejectedRows(filename.with_name(filename.stem + ".rejected.csv"), append=done > 0)
+    manifest_file = filename.with_name(filename.stem + ".covers.json")
+    manifest = loads(manifest_file.read_text()) if manifest_file.exists() else {}
+
+    added = updated = 0
+    with open(filename, "r", newline="") as infile:
         dict_reader = DictReader(infile)
-        row_data = [{
-            "id": it["id"].strip() if it["id"].strip() != "" else str(uuid4()),
-            "title": it["title"].strip(),
-            "author": it["author"].strip(),
-            "isbn": it["isbn"].strip() if it["isbn"].strip() != "" else None,
-            "cover_art": image_to_b64( (filename.parent / it["cover_art"].strip()).absolute() ) if it["cover_art"].strip() != "" else None,
-            "category": category_mapping[it["category"].strip()] if it["category"].strip() != "" else None
-        } for it in dict_reader]
-
-    with SessionLocal() as session:
-        session.add_all([
-            BooksTB(**it) for it in row_data
-        ])
-        session.commit()
-
-def dump_db(host, dest: Path):
-    from json import dumps
+        # Rows before the checkpoint were committed by an earlier run
+        for _ in islice(dict_reader, done):
+            pass
+
+        batches = iter(lambda: list(islice(dict_reader, batch_size)), [])
+        for batch, (books, covers, errors, entries) in prepare_batches(batches, workers, filename.parent, category_mapping, manifest):
+            for source, error in errors:
+                rejected.write(source, error)
+            with engine.begin() as conn:
+                stored = set(conn.execute(select(CoversTB.id).where(CoversTB.id.in_(list(covers)))).scalars())
+                new_covers = [load_cover(filename.parent, it) for key, it in covers.items() if key not in stored]
+                changed = copy_books(conn, [it[1] for it in books], new_covers, upsert=mode == "upsert")
+                save_checkpoint(conn, checkpoint, done + len(batch))
+            if mode != "upsert":
+                for source, row in books:
+                    if row[0] not in changed:
+                        rejected.write(source, "duplicate id")
+            rejected.flush()
+            manifest.update(entries)
+
+            done += len(batch)
+            added += sum(1 for it in changed.values() if it)
+            updated += sum(1 for it in changed.values() if not it)
+            print(f"{done} rows read, {added} books added, {updated} updated, {rejected.count} rejected")
+
+            if thumbnails:
+                generate_thumbnails(new_covers)
+
+    rejected.close()
+    manifest_file.write_text(dumps(manifest))
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM ingest_checkpoints WHERE source = :source"), {"source": checkpoint})
+    if rejected.count > 0:
+        print(f"\nRejected rows were written to {rejected.path}\n")
+
+def ingest_checkpoint(conn, source: str) -> int:
+    """Rows of source committed by an earlier ingest that did not finish"""
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS ingest_checkpoints ("
+        "source VARCHAR PRIMARY KEY, rows_done INTEGER NOT NULL, "
+        "updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now())"
+    ))
+    sql_query = text("SELECT rows_done FROM ingest_checkpoints WHERE source = :source")
+    return conn.execute(sql_query, {"source": source}).scalar() or 0
+
+def save_checkpoint(conn, source: str, done: int):
+    """Record rows of source as loaded, in the transaction that loads them"""
+    conn.execute(text(
+        "INSERT INTO ingest_checkpoints (source, rows_done) VALUES (:source, :done) "
+        "ON CONFLICT (source) DO UPDATE SET rows_done = EXCLUDED.rows_done, updated_at = now()"
+    ), {"source": source, "done": done})
+
+class RejectedRows:
+    """Side file of csv rows that could not be loaded, created on first use"""
+    def __init__(self, path: Path, append: bool = False):
+        self.path = path
+        self.append = append
+        self.count = 0
+        self._file = None
+        self._writer = None
+
+    def write(self, row: dict, error: str):
+        if self._writer is None:
+            exists = self.append and self.path.exists()
+            self._file = open(self.path, "a" if exists else "w", newline="")
+            self._writer = DictWriter(self._file, fieldnames=list(row) + ["error"], extrasaction="ignore")
+            if not exists:
+                self._writer.writeheader()
+        self._writer.writerow({**row, "error": error})
+        self.count += 1
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+def prepare_batches(batches, workers: int, cover_dir: Path, category_mapping: dict, manifest: dict):
+    """Yield each batch with its prepared books, in order
+
+    Worker processes run at most one batch ahead each, which bounds the
+    covers held in memory. Only the manifest entries of a batch are sent along.
+    """
+    def known(batch):
+        names = {(it.get("cover_art") or "").strip() for it in batch}
+        return {it: manifest[it] for it in names if it in manifest}
+
+    if workers <= 1:
+        for batch in batches:
+            yield batch, prepare_books(batch, cover_dir, category_mapping, known(batch))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append((batch, executor.submit(prepare_books, batch, cover_dir, category_mapping, known(batch))))
+            if len(pending) > workers:
+                batch, future = pending.popleft()
+                yield batch, future.result()
+        while len(pending) > 0:
+            batch, future = pending.popleft()
+            yield batch, future.result()
+
+def prepare_books(batch: list, cover_dir: Path, category_mapping: dict, known: dict):
+    """Validate csv rows and read their covers
+
+    Returns (source row, books row) pairs, the distinct covers of the batch,
+    (source row, reason) pairs for rows that were rejected and the manifest
+    entries of the cover files. Covers whose file is unchanged since it was
+    last hashed are not read, leaving their data as None.
+    """
+    books, covers, errors, entries, seen = [], {}, [], {}, set()
+    for it in batch:
+        value = {k: (v or "").strip() for k, v in it.items() if k is not None}
+        try:
+            for field in ["title", "author"]:
+                if value.get(field, "") == "":
+                    raise ValueError(f"missing {field}")
+            book_id = parse_book_id(value)
+            if book_id in seen:
+                raise ValueError("duplicate id")
+            seen.add(book_id)
+            category = value.get("category", "")
+            if category != "" and category not in category_mapping:
+                raise ValueError(f"unknown category {category}")
+
+            cover_id = None
+            if value.get("cover_art", "") != "":
+                entry, data = cover_entry(cover_dir, value["cover_art"], known)
+                _, _, cover_id, content_type = entry
+                if not content_type.startswith("image/"):
+                    raise ValueError(f"unrecognized cover image {value['cover_art']}")
+                entries[value["cover_art"]] = entry
+                if covers.get(cover_id, {}).get("data") is None:
+                    covers[cover_id] = {"id": cover_id, "content_type": content_type, "data": data, "path": value["cover_art"]}
+        except ValueError as e:
+            errors.append((it, str(e)))
+            continue
+        except OSError as e:
+            errors.append((it, f"unreadable cover: {e.strerror}"))
+            continue
+
+        row = (
+            value["title"],
+            value["author"],
+            value["isbn"] if value.get("isbn", "") != "" else None,
+            cover_id,
+            category_mapping[category] if category != "" else None
+        )
+        books.append((it, (book_id, *row, cover_hash(dumps(row).encode("utf-8")))))
+    return books, covers, errors, entries
+
+def cover_entry(cover_dir: Path, name: str, known: dict) -> tuple:
+    """Manifest entry [size, mtime, hash, content type] of a cover file and its bytes
+
+    The file is only read when it differs from its known entry, otherwise
+    the bytes are None.
+    """
+    path = (cover_dir / name).absolute()
+    stat = path.stat()
+    entry = known.get(name)
+    if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return entry, None
+    cover_id, content_type, data = image_to_blob(path)
+    return [stat.st_size, stat.st_mtime_ns, cover_id, content_type], data
+
+def load_cover(cover_dir: Path, cover: dict) -> dict:
+    """Read the bytes of a cover skipped by prepare_books"""
+    if cover["data"] is None:
+        _, _, cover["data"] = image_to_blob((cover_dir / cover["path"]).absolute())
+    return cover
+
+def parse_book_id(value: dict) -> UUID:
+    """Id from the csv, derived from title, author and isbn when left blank
+
+    Derived ids are the same on every run, so ingesting the file again finds
+    the books loaded before instead of adding them once more.
+    """
+    if value.get("id", "") == "":
+        return uuid5(CSV_BOOK_NAMESPACE, "\x1f".join(value.get(it, "") for it in ["title", "author", "isbn"]))
+    try:
+        return UUID(value["id"])
+    except ValueError:
+        raise ValueError(f"invalid id {value['id']}")
+
+def copy_books(conn, books: list, covers, upsert: bool = False) -> dict:
+    """COPY rows into staging tables and merge them
+
+    Books whose id already exists are left untouched, unless upserting and
+    their row_hash changed. Returns the ids written, mapped to whether the
+    book is new.
+    """
+    with conn.connection.driver_connection.cursor() as cursor:
+        cursor.execute("CREATE TEMP TABLE covers_staging (LIKE covers) ON COMMIT DROP")
+        with cursor.copy("COPY covers_staging (id, content_type, data) FROM STDIN") as copy:
+            for it in covers:
+                copy.write_row((it["id"], it["content_type"], it["data"]))
+        cursor.execute("INSERT INTO covers SELECT * FROM covers_staging ON CONFLICT (id) DO NOTHING")
+
+        cursor.execute("CREATE TEMP TABLE books_staging (LIKE books) ON COMMIT DROP")
+        with cursor.copy("COPY books_staging (id, title, author, isbn, cover_id, category, row_hash) FROM STDIN") as copy:
+            for it in books:
+                copy.write_row(it)
+        if upsert:
+            # xmax is only set on rows that existed before
+            conflict = (
+                "ON CONFLICT (id) DO UPDATE SET title = EXCLUDED.title, author = EXCLUDED.author, "
+                "isbn = EXCLUDED.isbn, cover_id = EXCLUDED.cover_id, category = EXCLUDED.category, "
+                "row_hash = EXCLUDED.row_hash "
+                "WHERE books.row_hash IS DISTINCT FROM EXCLUDED.row_hash "
+                "RETURNING id, xmax = 0"
+            )
+        else:
+            conflict = "ON CONFLICT (id) DO NOTHING RETURNING id, true"
+        cursor.execute(
+            "INSERT INTO books (id, title, author, isbn, cover_id, category, row_hash) "
+            "SELECT id, title, author, isbn, cover_id, category, row_hash FROM books_staging " + conflict
+        )
+        return dict(cursor.fetchall())
+
+def generate_thumbnails(covers):
+    """Fill the thumbnail cache shared with the api"""
+    cache = thumbnail_cache(config)
+    unreadable = []
+    for it in covers:
+        try:
+            for size in THUMBNAIL_SIZES:
+                if (it["id"], size) not in cache:
+                    cache.put(it["id"], size, make_thumbnail(it["data"], size))
+        except OSError:
+            unreadable.append(it["id"])
+
+    if len(unreadable) > 0:
+        message = ["Thumbnails could not be made for the following covers:"] + unreadable
+        print("\n" + "\n    ".join(message) + "\n")
+
+def dump_db(host, dest: Path, batch_size: int = 1000, workers: int = 4):
+    """Write categories.csv, books.csv and one file per cover to dest
+
+    Rows are streamed from server side cursors batch_size at a time and cover
+    files are written by a pool of worker threads.
+    """
     if not dest.exists():
         dest.mkdir(parents=True)
     if any(dest.iterdir()):
         raise RuntimeError("Output directory must be empty")
 
-    url = URL.create("postgresql", username=config["DB_USER"], password=config["DB_PASS"], host=host, port=config["DB_PORT"], database=config["DB_NAME"])
-    engine = create_engine(url, echo=False)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    with SessionLocal() as session:
-        categories = [{
-            "cat_id": it.CategoriesTB.cat_id,
-            "cat_path": it.CategoriesTB.cat_path.replace("|", " / ")
-        } for it in session.execute(select(CategoriesTB)).mappings().all()]
-        
-        with open(dest/"categories.csv", "w") as ofile:
+    engine = create_db_engine(host)
+    with engine.connect() as conn:
+        conn = conn.execution_options(yield_per=batch_size)
+
+        with open(dest/"categories.csv", "w", newline="") as ofile:
             field_names = ["cat_id", "cat_path"]
             writer = DictWriter(ofile, fieldnames=field_names)
             
             writer.writeheader()
-            [writer.writerow(it) for it in categories]
+            count = 0
+            for it in conn.execute(select(CategoriesTB.cat_id, CategoriesTB.cat_path)):
+                writer.writerow({"cat_id": it.cat_id, "cat_path": it.cat_path.replace("|", " / ")})
+                count += 1
+            print(f"{count} categories written")
             
         book_query = (
             select(
@@ -125,48 +514,100 @@ def dump_db(host, dest: Path):
                 BooksTB.author,
                 CategoriesTB.cat_id,
                 BooksTB.isbn,
-                BooksTB.cover_art)
+                BooksTB.cover_id,
+                CoversTB.content_type)
             .join(CategoriesTB, BooksTB.category == CategoriesTB.id, isouter=True)
+            .join(CoversTB, BooksTB.cover_id == CoversTB.id, isouter=True)
         )
-        
-        books = [{
-            "id": str(it.id),
-            "title": it.title,
-            "author": it.author,
-            "isbn": it.isbn,
-            "category": it.cat_id,
-            "cover_art": b64_to_image(it.cover_art, dest) if it.cover_art is not None else None
-        } for it in session.execute(book_query).mappings().all()]
-        print(len(books))
-
-        with open(dest/"books.csv", "w") as ofile:
+
+        with open(dest/"books.csv", "w", newline="") as ofile:
             field_names = ["id", "title", "author", "isbn", "category", "cover_art"]
             writer = DictWriter(ofile, fieldnames=field_names)
             
             writer.writeheader()
-            [writer.writerow(it) for it in books]
+            count = 0
+            for it in conn.execute(book_query):
+                writer.writerow({
+                    "id": str(it.id),
+                    "title": it.title,
+                    "author": it.author,
+                    "isbn": it.isbn,
+                    "category": it.cat_id,
+                    "cover_art": f"{it.cover_id}.{cover_extension(it.content_type)}" if it.cover_id is not None else None
+                })
+                count += 1
+                if count % batch_size == 0:
+                    print(f"{count} books written", end="\r", flush=True)
+            print(f"{count} books written")
 
-def image_to_b64(filepath):
-    cover_fc = open(filepath, "rb").read()
-    b64_cover = b64encode(cover_fc).decode("utf-8")
-    ext = splitext(filepath)[-1].replace('.','')
-    return f"data:image/{ext};base64,{b64_cover}"
+        # Each distinct cover is written once, named by its content hash
+        count = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for it in conn.execute(select(CoversTB.id, CoversTB.content_type, CoversTB.data)):
+                pending.append(executor.submit(blob_to_image, it.id, it.content_type, it.data, dest))
+                # Bound the cover bytes waiting to be written
+                while len(pending) > 2 * workers:
+                    pending.popleft().result()
+                    count += 1
+                    if count % batch_size == 0:
+                        print(f"{count} covers written", end="\r", flush=True)
+            for it in pending:
+                it.result()
+                count += 1
+        print(f"{count} covers written")
 
-def b64_to_image(url, dest_dir: Path):
+def image_to_blob(filepath):
+    """Read a cover image, returning its content hash, content type and bytes"""
+    with open(filepath, "rb") as infile:
+        data = infile.read()
+    return cover_hash(data), sniff_content_type(data, splitext(filepath)[-1]), data
+
+def blob_to_image(cover_id, content_type, data, dest_dir: Path):
     if not dest_dir.exists():
         dest_dir.mkdir(parents=True)
-    if not dest_dir.is_dir:
+    if not dest_dir.is_dir():
         raise RuntimeError("Must supply output directory")
 
-    value = fullmatch(r"data:image/(?P<ext>[a-z]+);base64,(?P<encoding>.+)", url)
-    ext = value.group("ext")
-    enc = value.group("encoding")
-    output_file = dest_dir / f"{uuid4()}.{ext}"
-    with open(output_file, "wb") as outfile:
-        outfile.write(b64decode(enc))
+    output_file = dest_dir / f"{cover_id}.{cover_extension(content_type)}"
+    if not output_file.exists():
+        with open(output_file, "wb") as outfile:
+            outfile.write(data)
         
     return output_file.parts[-1]
 
+def migrate_covers(host):
+    """Move base64 cover art stored on the books table into the cover store"""
+    engine = create_db_engine(host)
+    CoversTB.__table__.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        columns = {it["name"] for it in inspect(conn).get_columns("books")}
+        if "cover_art" not in columns:
+            print("Covers are already stored in the cover store")
+            return
+        if "cover_id" not in columns:
+            conn.execute(text("ALTER TABLE books ADD COLUMN cover_id VARCHAR(64) REFERENCES covers(id)"))
+
+        moved = 0
+        for book_id, cover_art in conn.execute(text("SELECT id, cover_art FROM books WHERE cover_art IS NOT NULL")).all():
+            content_type, data = parse_data_url(cover_art)
+            cover_id = cover_hash(data)
+            conn.execute(
+                insert(CoversTB)
+                .values(id=cover_id, content_type=content_type, data=data)
+                .on_conflict_do_nothing(index_elements=[CoversTB.id])
+            )
+            conn.execute(text("UPDATE books SET cover_id = :cover_id WHERE id = :id"), {"cover_id": cover_id, "id": book_id})
+            moved += 1
+        conn.execute(text("ALTER TABLE books DROP COLUMN cover_art"))
+        print(f"Moved {moved} covers")
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
 def main():
     # Call the appropriate sub command with args
     func_name, func_args = parse_cli()
@@ -189,13 +630,30 @@ def parse_cli():
     ingest_parser = subparser.add_parser("ingest", help="Ingest data from csv file", formatter_class=ArgumentDefaultsHelpFormatter)
     ingest_parser.add_argument("filename", help="Input file", type=Path)
     ingest_parser.add_argument("--type", help="Type of Data", choices=["categories", "books"], required=True, type=str)
+    ingest_parser.add_argument("--mode", help="insert skips existing rows, upsert updates changed ones", choices=["insert", "upsert"], default="insert", type=str)
+    ingest_parser.add_argument("--thumbnails", help="Pre-generate cover thumbnails into COVER_CACHE_DIR", action="store_true")
+    ingest_parser.add_argument("--batch-size", help="Books loaded and committed at a time", default=1000, type=positive_int)
+    ingest_parser.add_argument("--resume", help="Continue an interrupted books ingest from its checkpoint", action="store_true")
+    ingest_parser.add_argument("--workers", help="Processes reading and hashing covers", default=1, type=positive_int)
     ingest_parser.set_defaults(func=ingest_db)
     
     # Dump Data
     dump_parser = subparser.add_parser("dump", help="Dump database data to csv file", formatter_class=ArgumentDefaultsHelpFormatter)
     dump_parser.add_argument("dest", help="Output directory. Must be empty or not exist", type=Path)
+    dump_parser.add_argument("--batch-size", help="Rows fetched from the database at a time", default=1000, type=positive_int)
+    dump_parser.add_argument("--workers", help="Threads writing cover files", default=4, type=positive_int)
     dump_parser.set_defaults(func=dump_db)
 
+    # Schema migrations
+    migrate_parser = subparser.add_parser("migrate", help="Apply pending schema migrations", formatter_class=ArgumentDefaultsHelpFormatter)
+    migrate_parser.add_argument("--to", help="Version to migrate to, earlier versions roll back", type=int)
+    migrate_parser.add_argument("--list", dest="show", help="Show applied and pending migrations", action="store_true")
+    migrate_parser.set_defaults(func=migrate_db)
+
+    # Move inline covers to the cover store
+    covers_parser = subparser.add_parser("migrate-covers", help="Move inline base64 cover art into the cover store", formatter_class=ArgumentDefaultsHelpFormatter)
+    covers_parser.set_defaults(func=migrate_covers)
+
     # Parse the cli args, splitting out function from args
     args = vars(parser.parse_args())
     func_name = args["func"]
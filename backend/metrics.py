@@ -0,0 +1,240 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from logging import getLogger
+from threading import Lock
+from time import perf_counter
+
+from sqlalchemy import event
+
+from .config import config_value
+
+logger = getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Statements taking longer are logged, 0 turns the log off
+slow_query_seconds = config_value("SLOW_QUERY_SECONDS", 0.0, float)
+# Whether slow SELECTs are run again under EXPLAIN ANALYZE for the log
+slow_query_explain = config_value("SLOW_QUERY_EXPLAIN", False, bool)
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if len(names) == 0:
+        return ""
+    escaped = (
+        str(it).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        for it in values
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class Counter:
+    """Running totals per label set"""
+    def __init__(self, name: str, help: str, label_names: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._lock = Lock()
+        self._series: dict[tuple, float] = {}
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._series.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, labels)} {value}")
+        return lines
+
+class Histogram:
+    """Observations per label set counted into fixed buckets"""
+    def __init__(self, name: str, help: str, buckets: tuple, label_names: tuple = ()):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label_names = label_names
+        self._lock = Lock()
+        # Per bucket counts followed by the overflow count, the sum and the total count
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, labels: tuple, value: float):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.label_names + ("le",)
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{format_labels(names, labels + (bound,))} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {series[-2]}")
+                lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {series[-1]}")
+        return lines
+
+class QueryStats:
+    """Statements run on behalf of one request"""
+    __slots__ = ["count", "seconds"]
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+# Set by the middleware for the request being served
+_current_queries: ContextVar[QueryStats] = ContextVar("current_queries", default=None)
+
+class RequestMetrics:
+    """Request and database statement metrics of the process"""
+    def __init__(self):
+        route = ("method", "route")
+        self.requests = Counter("http_requests_total", "Requests answered", route + ("status",))
+        self.latency = Histogram("http_request_duration_seconds", "Time to answer a request", LATENCY_BUCKETS, route)
+        self.response_size = Histogram("http_response_size_bytes", "Size of response bodies", SIZE_BUCKETS, route)
+        self.queries = Histogram("db_queries_per_request", "Statements run by one request", QUERY_COUNT_BUCKETS, route)
+        self.query_time = Histogram("db_query_time_per_request_seconds", "Time spent in statements by one request", LATENCY_BUCKETS, route)
+        self.statements = Histogram("db_statement_duration_seconds", "Time to run a statement", LATENCY_BUCKETS, ("statement",))
+        self.slow_statements = Counter("db_slow_statements_total", "Statements over SLOW_QUERY_SECONDS", ("statement",))
+
+    @property
+    def instruments(self) -> tuple:
+        return (
+            self.requests, self.latency, self.response_size, self.queries,
+            self.query_time, self.statements, self.slow_statements
+        )
+
+    def reset(self):
+        for it in self.instruments:
+            it.reset()
+
+    def record_request(self, method: str, route: str, status: int, elapsed: float, size: int, queries: QueryStats):
+        labels = (method, route)
+        self.requests.inc(labels + (status,))
+        self.latency.observe(labels, elapsed)
+        self.response_size.observe(labels, size)
+        self.queries.observe(labels, queries.count)
+        self.query_time.observe(labels, queries.seconds)
+
+    def render(self, gauges: dict = {}) -> str:
+        lines = []
+        for it in self.instruments:
+            lines.extend(it.render())
+        for name, value in gauges.items():
+            lines.extend([f"# TYPE {name} gauge", f"{name} {float(value)}"])
+        return "\n".join(lines) + "\n"
+
+request_metrics = RequestMetrics()
+
+class MetricsMiddleware:
+    """Times each request and measures its response, labelled by route template
+
+    Requests matching no route share one label so unknown paths cannot grow
+    the number of series.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = perf_counter()
+        status = 500
+        size = 0
+        queries = QueryStats()
+        token = _current_queries.set(queries)
+
+        async def measured_send(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, measured_send)
+        finally:
+            _current_queries.reset(token)
+            route = scope.get("route")
+            request_metrics.record_request(
+                scope["method"], getattr(route, "path", "unmatched"), status,
+                perf_counter() - start, size, queries
+            )
+
+def statement_kind(statement: str) -> str:
+    words = statement.lstrip().split(None, 1)
+    kind = words[0].lower() if len(words) > 0 else ""
+    return kind if kind in ["select", "insert", "update", "delete", "with"] else "other"
+
+def explain_analyze(connection, statement: str, parameters) -> str:
+    """Plan of a statement run again under EXPLAIN ANALYZE
+
+    A savepoint keeps a failing EXPLAIN from aborting the caller's transaction.
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SAVEPOINT explain_slow_query")
+        try:
+            cursor.execute("EXPLAIN ANALYZE " + statement, parameters)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        except Exception:
+            cursor.execute("ROLLBACK TO SAVEPOINT explain_slow_query")
+            raise
+        cursor.execute("RELEASE SAVEPOINT explain_slow_query")
+        return plan
+    finally:
+        cursor.close()
+
+def log_slow_query(conn, statement: str, parameters, elapsed: float, executemany: bool):
+    request_metrics.slow_statements.inc((statement_kind(statement),))
+    plan = ""
+    # Only reads are safe to run twice
+    if slow_query_explain and not executemany and statement_kind(statement) == "select":
+        try:
+            plan = "\n" + explain_analyze(conn.connection, statement, parameters)
+        except Exception as e:
+            plan = f"\nEXPLAIN failed: {e}"
+    logger.warning("Slow query (%.3fs): %s%s", elapsed, statement, plan)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # A failed statement leaves its start behind, replaced by the next one
+    conn.info["query_start"] = perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop("query_start", None)
+    if start is None:
+        return
+    elapsed = perf_counter() - start
+    request_metrics.statements.observe((statement_kind(statement),), elapsed)
+    queries = _current_queries.get()
+    if queries is not None:
+        queries.count += 1
+        queries.seconds += elapsed
+    if slow_query_seconds > 0 and elapsed >= slow_query_seconds:
+        log_slow_query(conn, statement, parameters, elapsed, executemany)
+
+def instrument_engine(engine):
+    """Time every statement run through engine, the sync_engine of async engines"""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
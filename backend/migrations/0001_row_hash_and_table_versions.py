@@ -0,0 +1,23 @@
+"""Row hashes for upsert ingest and the table version triggers of the api
+
+Databases created by init already have these, so every statement is
+written to be skipped when there is nothing to do. It cannot be rolled back,
+as the models map everything it adds.
+"""
+from models import BUMP_TABLE_VERSION_SQL, version_trigger_sql
+
+up = [
+    "ALTER TABLE books ADD COLUMN IF NOT EXISTS row_hash VARCHAR(64)",
+    """
+    CREATE TABLE IF NOT EXISTS table_versions (
+        name VARCHAR PRIMARY KEY,
+        version BIGINT NOT NULL,
+        modified TIMESTAMP WITH TIME ZONE NOT NULL
+    )
+    """,
+    BUMP_TABLE_VERSION_SQL,
+    version_trigger_sql("categories"),
+    version_trigger_sql("books"),
+]
+
+down = None
@@ -0,0 +1,19 @@
+"""Indexes for the book list order and isbn lookups
+
+The list endpoints sort and page by (category, author, title, id), which
+the first index returns in order. Its leading column also serves the joins
+and foreign key checks on category. Built concurrently so the tables stay
+writable.
+"""
+
+transactional = False
+
+up = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_books_list_order ON books (category, author, title, id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_books_isbn ON books (isbn)",
+]
+
+down = [
+    "DROP INDEX CONCURRENTLY IF EXISTS ix_books_isbn",
+    "DROP INDEX CONCURRENTLY IF EXISTS ix_books_list_order",
+]
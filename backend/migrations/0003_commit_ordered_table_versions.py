@@ -0,0 +1,12 @@
+"""Table versions that follow commit order
+
+Versions were the id of the changing transaction, so one that started
+earlier but committed later moved the version back. They now count clock
+microseconds and never decrease. Rolling back keeps the new function, it
+works with the schema of every earlier version.
+"""
+from models import BUMP_TABLE_VERSION_SQL
+
+up = [BUMP_TABLE_VERSION_SQL]
+
+down = []
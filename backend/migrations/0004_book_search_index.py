@@ -0,0 +1,16 @@
+"""Full text index of the book search
+
+init builds it from the models, databases created before search was added
+only get it here. Built concurrently so the tables stay writable.
+"""
+
+transactional = False
+
+up = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_books_search ON books "
+    "USING gin (to_tsvector('simple'::regconfig, title || ' ' || author))",
+]
+
+down = [
+    "DROP INDEX CONCURRENTLY IF EXISTS ix_books_search",
+]
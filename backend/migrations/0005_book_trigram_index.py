@@ -0,0 +1,21 @@
+"""Trigram index for the typo tolerant book search
+
+Stays pending on servers without pg_trgm, searches only skip close
+spellings there. The trigram index on category paths goes, as categories
+are searched in memory and it only slowed writes.
+"""
+
+transactional = False
+
+extensions = ["pg_trgm"]
+
+up = [
+    "DROP INDEX CONCURRENTLY IF EXISTS ix_categories_cat_path_trgm",
+    # Matches the book search text in models.py
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_books_search_trgm ON books "
+    "USING gin ((title || ' ' || author) gin_trgm_ops)",
+]
+
+down = [
+    "DROP INDEX CONCURRENTLY IF EXISTS ix_books_search_trgm",
+]
@@ -0,0 +1,45 @@
+"""Versioned schema changes, applied in order by `manageDatabase.py migrate`
+
+Each module is named NNNN_description.py and defines lists of sql
+statements `up` and `down`, where down undoes up. down is None when the
+change cannot be undone, such as adding objects the models map. Modules setting
+`transactional = False` run outside a transaction, one statement at a time,
+as CREATE INDEX CONCURRENTLY requires. Modules listing `extensions` are
+left pending on servers that cannot install them.
+
+Migrations are run by manageDatabase and import the models the same way it
+does, so schema shared with create_all is written once, in models.py.
+"""
+from importlib import import_module
+from pathlib import Path
+
+class Migration:
+    def __init__(self, version: int, name: str, up: list, down: list, transactional: bool = True, extensions: list = None):
+        self.version = version
+        self.name = name
+        self.up = up
+        self.down = down
+        self.transactional = transactional
+        self.extensions = extensions or []
+
+    def __str__(self) -> str:
+        return f"{self.version:04d} {self.name}"
+
+    @property
+    def reversible(self) -> bool:
+        return self.down is not None
+
+def load_migrations() -> list[Migration]:
+    """All migrations, oldest first"""
+    found = []
+    for path in sorted(Path(__file__).parent.glob("[0-9][0-9][0-9][0-9]_*.py")):
+        module = import_module(f"{__name__}.{path.stem}")
+        found.append(Migration(
+            int(path.stem[:4]),
+            path.stem[5:],
+            module.up,
+            module.down,
+            getattr(module, "transactional", True),
+            getattr(module, "extensions", None)
+        ))
+    return found
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, VARCHAR, ForeignKey, Uuid
+from sqlalchemy import Column, Integer, BigInteger, String, VARCHAR, DateTime, ForeignKey, Uuid, LargeBinary, Index, DDL, event, func, literal_column, text
+from sqlalchemy.dialects import postgresql  # registers the full text search functions used below
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
@@ -8,12 +9,70 @@ class CategoriesTB(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     cat_id = Column(String(9), nullable=False, unique=True)
     cat_path = Column(String, nullable=False, unique=True)
+
+class CoversTB(Base):
+    __tablename__ = "covers"
+    # sha256 of the image bytes, identical covers are stored once
+    id = Column(String(64), primary_key=True)
+    content_type = Column(String, nullable=False)
+    data = Column(LargeBinary, nullable=False)
     
+class TableVersionsTB(Base):
+    __tablename__ = "table_versions"
+    # Bumped by the triggers below on every statement changing the table
+    name = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False)
+    modified = Column(DateTime(timezone=True), nullable=False)
+
 class BooksTB(Base):
     __tablename__ = "books"
     id = Column(Uuid, primary_key=True)
     title = Column(String, nullable=False)
     author = Column(String, nullable=False)
     isbn = Column(VARCHAR, nullable=True)
-    cover_art = Column(VARCHAR, nullable=True)
+    cover_id = Column(String(64), ForeignKey("covers.id"), nullable=True)
     category = Column("category", Integer, ForeignKey("categories.id"), nullable=True)
+    # sha256 of the csv values last ingested, lets resyncs skip unchanged rows
+    row_hash = Column(String(64), nullable=True)
+
+# Text searched by /books/search. Queries must use these exact expressions for
+# the indexes below to apply, so constants are inlined rather than bound.
+SEARCH_CONFIG = text("'simple'::regconfig")
+book_search_text = BooksTB.__table__.c.title.concat(literal_column("' '")).concat(BooksTB.__table__.c.author)
+book_search_vector = func.to_tsvector(SEARCH_CONFIG, book_search_text)
+
+# Added to existing databases by migrations/0004_book_search_index.py
+Index("ix_books_search", book_search_vector, postgresql_using="gin")
+
+# Added to existing databases by migrations/0002_book_list_indexes.py
+Index("ix_books_list_order", BooksTB.category, BooksTB.author, BooksTB.title, BooksTB.id)
+Index("ix_books_isbn", BooksTB.isbn)
+
+# Versions count microseconds of the clock. The row lock taken on
+# table_versions is held until commit, so a later commit always gets a larger
+# version and modified time, even when tables are dropped and created again.
+# Migrations install the same function and triggers in existing databases.
+VERSIONED_TABLES = ["categories", "books"]
+BUMP_TABLE_VERSION_SQL = """
+CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO table_versions (name, version, modified)
+    VALUES (TG_TABLE_NAME, (extract(epoch FROM clock_timestamp()) * 1000000)::bigint, clock_timestamp())
+    ON CONFLICT (name) DO UPDATE SET
+        version = GREATEST(table_versions.version + 1, EXCLUDED.version),
+        modified = GREATEST(table_versions.modified, EXCLUDED.modified);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+def version_trigger_sql(table: str) -> str:
+    return (
+        f"CREATE OR REPLACE TRIGGER {table}_version "
+        f"AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table} "
+        f"FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()"
+    )
+
+event.listen(Base.metadata, "before_create", DDL(BUMP_TABLE_VERSION_SQL))
+for table in VERSIONED_TABLES:
+    event.listen(Base.metadata.tables[table], "after_create", DDL(version_trigger_sql(table)))
@@ -0,0 +1,79 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as DecodeError
+from fastapi import HTTPException
+from json import dumps, loads
+from sqlalchemy import select, tuple_, union_all
+from uuid import UUID
+
+from .models import BooksTB
+
+# Stable sort order shared by the list endpoints. Category comes first and
+# uncategorized books are listed last.
+BOOK_ORDER = [
+    BooksTB.category.asc().nulls_last(),
+    BooksTB.author,
+    BooksTB.title,
+    BooksTB.id,
+]
+
+def encode_cursor(category: int, author: str, title: str, book_id: UUID) -> str:
+    """Opaque token pointing just past the given row"""
+    payload = dumps([category, author, title, str(book_id)], separators=(",", ":"))
+    return urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+def decode_cursor(token: str) -> tuple:
+    try:
+        category, author, title, book_id = loads(urlsafe_b64decode(token.encode("ascii")))
+        if category is not None and not isinstance(category, int):
+            raise ValueError(category)
+        return category, str(author), str(title), UUID(book_id)
+    except (DecodeError, UnicodeError, ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+
+def paginate(sql_query, limit: int = None, after: str = None):
+    """Apply the keyset cursor and push the limit into sql
+
+    One extra row is requested so the caller can tell if another page exists.
+    The query must select the BOOK_ORDER columns.
+    """
+    fetch = limit + 1 if limit is not None else None
+    if after is None:
+        return sql_query.order_by(*BOOK_ORDER).limit(fetch)
+
+    category, author, title, book_id = decode_cursor(after)
+    if category is None:
+        return (
+            sql_query
+            .where(BooksTB.category == None)
+            .where(tuple_(BooksTB.author, BooksTB.title, BooksTB.id) > tuple_(author, title, book_id))
+            .order_by(*BOOK_ORDER)
+            .limit(fetch)
+        )
+
+    # Uncategorized books sort last. Reading them in a second branch, rather
+    # than with an OR, keeps both cursor conditions usable by the list index.
+    pages = union_all(
+        sql_query
+        .where(tuple_(BooksTB.category, BooksTB.author, BooksTB.title, BooksTB.id) > tuple_(category, author, title, book_id))
+        .order_by(*BOOK_ORDER)
+        .limit(fetch),
+        sql_query
+        .where(BooksTB.category == None)
+        .order_by(*BOOK_ORDER)
+        .limit(fetch)
+    ).subquery()
+    return (
+        select(*pages.c)
+        .order_by(pages.c.category.asc().nulls_last(), pages.c.author, pages.c.title, pages.c.id)
+        .limit(fetch)
+    )
+
+def next_cursor(rows: list, limit: int = None) -> str:
+    """Cursor for the page after rows, or None when rows is the last page
+
+    Rows must select the book's id, title, author and category columns.
+    """
+    if limit is None or len(rows) <= limit:
+        return None
+    last = rows[limit - 1]
+    return encode_cursor(last.category, last.author, last.title, last.id)
@@ -0,0 +1,11 @@
+import orjson
+from fastapi.responses import JSONResponse
+
+class OrjsonResponse(JSONResponse):
+    """JSON encoded straight to bytes by orjson
+
+    UUIDs and datetimes are encoded natively, so content needs no
+    jsonable_encoder pass first.
+    """
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
@@ -1,147 +1,455 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import select, exc
-from sqlalchemy.orm import Session
-from uuid import uuid4
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from functools import cache
+from re import findall
+from pydantic import ValidationError
+from sqlalchemy import select, update, exc, func, literal, literal_column, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from uuid import UUID, uuid4
 
-from ..models import BooksTB, CategoriesTB
+from ..models import BooksTB, CoversTB, SEARCH_CONFIG, book_search_text, book_search_vector
 from ..schema import BookItem, BookCreate
-from ..database import get_db
+from ..database import get_async_read_db, get_async_write_db
+from ..pagination import paginate, next_cursor
+from ..covers import cover_hash, cover_url, parse_cover_url, parse_data_url
+from ..config import config
+from ..thumbnails import ThumbnailCache, THUMBNAIL_SIZES, THUMBNAIL_TYPE, make_thumbnail, thumbnail_cache
+from ..category_map import CategoryMap
+from ..category_index import CategoryIndex, category_names, get_category_index, resolve_categories
+from ..versioning import DataVersion, etag_matches, table_version
 
 router = APIRouter(tags=["books"], prefix="/api/v1/books")
 
-@router.get("/list")
-async def list_books(limit: int = None, db: Session = Depends(get_db)) -> dict:
-    labels = ["unique_id", "title", "author", "category", "cover_art", "isbn"]
-    sql_query = (
-        select(
-            BooksTB.id,
-            BooksTB.title,
-            BooksTB.author,
-            CategoriesTB.cat_path,
-            BooksTB.cover_art,
-            BooksTB.isbn
-        )
-        .join(CategoriesTB, CategoriesTB.id == BooksTB.category)
+# Whether pg_trgm is installed, checked on the first search
+_trigram_available: bool = None
+
+# Book responses include category names, so they change with either table
+books_version = table_version("books", "categories")
+
+# Most books read or written by one batch request
+BATCH_LIMIT = 1000
+
+# Fields of a book response and the column each is read from
+BOOK_FIELDS = {
+    "unique_id": BooksTB.id,
+    "title": BooksTB.title,
+    "author": BooksTB.author,
+    "category": BooksTB.category,
+    "cover_art": BooksTB.cover_id,
+    "isbn": BooksTB.isbn,
+}
+
+@cache
+def get_thumbnail_cache() -> ThumbnailCache:
+    return thumbnail_cache(config)
+
+def thumbnail_size(size: int = None) -> int:
+    """Optional thumbnail width, limited to the pre-defined sizes"""
+    if size is not None and size not in THUMBNAIL_SIZES:
+        raise HTTPException(status_code=422, detail=f"size must be one of {list(THUMBNAIL_SIZES)}")
+    return size
+
+def book_fields(fields: str = None) -> list[str]:
+    """Comma separated response fields to read, all of them when not given"""
+    if fields is None:
+        return list(BOOK_FIELDS)
+    labels = list(dict.fromkeys(it.strip() for it in fields.split(",") if it.strip() != ""))
+    unknown = [it for it in labels if it not in BOOK_FIELDS]
+    if len(unknown) > 0 or len(labels) == 0:
+        raise HTTPException(status_code=422, detail=f"fields must be taken from {list(BOOK_FIELDS)}")
+    return labels
+
+def book_columns(labels: list, *required) -> list:
+    """Columns of the labels in order, followed by required columns not among them
+
+    The book id is always selected, as cover links are built from it.
+    """
+    columns = [BOOK_FIELDS[it] for it in labels]
+    names = {it.key for it in columns}
+    for it in (BooksTB.id, *required):
+        if it.key not in names:
+            columns.append(it)
+            names.add(it.key)
+    return columns
+
+def format_book(labels: list, row, names: CategoryMap, size: int = None) -> dict:
+    """Map a selected row onto labels, naming the category and linking the cover
+
+    Columns selected after the labelled ones are left out.
+    """
+    result = dict(zip(labels, row))
+    if result.get("category") is not None:
+        result["category"] = names.name_of(result["category"])
+    if result.get("cover_art") is not None:
+        result["cover_art"] = cover_url(row.id, result["cover_art"], size)
+    return result
+
+def batch_entry(id, status: str, result=None, error: str = None) -> dict:
+    """Outcome of one item of a batch read or write, in the same shape for both"""
+    return {"id": id, "status": status, "result": result, "error": error}
+
+async def store_cover(db: AsyncSession, cover_art: str) -> str:
+    """Save a data url cover in the cover store, returning its id"""
+    if cover_art is None:
+        return None
+    cover_id = parse_cover_url(cover_art)
+    if cover_id is not None:
+        # Links are sent back from earlier responses, but may name any cover
+        stored = (await db.execute(select(CoversTB.id).where(CoversTB.id == cover_id))).scalar_one_or_none()
+        if stored is None:
+            raise HTTPException(status_code=422, detail="unknown cover")
+        return cover_id
+
+    content_type, data = parse_data_url(cover_art)
+    cover_id = cover_hash(data)
+    await db.execute(
+        insert(CoversTB)
+        .values(id=cover_id, content_type=content_type, data=data)
+        .on_conflict_do_nothing(index_elements=[CoversTB.id])
     )
-    sql_query_2 = (
-        select(
-            BooksTB.id,
-            BooksTB.title,
-            BooksTB.author,
-            BooksTB.category,
-            BooksTB.cover_art,
-            BooksTB.isbn
-        )
-        .where(BooksTB.category == None)
+    return cover_id
+
+async def category_id(db: AsyncSession, index: CategoryIndex, cat_id: str) -> int:
+    """Table id of a category code, None when no category is given"""
+    if cat_id is None:
+        return None
+    resolved = await resolve_categories(db, index, [cat_id])
+    if cat_id not in resolved:
+        raise HTTPException(status_code=422, detail=f"unknown category {cat_id}")
+    return resolved[cat_id]
+
+@router.get("/list")
+async def list_books(
+    limit: int = Query(None, ge=1),
+    after: str = None,
+    size: int = Depends(thumbnail_size),
+    labels: list[str] = Depends(book_fields),
+    index: CategoryIndex = Depends(get_category_index),
+    version: DataVersion = Depends(books_version),
+    db: AsyncSession = Depends(get_async_read_db)
+) -> dict:
+    cached = await version.cached()
+    if cached is not None:
+        return cached
+
+    # The cursor is built from the sort columns, whether requested or not
+    sql_query = paginate(
+        select(*book_columns(labels, BooksTB.category, BooksTB.author, BooksTB.title)),
+        limit, after
     )
-    
+
     try:
-        list_results = [dict(zip(labels,it)) for it in db.execute(sql_query).all()] + \
-                       [dict(zip(labels,it)) for it in db.execute(sql_query_2).all()]
+        rows = (await db.execute(sql_query)).all()
+        names = await category_names(db, index, version.versions.get("categories"))
     except exc.OperationalError as e:
         raise HTTPException(status_code=400, detail="unknown error")
-    
-    return {"result": [
-        {
-            key: val if key != "category" else (val.replace("|", " / ") if val is not None else None)
-            for key,val in it.items()
-        } for it in list_results[:limit]
-    ]}
+
+    return await version.respond({
+        "result": [format_book(labels, it, names, size) for it in rows[:limit]],
+        "next": next_cursor(rows, limit)
+    })
 
 @router.get("/")
-async def get_book_by_id(book_id: str, db: Session = Depends(get_db)) -> dict:
-    labels = ["unique_id", "title", "author", "category", "cover_art", "isbn"]
-    sql_query = (
-        select(
-            BooksTB.id,
-            BooksTB.title,
-            BooksTB.author,
-            CategoriesTB.cat_path,
-            BooksTB.cover_art,
-            BooksTB.isbn
-        )
-        .join(CategoriesTB, CategoriesTB.id == BooksTB.category, isouter=True)
-        .where(BooksTB.id == book_id)
-    )
-    
+async def get_book_by_id(
+    book_id: str,
+    size: int = Depends(thumbnail_size),
+    labels: list[str] = Depends(book_fields),
+    index: CategoryIndex = Depends(get_category_index),
+    version: DataVersion = Depends(books_version),
+    db: AsyncSession = Depends(get_async_read_db)
+) -> dict:
+    cached = await version.cached()
+    if cached is not None:
+        return cached
+
+    sql_query = select(*book_columns(labels)).where(BooksTB.id == book_id)
+
+    try:
+        row = (await db.execute(sql_query)).one()
+        names = await category_names(db, index, version.versions.get("categories"))
+    except exc.OperationalError as e:
+        raise HTTPException(status_code=400, detail="unknown error")
+
+    return await version.respond({"result": format_book(labels, row, names, size)})
+
+@router.get("/batch")
+async def get_books_batch(
+    ids: list[str] = Query(),
+    size: int = Depends(thumbnail_size),
+    labels: list[str] = Depends(book_fields),
+    index: CategoryIndex = Depends(get_category_index),
+    version: DataVersion = Depends(books_version),
+    db: AsyncSession = Depends(get_async_read_db)
+) -> dict:
+    """Books for each of the ids in the order given, with an error for ids not found
+
+    Each entry has the status found or error.
+    """
+    if len(ids) > BATCH_LIMIT:
+        raise HTTPException(status_code=422, detail=f"at most {BATCH_LIMIT} ids per request")
+    cached = await version.cached()
+    if cached is not None:
+        return cached
+
+    wanted = {}
+    for it in ids:
+        try:
+            wanted[it] = UUID(it)
+        except ValueError:
+            pass
+
+    sql_query = select(*book_columns(labels)).where(BooksTB.id.in_(set(wanted.values())))
     try:
-        result = dict(zip(labels,db.execute(sql_query).one()))
+        rows = (await db.execute(sql_query)).all()
+        names = await category_names(db, index, version.versions.get("categories"))
+        found = {it.id: format_book(labels, it, names, size) for it in rows}
     except exc.OperationalError as e:
         raise HTTPException(status_code=400, detail="unknown error")
 
-    return {"result":
-        {
-            key: val if key != "category" else (val.replace("|", " / ") if val is not None else None)
-            for key,val in result.items()
+    result = []
+    for it in ids:
+        if it not in wanted:
+            result.append(batch_entry(it, "error", error="invalid id"))
+        elif wanted[it] not in found:
+            result.append(batch_entry(it, "error", error="not found"))
+        else:
+            result.append(batch_entry(it, "found", found[wanted[it]]))
+    return await version.respond({"result": result})
+
+@router.post("/batch")
+async def upsert_books_batch(
+    items: list[dict] = Body(),
+    index: CategoryIndex = Depends(get_category_index),
+    db: AsyncSession = Depends(get_async_write_db)
+) -> dict:
+    """Create or replace many books in one transaction
+
+    Each item is validated on its own. Items that fail are reported in place
+    of their result and do not stop the others from being written. Each entry
+    has the status created, updated or error.
+    """
+    if len(items) > BATCH_LIMIT:
+        raise HTTPException(status_code=422, detail=f"at most {BATCH_LIMIT} books per request")
+
+    result = [None] * len(items)
+    books: dict[int, BookCreate] = {}
+    seen = set()
+    for idx, it in enumerate(items):
+        try:
+            book = BookCreate.model_validate(it)
+        except ValidationError as e:
+            errors = ", ".join(f"{'.'.join(str(loc) for loc in err['loc'])}: {err['msg']}" for err in e.errors())
+            result[idx] = batch_entry(it.get("id"), "error", error=errors)
+            continue
+        if book.id in seen:
+            result[idx] = batch_entry(book.id, "error", error="duplicate id")
+            continue
+        seen.add(book.id)
+        books[idx] = book
+
+    # Covers sent back as links are checked with one query
+    cat_ids = {it.category for it in books.values() if it.category is not None}
+    categories = await resolve_categories(db, index, cat_ids)
+    linked = {parse_cover_url(it.cover_art) for it in books.values() if it.cover_art is not None} - {None}
+    stored = set((await db.execute(select(CoversTB.id).where(CoversTB.id.in_(linked)))).scalars())
+
+    covers, rows = {}, {}
+    for idx, book in books.items():
+        if book.category is not None and book.category not in categories:
+            result[idx] = batch_entry(book.id, "error", error=f"unknown category {book.category}")
+            continue
+        cover_id = None
+        if book.cover_art is not None:
+            cover_id = parse_cover_url(book.cover_art)
+            if cover_id is None:
+                content_type, data = parse_data_url(book.cover_art)
+                cover_id = cover_hash(data)
+                covers[cover_id] = {"id": cover_id, "content_type": content_type, "data": data}
+            elif cover_id not in stored:
+                result[idx] = batch_entry(book.id, "error", error="unknown cover")
+                continue
+        rows[idx] = {
+            **book.model_dump(exclude={"cover_art"}),
+            **{"category": categories.get(book.category), "cover_id": cover_id, "row_hash": None}
         }
-    }
 
-@router.get("/list-by-category")
-async def list_books_category(limit: int = None, db: Session = Depends(get_db)) -> dict:
-    labels = ["unique_id", "title", "author", "cover_art", "category", "isbn"]
-    sql_query = (
-        select(
-            BooksTB.id,
-            BooksTB.title,
-            BooksTB.author,
-            BooksTB.cover_art,
-            CategoriesTB.cat_path,
-            BooksTB.isbn
+    if len(covers) > 0:
+        await db.execute(insert(CoversTB).on_conflict_do_nothing(index_elements=[CoversTB.id]), list(covers.values()))
+    if len(rows) > 0:
+        statement = insert(BooksTB).values(list(rows.values()))
+        # xmax is only set on rows that existed before
+        created = dict((await db.execute(
+            statement.on_conflict_do_update(
+                index_elements=[BooksTB.id],
+                set_={it: statement.excluded[it] for it in ["title", "author", "isbn", "cover_id", "category", "row_hash"]}
+            ).returning(BooksTB.id, literal_column("xmax = 0"))
+        )).all())
+    await db.commit()
+
+    for idx, row in rows.items():
+        book = books[idx]
+        result[idx] = batch_entry(
+            book.id,
+            "created" if created[row["id"]] else "updated",
+            BookItem(**{**book.model_dump(), **{"cover_art": cover_url(book.id, row["cover_id"])}})
         )
-        .join(CategoriesTB, CategoriesTB.id == BooksTB.category)
-        .order_by(CategoriesTB.id, BooksTB.author, BooksTB.title)
+    return {"result": result}
+
+@router.get("/list-by-category")
+async def list_books_category(
+    limit: int = Query(None, ge=1),
+    after: str = None,
+    size: int = Depends(thumbnail_size),
+    labels: list[str] = Depends(book_fields),
+    index: CategoryIndex = Depends(get_category_index),
+    version: DataVersion = Depends(books_version),
+    db: AsyncSession = Depends(get_async_read_db)
+) -> dict:
+    cached = await version.cached()
+    if cached is not None:
+        return cached
+
+    sql_query = paginate(
+        select(*book_columns(labels, BooksTB.category, BooksTB.author, BooksTB.title))
+        .where(BooksTB.category != None),
+        limit, after
     )
-    
+
     try:
-        list_results = [dict(zip(labels,it)) for it in db.execute(sql_query).all()]
+        rows = (await db.execute(sql_query)).all()
+        names = await category_names(db, index, version.versions.get("categories"))
     except exc.OperationalError as e:
         raise HTTPException(status_code=400, detail="unknown error")
-    
-    return {"result": [
-        {
-            key: val if key != "category" else val.replace("|", " / ") 
-            for key,val in it.items()
-        } for it in list_results[:limit]
-    ]}
-    
-@router.post("/add")
-async def add_book(data: BookCreate, db: Session = Depends(get_db)) -> BookItem:
-    # Recover category id
+
+    return await version.respond({
+        "result": [format_book(labels, it, names, size) for it in rows[:limit]],
+        "next": next_cursor(rows, limit)
+    })
+
+async def trigram_available(db: AsyncSession) -> bool:
+    global _trigram_available
+    if _trigram_available is None:
+        sql_query = text("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+        _trigram_available = (await db.execute(sql_query)).scalar_one()
+    return _trigram_available
+
+@router.get("/search")
+async def search_books(
+    query: str,
+    category: list[str] = Query(default=[]),
+    limit: int = Query(20, ge=1, le=100),
+    size: int = Depends(thumbnail_size),
+    labels: list[str] = Depends(book_fields),
+    index: CategoryIndex = Depends(get_category_index),
+    version: DataVersion = Depends(books_version),
+    db: AsyncSession = Depends(get_async_read_db)
+) -> dict:
+    """Books with title and author words starting with every query word
+
+    Best matches come first. When pg_trgm is installed, remaining slots are
+    filled with close spellings.
+    """
+    words = findall(r"\w+", query.lower())
+    if len(words) == 0:
+        return {"result": []}
+    cached = await version.cached()
+    if cached is not None:
+        return cached
+
+    sql_query = select(*book_columns(labels))
+    if len(category) > 0:
+        # Categories include everything below them
+        sql_query = sql_query.where(BooksTB.category.in_(index.resolve(index.subtree(category)).values()))
+
+    ts_query = func.to_tsquery(SEARCH_CONFIG, " & ".join(f"{word}:*" for word in words))
+    try:
+        rows = (await db.execute(
+            sql_query
+            .where(book_search_vector.op("@@")(ts_query))
+            .order_by(func.ts_rank_cd(book_search_vector, ts_query).desc(), BooksTB.title, BooksTB.id)
+            .limit(limit)
+        )).all()
+
+        if len(rows) < limit and await trigram_available(db):
+            phrase = " ".join(words)
+            rows += (await db.execute(
+                sql_query
+                .where(literal(phrase).op("<%")(book_search_text))
+                .where(BooksTB.id.not_in([it.id for it in rows]))
+                .order_by(func.word_similarity(phrase, book_search_text).desc(), BooksTB.title, BooksTB.id)
+                .limit(limit - len(rows))
+            )).all()
+        names = await category_names(db, index, version.versions.get("categories"))
+    except exc.OperationalError as e:
+        raise HTTPException(status_code=400, detail="unknown error")
+
+    return await version.respond({"result": [format_book(labels, it, names, size) for it in rows]})
+
+@router.get("/{book_id}/cover")
+async def get_cover(
+    book_id: UUID,
+    request: Request,
+    size: int = Depends(thumbnail_size),
+    thumbnails: ThumbnailCache = Depends(get_thumbnail_cache),
+    db: AsyncSession = Depends(get_async_read_db)
+) -> Response:
     sql_query = (
-        select(CategoriesTB.id)
-        .where(CategoriesTB.cat_id == data.category)
+        select(CoversTB.id, CoversTB.content_type)
+        .join(BooksTB, BooksTB.cover_id == CoversTB.id)
+        .where(BooksTB.id == book_id)
     )
-    cat_id = db.execute(sql_query).mappings().one_or_none().id
-    db_model = {**data.model_dump(), **{"category": cat_id}}
+    cover = (await db.execute(sql_query)).one_or_none()
+    if cover is None:
+        raise HTTPException(status_code=404, detail="cover not found")
+
+    # Covers are content addressed, so a matching tag never needs the image itself
+    headers = {
+        "ETag": f'"{cover.id}"' if size is None else f'"{cover.id}-{size}"',
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+    if etag_matches(request.headers.get("if-none-match", ""), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    if size is not None:
+        # The cache reads and writes files, kept off the event loop like resizing
+        thumbnail = await run_in_threadpool(thumbnails.get, cover.id, size)
+        if thumbnail is None:
+            data = (await db.execute(select(CoversTB.data).where(CoversTB.id == cover.id))).scalar_one()
+            try:
+                thumbnail = await run_in_threadpool(make_thumbnail, data, size)
+            except OSError:
+                # Uploads are only checked to be base64, not to be images Pillow can read
+                raise HTTPException(status_code=415, detail="cover cannot be resized")
+            await run_in_threadpool(thumbnails.put, cover.id, size, thumbnail)
+        return Response(content=thumbnail, media_type=THUMBNAIL_TYPE, headers=headers)
+
+    data = (await db.execute(select(CoversTB.data).where(CoversTB.id == cover.id))).scalar_one()
+    return Response(content=data, media_type=cover.content_type, headers=headers)
+
+@router.post("/add")
+async def add_book(data: BookCreate, index: CategoryIndex = Depends(get_category_index), db: AsyncSession = Depends(get_async_write_db)) -> BookItem:
+    cat_id = await category_id(db, index, data.category)
+    cover_id = await store_cover(db, data.cover_art)
+    db_model = {**data.model_dump(exclude={"cover_art"}), **{"category": cat_id, "cover_id": cover_id, "row_hash": None}}
     db.add(BooksTB(**db_model))
-    db.commit()
+    await db.commit()
 
-    return BookItem(**data.model_dump())
+    return BookItem(**{**data.model_dump(), **{"cover_art": cover_url(data.id, cover_id)}})
 
 @router.put("/")
-async def update_book(data: BookCreate, db: Session = Depends(get_db)) -> BookItem:
-    # Get category id
-    cat_id = None
-    if data.category is not None:
-        cat_id = db.query(CategoriesTB.id) \
-                     .filter(CategoriesTB.cat_id == data.category) \
-                     .one_or_none().id
-
-    db_model = {**data.model_dump(), **{"category": cat_id}}
-    db.query(BooksTB) \
-        .filter(BooksTB.id == data.id) \
-        .update(db_model)
-    db.commit()
-
-    book_model = {**db_model, **{"category": data.category}}
-    return BookItem(**book_model)
+async def update_book(data: BookCreate, index: CategoryIndex = Depends(get_category_index), db: AsyncSession = Depends(get_async_write_db)) -> BookItem:
+    cat_id = await category_id(db, index, data.category)
+
+    cover_id = await store_cover(db, data.cover_art)
+    # Clearing the csv hash lets the next upsert ingest restore the csv values
+    db_model = {**data.model_dump(exclude={"cover_art"}), **{"category": cat_id, "cover_id": cover_id, "row_hash": None}}
+    await db.execute(
+        update(BooksTB)
+        .where(BooksTB.id == data.id)
+        .values(**db_model)
+    )
+    await db.commit()
 
-    # sql_query = (
-    #     select(CategoriesTB.id)
-    #     .where(CategoriesTB.cat_id == data.category)
-    # )
-    # cat_id = db.execute(sql_query).mappings().one_or_none().id
-    # db_model = {**data.model_dump(), **{"category": cat_id}}
-    # # db.
-    # print(db_model)
-    # return BookItem(**db_model)
+    book_model = {**data.model_dump(), **{"cover_art": cover_url(data.id, cover_id)}}
+    return BookItem(**book_model)
@@ -1,46 +1,35 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import select, or_, exc
-from sqlalchemy.orm import Session
-from re import compile
 from urllib.parse import unquote
 
-from ..models import CategoriesTB
-from ..database import get_db
+from ..category_index import CategoryIndex, get_category_index
 
 router = APIRouter(tags=["categories"], prefix="/api/v1/categories")
 
 @router.get("/search")
-async def search(query: str, limit: int = 10, db: Session = Depends(get_db)) -> dict:
-    query_list = [it.strip() for it in unquote(query).split(" ") if it.strip() not in ["&"]]
-    query_terms = [
-        CategoriesTB.cat_path.ilike(it)
-            for word in query_list
-            for it in [f"{word}%" ,f"% {word}%", f"%|{word}%"]
-    ]
-    labels = ["id", "name"]
-    sql_query = (
-        select(
-            CategoriesTB.cat_id,
-            CategoriesTB.cat_path)
-        .where(or_(*query_terms))
-    )
-    
-    try:
-        search_results = [dict(zip(labels,it)) for it in db.execute(sql_query).all()]
-    except exc.OperationalError as e:
-        raise HTTPException(status_code=400, detail="unknown error")
-
-    # Sort based on how far from leaf the hit is.
-    pattern = compile("|".join(f"^{word.lower()}|[| ]{word.lower()}" for word in query_list))
-    def rank(key: str):
-        return sum(2**idx / (len(pattern.findall(it.lower()))+1)**-idx for idx,it in enumerate(reversed(key.split('|'))))
-    hits: list[tuple[float,dict]] = sorted([(rank(it["name"]), it) for it in search_results], key=lambda x: (x[0], x[1]["name"]))
-    # print([(it,jt["name"]) for it,jt in hits[:limit]])
-
-    return {"result": [
-        {
-            key: val if key != "name" else val.replace("|", " / ")
-            for key,val in it[1].items()
-        } for it in hits[:limit]
-    ]}
-    
+async def search(query: str, limit: int = 10, index: CategoryIndex = Depends(get_category_index)) -> dict:
+    query_list = [it.strip() for it in unquote(query).split(" ") if it.strip() not in ["&", ""]]
+    if len(query_list) == 0:
+        return {"result": []}
+
+    # Matching and ranking run against the in memory index, sorted based on
+    # how far from leaf the hit is.
+    return {"result": index.search(query_list, limit)}
+
+@router.get("/children")
+async def list_children(path: str = "", index: CategoryIndex = Depends(get_category_index)) -> dict:
+    """Browse the hierarchy by name, top level categories when path is empty"""
+    separator = "|" if "|" in path else " / "
+    segments = tuple(it.strip() for it in path.split(separator)) if path.strip() != "" else ()
+    children = index.children(segments)
+    if children is None:
+        raise HTTPException(status_code=404, detail="category not found")
+
+    return {"result": children}
+
+@router.get("/{cat_id}/children")
+async def list_category_children(cat_id: str, index: CategoryIndex = Depends(get_category_index)) -> dict:
+    path = index.path_of(cat_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="category not found")
+
+    return {"result": index.children(path)}
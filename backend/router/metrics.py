@@ -0,0 +1,15 @@
+from fastapi import APIRouter, Response
+
+from ..database import pool_status
+from ..metrics import CONTENT_TYPE, request_metrics
+
+router = APIRouter(tags=["status"])
+
+@router.get("/metrics")
+async def metrics() -> Response:
+    """Request, statement and pool metrics in the Prometheus text format"""
+    pool = {
+        f"db_pool_{name}": value for name, value in pool_status().items()
+        if isinstance(value, (int, float))
+    }
+    return Response(content=request_metrics.render(pool), media_type=CONTENT_TYPE)
@@ -0,0 +1,9 @@
+from fastapi import APIRouter
+
+from ..database import pool_status
+
+router = APIRouter(tags=["status"], prefix="/api/v1/status")
+
+@router.get("/pool")
+async def database_pool() -> dict:
+    return {"result": pool_status()}
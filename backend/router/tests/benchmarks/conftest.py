@@ -0,0 +1,166 @@
+"""Benchmarks of the api and manageDatabase against synthetic catalogs
+
+Only collected when BENCHMARK is set, as seeding the larger catalogs takes
+minutes. Results are written to BENCHMARK_OUTPUT and, when BENCHMARK_BASELINE
+names an earlier results file, compared against it. Medians slower than the
+baseline by more than BENCHMARK_TOLERANCE fail the run.
+"""
+from asyncio import Runner
+from json import dump, load
+from os import environ
+from pathlib import Path
+from platform import python_version
+from time import perf_counter
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+
+from .synthetic import Catalog, category_rows, cover_images
+
+if environ.get("BENCHMARK", "") == "":
+    collect_ignore_glob = ["test_*.py"]
+
+SIZES = [int(it) for it in environ.get("BENCHMARK_SIZES", "10000,100000,1000000").split(",")]
+RUNS = int(environ.get("BENCHMARK_RUNS", "50"))
+
+class BenchmarkResults:
+    """Timings of named operations, compared against a baseline by median"""
+    def __init__(self, baseline: dict = None, tolerance: float = 0.25):
+        self.baseline = baseline or {}
+        self.tolerance = tolerance
+        self.results: dict[str, dict] = {}
+
+    def measure(self, name: str, call, runs: int = RUNS, setup=None, items: int = 1, warmup: int = 1) -> dict:
+        """Time runs calls of call after warmup untimed ones, setup runs untimed before each
+
+        items is the number of rows or requests one call handles, for throughput.
+        """
+        for _ in range(warmup):
+            if setup is not None:
+                setup()
+            call()
+        timings = []
+        for _ in range(runs):
+            if setup is not None:
+                setup()
+            start = perf_counter()
+            call()
+            timings.append(perf_counter() - start)
+
+        timings.sort()
+        self.results[name] = {
+            "runs": runs,
+            "mean": sum(timings) / runs,
+            "p50": timings[runs // 2],
+            "p95": timings[min(runs - 1, int(runs * 0.95))],
+            "max": timings[-1],
+            "per_second": runs * items / sum(timings),
+        }
+        return self.results[name]
+
+    def regressions(self) -> list[str]:
+        found = []
+        for name, result in sorted(self.results.items()):
+            base = self.baseline.get(name)
+            if base is not None and result["p50"] > base["p50"] * (1 + self.tolerance):
+                found.append(f"{name}: median {result['p50'] * 1000:.2f}ms, baseline {base['p50'] * 1000:.2f}ms")
+        return found
+
+    def write(self, path: Path):
+        with open(path, "w") as outfile:
+            dump({"python": python_version(), "results": self.results}, outfile, indent=2, sort_keys=True)
+
+def load_baseline() -> dict:
+    path = environ.get("BENCHMARK_BASELINE", "")
+    if path == "":
+        return {}
+    with open(path) as infile:
+        return load(infile)["results"]
+
+benchmark_results = BenchmarkResults(load_baseline(), float(environ.get("BENCHMARK_TOLERANCE", "0.25")))
+
+@pytest.fixture
+def bench() -> BenchmarkResults:
+    return benchmark_results
+
+def pytest_generate_tests(metafunc):
+    if "catalog_size" in metafunc.fixturenames:
+        metafunc.parametrize("catalog_size", SIZES)
+
+class BenchmarkClient:
+    """Sends requests to the api from one event loop
+
+    The test client starts a loop per request, which rules out pooled
+    connections and would mostly measure connecting to the database.
+    """
+    def __init__(self, app):
+        self.app = app
+        self._runner = Runner()
+        self._client = AsyncClient(transport=ASGITransport(app=app), base_url="http://testserver")
+
+    def run(self, coroutine):
+        return self._runner.run(coroutine)
+
+    def request(self, method: str, url: str, **kwargs):
+        return self.run(self._client.request(method, url, **kwargs))
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def close(self):
+        self.run(self._client.aclose())
+        self._runner.close()
+
+@pytest.fixture
+def client(db_session, helpers) -> BenchmarkClient:
+    """Client of the api using a connection pool on the test database"""
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    from ....database import get_async_db, get_async_read_db, pool_options
+    from ....metrics import instrument_engine
+
+    app = helpers.get_client(db_session).app
+    engine = create_async_engine(db_session.get_bind().url.set(drivername="postgresql+psycopg"), **pool_options())
+    instrument_engine(engine.sync_engine)
+    sessions = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+    async def get_pooled_db():
+        async with sessions() as db:
+            yield db
+    app.dependency_overrides[get_async_db] = get_pooled_db
+    app.dependency_overrides[get_async_read_db] = get_pooled_db
+
+    client = BenchmarkClient(app)
+    yield client
+    client.run(engine.dispose())
+    client.close()
+
+@pytest.fixture
+def catalog(db_session, catalog_size) -> Catalog:
+    """The test database seeded with catalog_size deterministic books
+
+    The database is dropped after each test, so benchmarks sharing a catalog
+    are run from one test rather than seeding it again.
+    """
+    catalog = Catalog(catalog_size, category_rows(), cover_images())
+    catalog.load(db_session)
+    return catalog
+
+def pytest_sessionfinish(session, exitstatus):
+    if len(benchmark_results.results) == 0:
+        return
+    output = Path(environ.get("BENCHMARK_OUTPUT", "benchmark-results.json"))
+    benchmark_results.write(output)
+
+    reporter = session.config.pluginmanager.get_plugin("terminalreporter")
+    regressions = benchmark_results.regressions()
+    if reporter is not None:
+        reporter.write_line(f"\nBenchmark results written to {output}")
+        for it in regressions:
+            reporter.write_line(f"REGRESSION {it}", red=True)
+    if len(regressions) > 0:
+        session.exitstatus = pytest.ExitCode.TESTS_FAILED
@@ -0,0 +1,132 @@
+from csv import writer
+from hashlib import sha256
+from io import BytesIO
+from pathlib import Path
+from random import Random
+from uuid import UUID
+
+from PIL import Image
+
+WORDS = [
+    "ancient", "art", "atlas", "autumn", "beyond", "blue", "bridge", "castle", "city", "code",
+    "cooking", "dark", "desert", "dragon", "dream", "early", "empire", "field", "fire", "forest",
+    "garden", "glass", "golden", "guide", "harbor", "hidden", "history", "house", "island", "journey",
+    "kingdom", "lake", "last", "letters", "light", "lost", "machine", "market", "memory", "modern",
+    "moon", "mountain", "music", "night", "north", "ocean", "paper", "practical", "quiet", "rain",
+    "red", "river", "road", "salt", "science", "secret", "shadow", "silver", "song", "south",
+    "spring", "star", "stone", "storm", "story", "summer", "theory", "thunder", "tower", "travel",
+    "tree", "valley", "voyage", "war", "water", "west", "whisper", "wild", "wind", "winter",
+]
+GIVEN_NAMES = [
+    "Ada", "Alan", "Ana", "Boris", "Chen", "Clara", "David", "Elena", "Farah", "George",
+    "Hana", "Ivan", "Jane", "Kofi", "Lena", "Mario", "Nadia", "Omar", "Priya", "Sam",
+]
+FAMILY_NAMES = [
+    "Abe", "Brown", "Costa", "Dubois", "Evans", "Fischer", "Garcia", "Hughes", "Ito", "Jensen",
+    "Kim", "Lopez", "Meyer", "Novak", "Okafor", "Patel", "Quinn", "Rossi", "Silva", "Tanaka",
+    "Usman", "Varga", "Walker", "Xu", "Young", "Zhang",
+]
+
+def category_rows(top: int = 20, fanout: tuple = (8, 5), seed: int = 0) -> list[tuple[str, str]]:
+    """(cat_id, cat_path) of a three level tree in the style of the BISAC codes
+
+    Every level is a category of its own, like "General" entries are in the
+    real data, and sibling names never repeat.
+    """
+    rng = Random(seed)
+    rows = []
+    for it in range(top):
+        prefix = "".join(chr(65 + (it // 26**power) % 26) for power in (2, 1, 0))
+        top_name = " ".join(rng.sample(WORDS, 2)).title()
+        rows.append((f"{prefix}000000", top_name))
+        for second, second_words in enumerate(sibling_names(rng, fanout[0]), start=1):
+            second_path = f"{top_name}|{second_words}"
+            rows.append((f"{prefix}{second:03d}000", second_path))
+            for third, third_words in enumerate(sibling_names(rng, fanout[1]), start=1):
+                rows.append((f"{prefix}{second:03d}{third:03d}", f"{second_path}|{third_words}"))
+    return rows
+
+def sibling_names(rng: Random, count: int) -> list[str]:
+    names = []
+    while len(names) < count:
+        name = " ".join(rng.sample(WORDS, rng.randint(1, 3))).title()
+        if name not in names:
+            names.append(name)
+    return names
+
+def cover_images(count: int = 20, seed: int = 0) -> list[bytes]:
+    """JPEG covers from thumbnail to full page size, noisy so they compress realistically"""
+    rng = Random(seed)
+    covers = []
+    for it in range(count):
+        width = 100 + (900 * it) // max(count - 1, 1)
+        size = (width, width * 3 // 2)
+        image = Image.merge("RGB", [Image.effect_noise(size, rng.randint(10, 60)) for _ in range(3)])
+        output = BytesIO()
+        image.save(output, "JPEG", quality=rng.randint(60, 90))
+        covers.append(output.getvalue())
+    return covers
+
+def book_rows(count: int, category_ids: list, cover_ids: list, seed: int = 0):
+    """(id, title, author, isbn, category, cover_id) of count books
+
+    About one book in fifty has no category and one in three no cover.
+    """
+    rng = Random(seed)
+    for _ in range(count):
+        yield (
+            UUID(int=rng.getrandbits(128), version=4),
+            " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 6))).capitalize(),
+            f"{rng.choice(FAMILY_NAMES)}, {rng.choice(GIVEN_NAMES)}",
+            f"{rng.randrange(10**12, 10**13)}" if rng.random() < 0.8 else None,
+            rng.choice(category_ids) if rng.random() >= 0.02 else None,
+            rng.choice(cover_ids) if rng.random() >= 0.33 else None,
+        )
+
+class Catalog:
+    """A synthetic catalog loaded into the test database"""
+    def __init__(self, size: int, categories: list, covers: list[bytes], seed: int = 0):
+        self.size = size
+        self.categories = categories
+        self.covers = covers
+        self.seed = seed
+        self.cover_ids = [sha256(it).hexdigest() for it in covers]
+
+    def books(self, category_ids: list, cover_ids: list):
+        return book_rows(self.size, category_ids, cover_ids, self.seed)
+
+    def load(self, session):
+        """COPY the catalog into the database behind session"""
+        conn = session.connection()
+        with conn.connection.driver_connection.cursor() as cursor:
+            with cursor.copy("COPY categories (cat_id, cat_path) FROM STDIN") as copy:
+                for it in self.categories:
+                    copy.write_row(it)
+            with cursor.copy("COPY covers (id, content_type, data) FROM STDIN") as copy:
+                for cover_id, data in zip(self.cover_ids, self.covers):
+                    copy.write_row((cover_id, "image/jpeg", data))
+            cursor.execute("SELECT id FROM categories ORDER BY id")
+            category_ids = [it[0] for it in cursor.fetchall()]
+            with cursor.copy("COPY books (id, title, author, isbn, category, cover_id) FROM STDIN") as copy:
+                for it in self.books(category_ids, self.cover_ids):
+                    copy.write_row(it)
+            cursor.execute("ANALYZE")
+        session.commit()
+
+    def write_csv(self, directory: Path):
+        """categories.csv, books.csv and cover files in the layout ingest reads"""
+        directory.mkdir(parents=True, exist_ok=True)
+        with open(directory / "categories.csv", "w", newline="") as outfile:
+            output = writer(outfile)
+            output.writerow(["cat_id", "cat_path"])
+            output.writerows((cat_id, cat_path.replace("|", " / ")) for cat_id, cat_path in self.categories)
+
+        names = [f"{it}.jpg" for it in self.cover_ids]
+        for name, data in zip(names, self.covers):
+            (directory / name).write_bytes(data)
+
+        cat_ids = [cat_id for cat_id, _ in self.categories]
+        with open(directory / "books.csv", "w", newline="") as outfile:
+            output = writer(outfile)
+            output.writerow(["id", "title", "author", "isbn", "category", "cover_art"])
+            output.writerows(self.books(cat_ids, names))
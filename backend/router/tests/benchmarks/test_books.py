@@ -0,0 +1,97 @@
+from base64 import b64encode
+from random import Random
+
+from sqlalchemy import select
+
+from ....models import BooksTB
+from ....pagination import BOOK_ORDER, encode_cursor
+from ....thumbnails import ThumbnailCache
+from ....versioning import response_cache
+from ...books import get_thumbnail_cache
+
+PAGE = 50
+
+def ok(response):
+    assert response.status_code == 200, response.text
+    return response
+
+def test_books(catalog, db_session, client, bench, tmp_path):
+    """Reads and then writes over one seeded catalog, as seeding the larger ones takes minutes"""
+    book_reads(catalog, db_session, client, bench, tmp_path)
+    book_writes(catalog, client, bench)
+
+def book_reads(catalog, db_session, client, bench, tmp_path):
+    thumbnails = ThumbnailCache(tmp_path / "thumbnails", 2**30)
+    client.app.dependency_overrides[get_thumbnail_cache] = lambda: thumbnails
+    name = f"{catalog.size}/books"
+
+    rng = Random(catalog.seed)
+    ids = [str(it) for it in db_session.execute(select(BooksTB.id)).scalars()]
+    sample = rng.sample(ids, 100)
+    covered = str(db_session.execute(select(BooksTB.id).where(BooksTB.cover_id != None).limit(1)).scalar_one())
+    # A cursor nine tenths of the way through the listing
+    deep = db_session.execute(
+        select(BooksTB.category, BooksTB.author, BooksTB.title, BooksTB.id)
+        .order_by(*BOOK_ORDER).offset(catalog.size * 9 // 10).limit(1)
+    ).one()
+    after = encode_cursor(deep.category, deep.author, deep.title, deep.id)
+    batch = "&".join(f"ids={it}" for it in sample)
+
+    reads = {
+        "list": f"/api/v1/books/list?limit={PAGE}",
+        "list_fields": f"/api/v1/books/list?limit={PAGE}&fields=unique_id,title",
+        "list_deep": f"/api/v1/books/list?limit={PAGE}&after={after}",
+        "list_by_category": f"/api/v1/books/list-by-category?limit={PAGE}",
+        "by_id": f"/api/v1/books/?book_id={sample[0]}",
+        "batch_100": f"/api/v1/books/batch?{batch}",
+        "search": "/api/v1/books/search?query=riv",
+        "search_two_words": "/api/v1/books/search?query=silver%20moon",
+        "search_category": f"/api/v1/books/search?query=storm&category={catalog.categories[0][0]}",
+    }
+    for label, url in reads.items():
+        bench.measure(f"{name}/{label}", lambda: ok(client.get(url)), setup=response_cache.clear)
+        bench.measure(f"{name}/{label}/cached", lambda: ok(client.get(url)))
+
+    def clear_thumbnails():
+        for it in thumbnails.directory.glob("*.webp"):
+            it.unlink()
+
+    bench.measure(f"{name}/cover", lambda: ok(client.get(f"/api/v1/books/{covered}/cover")))
+    bench.measure(
+        f"{name}/cover_thumbnail", lambda: ok(client.get(f"/api/v1/books/{covered}/cover?size=160")),
+        setup=clear_thumbnails, runs=10
+    )
+    bench.measure(f"{name}/cover_thumbnail/cached", lambda: ok(client.get(f"/api/v1/books/{covered}/cover?size=160")))
+
+    # Walking the listing page by page, up to 100k books
+    def walk(limit: int = 1000):
+        url = f"/api/v1/books/list?limit={limit}&fields=unique_id"
+        pages = 0
+        while url is not None and pages < 100:
+            cursor = ok(client.get(url)).json()["next"]
+            url = f"/api/v1/books/list?limit={limit}&fields=unique_id&after={cursor}" if cursor is not None else None
+            pages += 1
+    bench.measure(f"{name}/list_walk", walk, runs=1, setup=response_cache.clear, items=min(catalog.size, 100_000))
+
+    client.app.dependency_overrides.pop(get_thumbnail_cache)
+
+def book_writes(catalog, client, bench):
+    name = f"{catalog.size}/books"
+    cat_id = catalog.categories[-1][0]
+    rng = Random(catalog.seed)
+    cover = "data:image/jpeg;base64," + b64encode(catalog.covers[0]).decode("ascii")
+
+    def book(**fields) -> dict:
+        return {"title": f"Benchmark {rng.random()}", "author": "Bench, Mark", "category": cat_id, **fields}
+
+    bench.measure(f"{name}/add", lambda: ok(client.post("/api/v1/books/add", json=book())))
+    bench.measure(f"{name}/add_cover", lambda: ok(client.post("/api/v1/books/add", json=book(cover_art=cover))))
+
+    existing = ok(client.post("/api/v1/books/add", json=book())).json()["id"]
+    bench.measure(f"{name}/update", lambda: ok(client.put("/api/v1/books/", json=book(id=existing))))
+
+    bench.measure(
+        f"{name}/batch_upsert_100",
+        lambda: ok(client.post("/api/v1/books/batch", json=[book() for _ in range(100)])),
+        runs=10, items=100
+    )
@@ -0,0 +1,19 @@
+from ....models import CategoriesTB
+from .synthetic import category_rows
+from .test_books import ok
+
+def test_category_reads(db_session, helpers, client, bench):
+    db_session.add_all([CategoriesTB(cat_id=cat_id, cat_path=cat_path) for cat_id, cat_path in category_rows()])
+    db_session.commit()
+    helpers.reload_categories(db_session)
+
+    second = category_rows()[1][1]
+    reads = {
+        "search": "/api/v1/categories/search?query=hist",
+        "search_three_words": "/api/v1/categories/search?query=silver%20moon%20river&limit=50",
+        "children_top": "/api/v1/categories/children",
+        "children_path": f"/api/v1/categories/children?path={second}",
+        "children_by_id": f"/api/v1/categories/{category_rows()[0][0]}/children",
+    }
+    for label, url in reads.items():
+        bench.measure(f"categories/{label}", lambda: ok(client.get(url)))
@@ -0,0 +1,37 @@
+from shutil import rmtree
+
+from sqlalchemy import text
+
+from .synthetic import Catalog, category_rows, cover_images
+
+def test_manage_commands(db_session, manage, catalog_size, bench, tmp_path):
+    """Ingest and dump a catalog through the command line, as deployments run them"""
+    catalog = Catalog(catalog_size, category_rows(), cover_images())
+    source = tmp_path / "source"
+    catalog.write_csv(source)
+
+    def reset_books():
+        db_session.execute(text("TRUNCATE books, covers"))
+        db_session.commit()
+
+    name = f"{catalog_size}/manage"
+    bench.measure(
+        f"{name}/ingest_categories", lambda: manage("ingest", source / "categories.csv", "--type", "categories"),
+        setup=lambda: (db_session.execute(text("TRUNCATE categories CASCADE")), db_session.commit()),
+        runs=3, items=len(catalog.categories), warmup=0
+    )
+    for workers in [1, 4]:
+        bench.measure(
+            f"{name}/ingest_books/workers_{workers}",
+            lambda: manage("ingest", source / "books.csv", "--type", "books", "--batch-size", "5000", "--workers", str(workers)),
+            setup=reset_books, runs=1, items=catalog_size, warmup=0
+        )
+    bench.measure(
+        f"{name}/ingest_books/upsert_unchanged",
+        lambda: manage("ingest", source / "books.csv", "--type", "books", "--batch-size", "5000", "--mode", "upsert"),
+        runs=1, items=catalog_size, warmup=0
+    )
+    bench.measure(
+        f"{name}/dump", lambda: manage("dump", tmp_path / "dump"),
+        setup=lambda: rmtree(tmp_path / "dump", ignore_errors=True), runs=1, items=catalog_size, warmup=0
+    )
@@ -0,0 +1,7 @@
+from .test_books import ok
+
+def test_status_reads(client, bench):
+    ok(client.get("/api/v1/books/list?limit=50"))
+
+    bench.measure("status/pool", lambda: ok(client.get("/api/v1/status/pool")))
+    bench.measure("metrics", lambda: ok(client.get("/metrics")))
@@ -26,11 +26,72 @@ def db_session(postgresql):
 class Helpers:
     @staticmethod
     def get_client(session) -> TestClient:
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+        from sqlalchemy.pool import NullPool
         from ...backendManager import api
-        from ...database import get_db
+        from ...database import get_db, get_async_db, get_async_read_db
+        from ...metrics import instrument_engine
+        from ...versioning import response_cache
+        from ...category_index import get_category_index, current_category_index
+
+        # The test client runs each request on its own event loop, so
+        # async connections must not be pooled between requests
+        url = session.get_bind().url.set(drivername="postgresql+psycopg")
+        async_engine = create_async_engine(url, poolclass=NullPool)
+        instrument_engine(async_engine.sync_engine)
+        instrument_engine(session.get_bind())
+        localAsyncSession = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+        async def get_async_session():
+            async with localAsyncSession() as db:
+                yield db
+
         api.dependency_overrides[get_db] = lambda: session
+        api.dependency_overrides[get_async_db] = get_async_session
+        api.dependency_overrides[get_async_read_db] = get_async_session
+        # Rebuilt from the test database once invalidated
+        def get_test_category_index():
+            index = current_category_index()
+            return index if index is not None else Helpers.reload_categories(session)
+        api.dependency_overrides[get_category_index] = get_test_category_index
+        Helpers.reload_categories(session)
+        response_cache.clear()
         return TestClient(app=api)
+
+    @staticmethod
+    def reload_categories(session):
+        """Build the in memory category index from the test database"""
+        from sqlalchemy import select
+        from ...models import CategoriesTB, TableVersionsTB
+        from ...category_index import CategoryIndex, set_category_index
+        version = session.execute(select(TableVersionsTB.version).where(TableVersionsTB.name == "categories")).scalar()
+        index = CategoryIndex(session.execute(select(CategoriesTB.id, CategoriesTB.cat_id, CategoriesTB.cat_path)).all(), version or 0)
+        set_category_index(index)
+        return index
     
 @pytest.fixture
 def helpers():
-    return Helpers
\ No newline at end of file
+    return Helpers
+
+@pytest.fixture
+def manage(postgresql, tmp_path):
+    """Run manageDatabase.py against the test database, as deployments run it"""
+    from os import environ
+    from pathlib import Path
+    from subprocess import run
+    from sys import executable
+
+    script = Path(__file__).parents[2] / "manageDatabase.py"
+    env = {
+        **environ,
+        "DB_USER": postgresql.info.user,
+        "DB_PASS": postgresql.info.password or "",
+        "DB_PORT": str(postgresql.info.port),
+        "DB_NAME": postgresql.info.dbname,
+    }
+    def run_manage(*args, check: bool = True):
+        # Run outside backend so a developer .env is not picked up
+        return run(
+            [executable, script, "--host", postgresql.info.host, *[str(it) for it in args]],
+            cwd=tmp_path, env=env, check=check, capture_output=True, text=True
+        )
+    return run_manage
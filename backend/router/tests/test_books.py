@@ -1,8 +1,13 @@
 
 from uuid import uuid3, NAMESPACE_OID
 from json import dumps
+from base64 import b64encode
+from datetime import timedelta
+from email.utils import format_datetime, parsedate_to_datetime
+from sqlalchemy import text
 
-from ...models import BooksTB, CategoriesTB
+from ...models import BooksTB, CategoriesTB, CoversTB
+from ...covers import cover_hash
 
 def test_list_books_all(db_session, helpers):
     db_session.add_all([
@@ -28,7 +33,8 @@ def test_list_books_all(db_session, helpers):
             {"unique_id": str(id_list[0]), "title": "Book 1", "author": "Someone", "category": "Category / Sub Category", "cover_art": None, "isbn": None},
             {"unique_id": str(id_list[1]), "title": "Book 2", "author": "Someone", "category": "Category / Other Sub Category", "cover_art": None, "isbn": None},
             {"unique_id": str(id_list[2]), "title": "Other Book", "author": "Someone Else", "category": "Category / Other Sub Category", "cover_art": None, "isbn": None},
-        ]
+        ],
+        "next": None
     }
     
 def test_list_books_limit(db_session, helpers):
@@ -50,37 +56,63 @@ def test_list_books_limit(db_session, helpers):
     
     client = helpers.get_client(db_session)
     
-    # List all endpoint
+    # First page, ordered by category,author,title,id
     response = client.get("/api/v1/books/list?limit=2")
     assert response.status_code == 200
+    first_page = response.json()
+    assert first_page["result"] == [
+        {"unique_id": str(id_list[0]), "title": "Book 1", "author": "Someone", "category": "Category / Sub Category", "cover_art": None, "isbn": None},
+        {"unique_id": str(id_list[4]), "title": "Book 2", "author": "Someone", "category": "Category / Sub Category", "cover_art": None, "isbn": None},
+    ]
+    assert first_page["next"] is not None
+    
+    # Follow the cursor, ties on title are broken by id
+    tied = sorted([id_list[2], id_list[5]])
+    response = client.get(f"/api/v1/books/list?limit=2&after={first_page['next']}")
+    assert response.status_code == 200
+    second_page = response.json()
+    assert second_page["result"] == [
+        {"unique_id": str(id_list[1]), "title": "Book 2", "author": "Someone", "category": "Category / Other Sub Category", "cover_art": None, "isbn": None},
+        {"unique_id": str(tied[0]), "title": "Other Book", "author": "Someone Else", "category": "Category / Other Sub Category", "cover_art": None, "isbn": None},
+    ]
+    
+    # Last page has no cursor
+    response = client.get(f"/api/v1/books/list?limit=2&after={second_page['next']}")
+    assert response.status_code == 200
     assert response.json() == {
         "result": [
-            {"unique_id": str(id_list[0]), "title": "Book 1", "author": "Someone", "category": "Category / Sub Category", "cover_art": None, "isbn": None},
-            {"unique_id": str(id_list[1]), "title": "Book 2", "author": "Someone", "category": "Category / Other Sub Category", "cover_art": None, "isbn": None},
-        ]
+            {"unique_id": str(tied[1]), "title": "Other Book", "author": "Someone Else", "category": "Category / Other Sub Category", "cover_art": None, "isbn": None},
+            {"unique_id": str(id_list[3]), "title": "Other Book 1", "author": "Someone Else", "category": "Category / Other Sub Category", "cover_art": None, "isbn": None},
+        ],
+        "next": None
     }
     
-    # Test Offset
-    # response = client.get("/api/v1/books/list?limit=2&page=2")
-    # assert response.status_code == 200
-    # assert response.json() == {
-    #     "result": [
-    #         {"unique_id": str(id_list[4]), "title": "Book 2", "author": "Someone", "category": "Category / Sub Category", "cover_art": None, "isbn": None},
-    #         {"unique_id": str(id_list[5]), "title": "Other Book", "author": "Someone Else", "category": "Category / Other Sub Category", "cover_art": None, "isbn": None}
-    #     ]
-    # }
+    # Malformed cursor
+    response = client.get("/api/v1/books/list?limit=2&after=not-a-cursor")
+    assert response.status_code == 400
+
+    # Pages hold at least one book
+    for limit in [0, -1]:
+        assert client.get(f"/api/v1/books/list?limit={limit}").status_code == 422
+        assert client.get(f"/api/v1/books/list-by-category?limit={limit}").status_code == 422
 
 def test_list_books_with_cover(db_session, helpers):
     db_session.add_all([
         CategoriesTB(cat_id="CAT001000", cat_path="Category|Sub Category"),
         CategoriesTB(cat_id="CAT002000", cat_path="Category|Other Sub Category"),
     ])
+    covers = [b"\xff\xd8\xff\xe0 first cover", b"\xff\xd8\xff\xe0 second cover"]
+    cover_ids = [cover_hash(it) for it in covers]
+    db_session.add_all([
+        CoversTB(id=cover_id, content_type="image/jpeg", data=data)
+        for cover_id, data in zip(cover_ids, covers)
+    ])
     db_session.commit()
     id_list = [uuid3(NAMESPACE_OID, f"test {it}") for it in range(3)]
     db_session.add_all([
         BooksTB(title="Book 1", author="Someone", category="1", id=id_list[0]),
-        BooksTB(title="Book 2", author="Someone", category="2", id=id_list[1], cover_art="data:image/jpg;base64,/9j/4AAQSkZJRgABAQ"),
-        BooksTB(title="Other Book", author="Someone Else", category="2", id=id_list[2], cover_art="data:image/jpg;base64,/9j/4AAQSjZJqgABAQ"),
+        BooksTB(title="Book 2", author="Someone", category="2", id=id_list[1], cover_id=cover_ids[0]),
+        BooksTB(title="Other Book", author="Someone Else", category="2", id=id_list[2], cover_id=cover_ids[1]),
     ])
     db_session.commit()
     
@@ -92,11 +124,44 @@ def test_list_books_with_cover(db_session, helpers):
     assert response.json() == {
         "result": [
             {"cover_art": None, "unique_id": str(id_list[0]), "title": "Book 1", "author": "Someone", "category": "Category / Sub Category", "isbn": None},
-            {"cover_art": "data:image/jpg;base64,/9j/4AAQSkZJRgABAQ", "unique_id": str(id_list[1]), "title": "Book 2", "author": "Someone", "category": "Category / Other Sub Category", "isbn": None},
-            {"cover_art": "data:image/jpg;base64,/9j/4AAQSjZJqgABAQ", "unique_id": str(id_list[2]), "title": "Other Book", "author": "Someone Else", "category": "Category / Other Sub Category", "isbn": None},
-        ]
+            {"cover_art": f"/api/v1/books/{id_list[1]}/cover?v={cover_ids[0]}", "unique_id": str(id_list[1]), "title": "Book 2", "author": "Someone", "category": "Category / Other Sub Category", "isbn": None},
+            {"cover_art": f"/api/v1/books/{id_list[2]}/cover?v={cover_ids[1]}", "unique_id": str(id_list[2]), "title": "Other Book", "author": "Someone Else", "category": "Category / Other Sub Category", "isbn": None},
+        ],
+        "next": None
     }
     
+def test_get_cover(db_session, helpers):
+    cover = b"\x89PNG\r\n\x1a\n a cover"
+    db_session.add(CoversTB(id=cover_hash(cover), content_type="image/png", data=cover))
+    db_session.commit()
+    id_list = [uuid3(NAMESPACE_OID, f"test {it}") for it in range(3)]
+    db_session.add_all([
+        BooksTB(title="Book 1", author="Someone", id=id_list[0], cover_id=cover_hash(cover)),
+        BooksTB(title="Book 2", author="Someone", id=id_list[1], cover_id=cover_hash(cover)),
+        BooksTB(title="No Cover", author="Someone", id=id_list[2]),
+    ])
+    db_session.commit()
+    
+    client = helpers.get_client(db_session)
+    
+    # Shared cover served as binary with a content tag
+    for book_id in id_list[:2]:
+        response = client.get(f"/api/v1/books/{book_id}/cover")
+        assert response.status_code == 200
+        assert response.content == cover
+        assert response.headers["content-type"] == "image/png"
+        assert response.headers["etag"] == f'"{cover_hash(cover)}"'
+        assert "immutable" in response.headers["cache-control"]
+    
+    # Revalidation
+    response = client.get(f"/api/v1/books/{id_list[0]}/cover", headers={"If-None-Match": f'"{cover_hash(cover)}"'})
+    assert response.status_code == 304
+    assert response.content == b""
+    
+    # Book without cover
+    response = client.get(f"/api/v1/books/{id_list[2]}/cover")
+    assert response.status_code == 404
+
 def test_list_books_with_isbn(db_session, helpers):
     db_session.add_all([
         CategoriesTB(cat_id="CAT001000", cat_path="Category|Sub Category"),
@@ -121,7 +186,8 @@ def test_list_books_with_isbn(db_session, helpers):
             {"isbn": "9780534349417", "unique_id": str(id_list[1]), "title": "Book 2", "author": "Someone", "category": "Category / Other Sub Category", "cover_art": None},
             {"isbn": "9780534349517", "unique_id": str(id_list[2]), "title": "Other Book", "author": "Someone Else", "category": "Category / Other Sub Category", "cover_art": None},
             {"isbn": None, "unique_id": str(id_list[0]), "title": "Book 1", "author": "Someone", "category": None, "cover_art": None},
-        ]
+        ],
+        "next": None
     }
 
 def test_list_book_from_id(db_session, helpers):
@@ -156,8 +222,8 @@ def test_update_book(db_session, helpers):
     id_list = [uuid3(NAMESPACE_OID, f"test {it}") for it in range(3)]
     db_session.add_all([
         BooksTB(title="Book 1", author="Someone", id=id_list[0]),
-        BooksTB(title="Book 2", author="Someone", id=id_list[1]),
-        BooksTB(title="Other Book", author="Someone Else", id=id_list[2]),
+        BooksTB(title="Book 2", author="Someone", id=id_list[1], row_hash="0" * 64),
+        BooksTB(title="Other Book", author="Someone Else", id=id_list[2], row_hash="0" * 64),
     ])
     db_session.commit()
     
@@ -176,6 +242,12 @@ def test_update_book(db_session, helpers):
         "result": {"unique_id": str(id_list[1]), "title": "Book 2", "author": "Someone", "category": "Category / Other Sub Category", "cover_art": None, "isbn": None}
     }
 
+    # Edits through the api are no longer what the csv ingested
+    response = client.post("/api/v1/books/batch", json=[{"id": str(id_list[2]), "title": "Renamed", "author": "Someone Else"}])
+    assert response.status_code == 200
+    db_session.expire_all()
+    assert [db_session.get(BooksTB, it).row_hash for it in id_list] == [None, None, None]
+
 def test_list_books_by_category(db_session, helpers):
     db_session.add_all([
         CategoriesTB(cat_id="CAT001000", cat_path="Category|Sub Category"),
@@ -203,7 +275,8 @@ def test_list_books_by_category(db_session, helpers):
             {"unique_id": str(id_list[2]), "title": "Book 2", "author": "Someone", "category": "Category / Sub Category", "cover_art": None, "isbn": None},
             {"unique_id": str(id_list[0]), "title": "Other Book", "author": "New Someone", "category": "Category / Other Sub Category", "cover_art": None, "isbn": None},
             {"unique_id": str(id_list[1]), "title": "Book 1", "author": "Someone", "category": "Category / Other Sub Category", "cover_art": None, "isbn": None},
-        ]
+        ],
+        "next": None
     }
 
 def test_add_new_book(db_session, helpers):
@@ -218,7 +291,7 @@ def test_add_new_book(db_session, helpers):
     # Verify that books are empty
     response = client.get("/api/v1/books/list")
     assert response.status_code == 200
-    assert response.json() == {"result": []}
+    assert response.json() == {"result": [], "next": None}
     
     # Add new book
     newBook = {
@@ -244,3 +317,498 @@ def test_add_new_book(db_session, helpers):
     assert book_response["category"] == "Category / Other Sub Category"
     assert "unique_id" in book_response
     assert book_response["unique_id"] == post_response.json()["id"]
+
+def test_list_books_by_category_pages(db_session, helpers):
+    db_session.add_all([
+        CategoriesTB(cat_id="CAT001000", cat_path="Category|Sub Category"),
+        CategoriesTB(cat_id="CAT002000", cat_path="Category|Other Sub Category"),
+    ])
+    db_session.commit()
+    id_list = [uuid3(NAMESPACE_OID, f"test {it}") for it in range(5)]
+    db_session.add_all([
+        BooksTB(title="Other Book", author="New Someone", category="2", id=id_list[0]),
+        BooksTB(title="Book 1", author="Someone", category="2", id=id_list[1]),
+        BooksTB(title="Book 2", author="Someone", category="1", id=id_list[2]),
+        BooksTB(title="A Book 2", author="Someone", category="1", id=id_list[3]),
+        BooksTB(title="No Cat", author="Unknown", id=id_list[4])
+    ])
+    db_session.commit()
+    
+    client = helpers.get_client(db_session)
+    
+    # Walk every page one book at a time, uncategorized books come last in the full list
+    for endpoint, expected in [("list-by-category", [3, 2, 0, 1]), ("list", [3, 2, 0, 1, 4])]:
+        seen = []
+        after = ""
+        while after is not None:
+            response = client.get(f"/api/v1/books/{endpoint}?limit=1{after and '&after=' + after}")
+            assert response.status_code == 200
+            assert len(response.json()["result"]) <= 1
+            seen += [it["unique_id"] for it in response.json()["result"]]
+            after = response.json()["next"]
+        assert seen == [str(id_list[it]) for it in expected]
+
+def test_add_book_with_cover(db_session, helpers):
+    db_session.add(CategoriesTB(cat_id="CAT001000", cat_path="Category|Sub Category"))
+    db_session.commit()
+    
+    client = helpers.get_client(db_session)
+    
+    # New cover art is sent as a data url
+    cover = b"\xff\xd8\xff\xe0 new cover"
+    newBook = {
+        "title": "New Book Title",
+        "author": "Someone New",
+        "category": "CAT001000",
+        "cover_art": f"data:image/jpg;base64,{b64encode(cover).decode()}"
+    }
+    post_response = client.post("/api/v1/books/add", json=newBook)
+    assert post_response.status_code == 200, post_response.text
+    book_id = post_response.json()["id"]
+    cover_link = f"/api/v1/books/{book_id}/cover?v={cover_hash(cover)}"
+    assert post_response.json()["cover_art"] == cover_link
+    
+    # Listing links to the stored cover
+    get_response = client.get("/api/v1/books/list")
+    assert get_response.json()["result"][0]["cover_art"] == cover_link
+    response = client.get(cover_link)
+    assert response.status_code == 200
+    assert response.content == cover
+    assert response.headers["content-type"] == "image/jpeg"
+    
+    # Sending the link back keeps the cover
+    put_response = client.put("/api/v1/books", json={**newBook, "id": book_id, "title": "Renamed", "cover_art": cover_link})
+    assert put_response.status_code == 200, put_response.text
+    assert put_response.json()["cover_art"] == cover_link
+    assert client.get(cover_link).content == cover
+
+    # Links to covers that were never stored are rejected
+    unknown_link = f"/api/v1/books/{book_id}/cover?v={cover_hash(b'never stored')}"
+    put_response = client.put("/api/v1/books", json={**newBook, "id": book_id, "cover_art": unknown_link})
+    assert put_response.status_code == 422
+    post_response = client.post("/api/v1/books/add", json={**newBook, "cover_art": unknown_link})
+    assert post_response.status_code == 422
+    
+    # Anything else is rejected
+    response = client.post("/api/v1/books/add", json={**newBook, "cover_art": "not an image"})
+    assert response.status_code == 422
+
+def test_cover_thumbnails(db_session, helpers, tmp_path):
+    from io import BytesIO
+    from PIL import Image
+    from ..books import get_thumbnail_cache
+    from ...thumbnails import ThumbnailCache
+
+    image = BytesIO()
+    Image.new("RGB", (400, 600), "navy").save(image, "JPEG")
+    cover = image.getvalue()
+    db_session.add(CoversTB(id=cover_hash(cover), content_type="image/jpeg", data=cover))
+    db_session.commit()
+    book_id = uuid3(NAMESPACE_OID, "test 0")
+    db_session.add(BooksTB(title="Book 1", author="Someone", id=book_id, cover_id=cover_hash(cover)))
+    db_session.commit()
+    
+    client = helpers.get_client(db_session)
+    cache = ThumbnailCache(tmp_path, 2**20)
+    client.app.dependency_overrides[get_thumbnail_cache] = lambda: cache
+    
+    # Listing links to the requested size
+    response = client.get("/api/v1/books/list?size=160")
+    assert response.status_code == 200
+    thumbnail_link = f"/api/v1/books/{book_id}/cover?v={cover_hash(cover)}&size=160"
+    assert response.json()["result"][0]["cover_art"] == thumbnail_link
+    assert client.get(f"/api/v1/books?book_id={book_id}&size=160").json()["result"]["cover_art"] == thumbnail_link
+    
+    # Generated on first request and then served from the cache
+    response = client.get(thumbnail_link)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    assert Image.open(BytesIO(response.content)).size == (107, 160)
+    assert (cover_hash(cover), 160) in cache
+    assert client.get(thumbnail_link).content == response.content
+    
+    # Unsupported sizes
+    assert client.get(f"/api/v1/books/{book_id}/cover?size=100").status_code == 422
+    assert client.get("/api/v1/books/list?size=100").status_code == 422
+
+    # Covers Pillow cannot read are still served, just not resized
+    unreadable = b"\xff\xd8\xff\xe0 not really a jpeg"
+    db_session.add(CoversTB(id=cover_hash(unreadable), content_type="image/jpeg", data=unreadable))
+    db_session.commit()
+    other_id = uuid3(NAMESPACE_OID, "test 1")
+    db_session.add(BooksTB(title="Book 2", author="Someone", id=other_id, cover_id=cover_hash(unreadable)))
+    db_session.commit()
+    assert client.get(f"/api/v1/books/{other_id}/cover").content == unreadable
+    assert client.get(f"/api/v1/books/{other_id}/cover?size=160").status_code == 415
+    client.app.dependency_overrides.pop(get_thumbnail_cache)
+
+def test_thumbnail_cache_eviction(tmp_path):
+    from ...thumbnails import ThumbnailCache
+
+    cache = ThumbnailCache(tmp_path, 250)
+    cache.put("a", 64, b"a" * 100)
+    cache.put("b", 64, b"b" * 100)
+    assert cache.get("a", 64) == b"a" * 100
+    
+    # Least recently used entry goes first
+    cache.put("c", 64, b"c" * 100)
+    assert ("b", 64) not in cache
+    assert not (tmp_path / "b-64.webp").exists()
+    assert cache.get("a", 64) is not None and cache.get("c", 64) is not None
+    assert cache.total_bytes == 200
+    
+    # Index is rebuilt from disk
+    assert ("a", 64) in ThumbnailCache(tmp_path, 250)
+
+def test_thumbnail_cache_directory(tmp_path):
+    from pathlib import Path
+    from ...thumbnails import thumbnail_cache
+
+    # The same for the api and manageDatabase.py, whichever directory they run in
+    root = Path(__file__).resolve().parents[3]
+    assert thumbnail_cache({}).directory == root / "cover_cache"
+    assert thumbnail_cache({"COVER_CACHE_DIR": "cache/covers"}).directory == root / "cache" / "covers"
+    cache = thumbnail_cache({"COVER_CACHE_DIR": str(tmp_path), "COVER_CACHE_MAX_BYTES": "100"})
+    assert cache.directory == tmp_path and cache.max_bytes == 100
+
+def test_search_books(db_session, helpers):
+    db_session.add_all([
+        CategoriesTB(cat_id="FIC000000", cat_path="Fiction|General"),
+        CategoriesTB(cat_id="JUV037000", cat_path="Juvenile Fiction|Fantasy & Magic"),
+        CategoriesTB(cat_id="TEC028000", cat_path="Technology & Engineering|Nuclear"),
+    ])
+    db_session.commit()
+    id_list = [uuid3(NAMESPACE_OID, f"test {it}") for it in range(6)]
+    db_session.add_all([
+        BooksTB(title="Harry Potter and the Sorcerer's Stone", author="Rowling, J. K.", category="2", id=id_list[0]),
+        BooksTB(title="Harry Potter and the Chamber of Secrets", author="Rowling, J. K.", category="2", id=id_list[1]),
+        BooksTB(title="Nuclear Reactor Analysis", author="Duderstadt, James J.", category="3", id=id_list[2]),
+        BooksTB(title="Introduction to Nuclear Concepts for Engineers", author="Mayo, Robert M.", category="3", id=id_list[3]),
+        BooksTB(title="The Casual Vacancy", author="Rowling, J. K.", id=id_list[4]),
+        BooksTB(title="Analysis Methods in Nuclear Engineering", author="Someone", category="3", id=id_list[5]),
+    ])
+    db_session.commit()
+    
+    client = helpers.get_client(db_session)
+    
+    # Word fragments across title and author
+    response = client.get("/api/v1/books/search?query=harr%20rowl%20cham")
+    assert response.status_code == 200
+    assert response.json() == {
+        "result": [
+            {"unique_id": str(id_list[1]), "title": "Harry Potter and the Chamber of Secrets", "author": "Rowling, J. K.", "category": "Juvenile Fiction / Fantasy & Magic", "cover_art": None, "isbn": None},
+        ]
+    }
+    
+    # Author only, with limit
+    response = client.get("/api/v1/books/search?query=Rowling")
+    assert response.status_code == 200
+    assert {it["unique_id"] for it in response.json()["result"]} == {str(id_list[it]) for it in [0, 1, 4]}
+    response = client.get("/api/v1/books/search?query=Rowling&limit=2")
+    assert len(response.json()["result"]) == 2
+    for limit in [0, -1, 101]:
+        assert client.get(f"/api/v1/books/search?query=Rowling&limit={limit}").status_code == 422
+    
+    # Better matches come first, here the words closer together before the title order
+    response = client.get("/api/v1/books/search?query=nuclear%20reactor")
+    assert [it["unique_id"] for it in response.json()["result"]] == [str(id_list[2])]
+    response = client.get("/api/v1/books/search?query=nuclear%20analysis")
+    assert [it["unique_id"] for it in response.json()["result"]] == [str(id_list[2]), str(id_list[5])]
+    response = client.get("/api/v1/books/search?query=nuclear")
+    assert {it["unique_id"] for it in response.json()["result"]} == {str(id_list[it]) for it in [2, 3, 5]}
+    
+    # Category filter includes sub categories
+    response = client.get("/api/v1/books/search?query=rowling&category=JUV037000")
+    assert {it["unique_id"] for it in response.json()["result"]} == {str(id_list[0]), str(id_list[1])}
+    response = client.get("/api/v1/books/search?query=rowling&category=FIC000000&category=TEC028000")
+    assert response.json() == {"result": []}
+    
+    # Punctuation only
+    response = client.get("/api/v1/books/search?query=%27%22%26")
+    assert response.json() == {"result": []}
+
+def test_list_books_not_modified(db_session, helpers):
+    db_session.add(CategoriesTB(cat_id="CAT001000", cat_path="Category|Sub Category"))
+    db_session.commit()
+    id_list = [uuid3(NAMESPACE_OID, f"test {it}") for it in range(2)]
+    db_session.add(BooksTB(title="Book 1", author="Someone", category="1", id=id_list[0]))
+    db_session.commit()
+    
+    client = helpers.get_client(db_session)
+    
+    # Responses carry the version of the tables they were built from
+    response = client.get("/api/v1/books/list")
+    assert response.status_code == 200
+    etag, modified = response.headers["etag"], response.headers["last-modified"]
+    assert len(response.json()["result"]) == 1
+    
+    # Repeat requests are served from the response cache
+    cached = client.get("/api/v1/books/list")
+    assert cached.content == response.content
+    assert cached.headers["etag"] == etag
+    
+    # Clients holding the current version get no body
+    response = client.get("/api/v1/books/list", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    # Tags are matched as a list, weakly, and "*" matches any version
+    for header in [f'"other", W/{etag}', "*", f'"a,b", {etag}']:
+        assert client.get("/api/v1/books/list", headers={"If-None-Match": header}).status_code == 304
+    for header in [f'"x{etag[1:]}', etag[:-1] + '0"', '"other"', ""]:
+        assert client.get("/api/v1/books/list", headers={"If-None-Match": header}).status_code == 200
+    # Dates only count once a whole second has passed since the change
+    response = client.get(f"/api/v1/books/?book_id={id_list[0]}", headers={"If-Modified-Since": modified})
+    assert response.status_code == 200
+    later = format_datetime(parsedate_to_datetime(modified) + timedelta(seconds=1), usegmt=True)
+    response = client.get(f"/api/v1/books/?book_id={id_list[0]}", headers={"If-Modified-Since": later})
+    assert response.status_code == 304
+    
+    # Any change to books gives a new version
+    response = client.post("/api/v1/books/add", json={"id": str(id_list[1]), "title": "Book 2", "author": "Someone", "category": "CAT001000"})
+    assert response.status_code == 200
+    response = client.get("/api/v1/books/list", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert len(response.json()["result"]) == 2
+
+    # Versions follow commit order, not the order transactions started in
+    version_query = text("SELECT version FROM table_versions WHERE name = 'books'")
+    with db_session.get_bind().connect() as older, db_session.get_bind().connect() as newer:
+        older.execute(text("SELECT txid_current()"))
+        newer.execute(text("UPDATE books SET title = title"))
+        newer.commit()
+        committed = newer.execute(version_query).scalar()
+        older.execute(text("UPDATE books SET title = title"))
+        older.commit()
+        assert older.execute(version_query).scalar() > committed
+
+def test_books_batch(db_session, helpers):
+    db_session.add(CategoriesTB(cat_id="CAT001000", cat_path="Category|Sub Category"))
+    db_session.commit()
+    id_list = [uuid3(NAMESPACE_OID, f"test {it}") for it in range(3)]
+    db_session.add(BooksTB(title="Book 1", author="Someone", category="1", id=id_list[0]))
+    db_session.commit()
+    
+    client = helpers.get_client(db_session)
+    
+    # Creates and updates in one request, failures reported per item
+    cover = b"\xff\xd8\xff\xe0 batch cover"
+    response = client.post("/api/v1/books/batch", json=[
+        {"id": str(id_list[0]), "title": "Book 1, Revised", "author": "Someone", "category": "CAT001000"},
+        {"id": str(id_list[1]), "title": "Book 2", "author": "Someone", "cover_art": f"data:image/jpg;base64,{b64encode(cover).decode()}"},
+        {"id": str(id_list[2]), "title": "Book 3", "author": "Someone", "category": "ZZZ000000"},
+        {"title": "No Author"},
+        {"id": str(id_list[1]), "title": "Book 2 again", "author": "Someone"},
+    ])
+    assert response.status_code == 200, response.text
+    result = response.json()["result"]
+    assert [it["status"] for it in result] == ["updated", "created", "error", "error", "error"]
+    assert [it["id"] for it in result] == [str(id_list[it]) for it in [0, 1, 2]] + [None, str(id_list[1])]
+    assert all(set(it) == {"id", "status", "result", "error"} for it in result)
+    assert result[0]["error"] is None and result[2]["result"] is None
+    assert result[0]["result"]["title"] == "Book 1, Revised"
+    assert result[1]["result"]["cover_art"] == f"/api/v1/books/{id_list[1]}/cover?v={cover_hash(cover)}"
+    assert result[2]["error"] == "unknown category ZZZ000000"
+    assert result[3]["error"].startswith("author:")
+    assert result[4]["error"] == "duplicate id"
+    
+    # Reads keep the order of the ids
+    response = client.get(f"/api/v1/books/batch?ids={id_list[1]}&ids={id_list[2]}&ids=bad&ids={id_list[0]}")
+    assert response.status_code == 200
+    assert response.json() == {
+        "result": [
+            {"id": str(id_list[1]), "status": "found", "error": None, "result": {"unique_id": str(id_list[1]), "title": "Book 2", "author": "Someone", "category": None, "cover_art": f"/api/v1/books/{id_list[1]}/cover?v={cover_hash(cover)}", "isbn": None}},
+            {"id": str(id_list[2]), "status": "error", "error": "not found", "result": None},
+            {"id": "bad", "status": "error", "error": "invalid id", "result": None},
+            {"id": str(id_list[0]), "status": "found", "error": None, "result": {"unique_id": str(id_list[0]), "title": "Book 1, Revised", "author": "Someone", "category": "Category / Sub Category", "cover_art": None, "isbn": None}},
+        ]
+    }
+
+    # The same ids in another order are not answered from the cache of the first
+    for ids in [[0, 1], [1, 0], [0, 1]]:
+        response = client.get("/api/v1/books/batch?" + "&".join(f"ids={id_list[it]}" for it in ids))
+        assert [it["id"] for it in response.json()["result"]] == [str(id_list[it]) for it in ids]
+
+def test_add_book_category(db_session, helpers):
+    client = helpers.get_client(db_session)
+    
+    # Books without a category
+    response = client.post("/api/v1/books/add", json={"title": "Loose Book", "author": "Someone"})
+    assert response.status_code == 200, response.text
+    assert response.json()["category"] is None
+    
+    # Unknown categories are refused
+    response = client.post("/api/v1/books/add", json={"title": "Lost Book", "author": "Someone", "category": "CAT009000"})
+    assert response.status_code == 422
+    
+    # Categories added after the index was built are still found
+    db_session.add(CategoriesTB(cat_id="CAT009000", cat_path="Category|Late"))
+    db_session.commit()
+    response = client.post("/api/v1/books/add", json={"title": "Found Book", "author": "Someone", "category": "CAT009000"})
+    assert response.status_code == 200, response.text
+    response = client.get("/api/v1/books/list-by-category")
+    assert [it["category"] for it in response.json()["result"]] == ["Category / Late"]
+
+def test_list_books_stale_category_index(db_session, helpers):
+    from ...category_index import current_category_index
+
+    db_session.add(CategoriesTB(cat_id="CAT001000", cat_path="Category|Sub Category"))
+    db_session.commit()
+    db_session.add(BooksTB(title="Book 1", author="Someone", category="1", id=uuid3(NAMESPACE_OID, "test 0")))
+    db_session.commit()
+    client = helpers.get_client(db_session)
+    assert client.get("/api/v1/books/list").json()["result"][0]["category"] == "Category / Sub Category"
+    index = current_category_index()
+
+    # Changed by another process before the index is rebuilt
+    db_session.add(CategoriesTB(cat_id="CAT002000", cat_path="Category|New"))
+    db_session.commit()
+    db_session.add(BooksTB(title="Book 2", author="Someone", category="2", id=uuid3(NAMESPACE_OID, "test 1")))
+    db_session.execute(text("UPDATE categories SET cat_path = 'Category|Renamed' WHERE cat_id = 'CAT001000'"))
+    db_session.commit()
+
+    # Names come from the database until the index catches up, and are cached that way
+    for _ in range(2):
+        response = client.get("/api/v1/books/list")
+        assert [it["category"] for it in response.json()["result"]] == ["Category / Renamed", "Category / New"]
+    assert current_category_index() is not index
+    book = client.get(f"/api/v1/books/?book_id={uuid3(NAMESPACE_OID, 'test 1')}").json()["result"]
+    assert book["category"] == "Category / New"
+
+def test_book_fields(db_session, helpers):
+    db_session.add(CategoriesTB(cat_id="CAT001000", cat_path="Category|Sub Category"))
+    db_session.add(CoversTB(id=cover_hash(b"cover"), content_type="image/jpeg", data=b"cover"))
+    db_session.commit()
+    id_list = [uuid3(NAMESPACE_OID, f"test {it}") for it in range(3)]
+    db_session.add_all([
+        BooksTB(title="Book 1", author="Someone", category="1", id=id_list[0], cover_id=cover_hash(b"cover")),
+        BooksTB(title="Book 2", author="Someone", category="1", id=id_list[1]),
+        BooksTB(title="Book 3", author="Someone", id=id_list[2]),
+    ])
+    db_session.commit()
+    
+    client = helpers.get_client(db_session)
+    
+    # Only the requested fields are returned, and paging still works
+    response = client.get("/api/v1/books/list?fields=title&limit=2")
+    assert response.status_code == 200
+    assert response.json()["result"] == [{"title": "Book 1"}, {"title": "Book 2"}]
+    response = client.get(f"/api/v1/books/list?fields=title&limit=2&after={response.json()['next']}")
+    assert response.json() == {"result": [{"title": "Book 3"}], "next": None}
+    
+    response = client.get("/api/v1/books/list-by-category?fields=author,category")
+    assert response.json()["result"] == [{"author": "Someone", "category": "Category / Sub Category"}] * 2
+    
+    # Cover links do not need the id to be requested
+    response = client.get(f"/api/v1/books/?book_id={id_list[0]}&fields=cover_art")
+    assert response.json() == {"result": {"cover_art": f"/api/v1/books/{id_list[0]}/cover?v={cover_hash(b'cover')}"}}
+    
+    # Unknown fields are refused
+    assert client.get("/api/v1/books/list?fields=title,data").status_code == 422
+    assert client.get("/api/v1/books/list?fields=").status_code == 422
+
+def test_read_replicas(db_session, helpers, monkeypatch):
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    from sqlalchemy.pool import NullPool
+    from ... import database
+    from ...database import ReplicaSet, get_async_read_db
+
+    client = helpers.get_client(db_session)
+    client.app.dependency_overrides.pop(get_async_read_db)
+
+    # The test database stands in for the primary and a replica, next to a replica that is down
+    url = db_session.get_bind().url.set(drivername="postgresql+psycopg")
+    engines = {
+        "down": create_async_engine(url.set(port=1), poolclass=NullPool),
+        "replica": create_async_engine(url, poolclass=NullPool),
+        "primary": create_async_engine(url, poolclass=NullPool),
+    }
+    used = []
+    def sessionmaker(name):
+        sessions = async_sessionmaker(engines[name], autoflush=False, expire_on_commit=False)
+        return lambda: used.append(name) or sessions()
+
+    replicas = ReplicaSet([("down", None), ("replica", None)], 60)
+    monkeypatch.setattr(database, "replicas", replicas)
+    monkeypatch.setattr(database, "get_replica_engines", lambda: [engines["down"], engines["replica"]])
+    monkeypatch.setattr(database, "get_replica_sessionmakers", lambda: [sessionmaker("down"), sessionmaker("replica")])
+    monkeypatch.setattr(database, "get_async_engine", lambda: engines["primary"])
+    monkeypatch.setattr(database, "get_async_sessionmaker", lambda: sessionmaker("primary"))
+
+    # Reads skip the replica that is down, and keep skipping it
+    assert client.get("/api/v1/books/list").status_code == 200
+    assert client.get("/api/v1/books/list").status_code == 200
+    assert used == ["down", "replica", "replica"]
+    assert replicas.status() == [{"host": "down", "healthy": False, "reads": 0}, {"host": "replica", "healthy": True, "reads": 2}]
+
+    # After writing, the client reads from the primary for a while
+    used.clear()
+    response = client.post("/api/v1/books/add", json={"title": "New Book", "author": "Someone"})
+    assert response.status_code == 200
+    assert database.PRIMARY_COOKIE in response.cookies
+    response = client.get(f"/api/v1/books/?book_id={response.json()['id']}")
+    assert response.json()["result"]["title"] == "New Book"
+    assert used == ["primary"]
+
+    # And when every replica is down
+    used.clear()
+    client.cookies.clear()
+    replicas.mark_down(1, "test")
+    assert client.get("/api/v1/books/list").status_code == 200
+    assert used == ["primary"]
+    assert replicas.primary_reads == 2
+
+def test_list_books_compressed(db_session, helpers, monkeypatch):
+    from ... import versioning
+    from ...compression import encoded_etag, negotiate
+
+    db_session.add(CategoriesTB(cat_id="CAT001000", cat_path="Category|Sub Category"))
+    db_session.commit()
+    db_session.add_all([
+        BooksTB(title=f"A Rather Long Book Title {it}", author="Someone", category="1", id=uuid3(NAMESPACE_OID, f"test {it}"))
+        for it in range(20)
+    ])
+    db_session.commit()
+    client = helpers.get_client(db_session)
+
+    compressed = []
+    def counting_compress(body, encoding):
+        compressed.append(encoding)
+        return compress(body, encoding)
+    compress = versioning.compress
+    monkeypatch.setattr(versioning, "compress", counting_compress)
+
+    plain = client.get("/api/v1/books/list", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    assert "Accept-Encoding" in plain.headers["vary"]
+
+    # Compressed once per data version and encoding, then served from the cache
+    for _ in range(2):
+        response = client.get("/api/v1/books/list", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        assert int(response.headers["content-length"]) < len(plain.content)
+        assert response.json() == plain.json()
+        assert response.headers["etag"] == plain.headers["etag"][:-1] + '-gzip"'
+    assert compressed == ["gzip"]
+
+    # The plain body is not a copy of the compressed one
+    response = client.get("/api/v1/books/list", headers={"Accept-Encoding": "gzip", "If-None-Match": plain.headers["etag"]})
+    assert response.status_code == 200
+    response = client.get("/api/v1/books/list", headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
+    assert response.headers["etag"].endswith('-gzip"')
+
+    # Small responses are not worth compressing
+    response = client.get(f"/api/v1/books/?book_id={uuid3(NAMESPACE_OID, 'test 0')}", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+
+    assert negotiate("gzip;q=0.5, identity") is None
+    assert negotiate("identity;q=0.5, gzip") == "gzip"
+    assert negotiate("identity, gzip") == "gzip"
+    assert negotiate("gzip;q=0.5, *;q=0.8, zstd;q=0, br;q=0") is None
+    assert negotiate("gzip;q=0.5") == "gzip"
+    assert negotiate("gzip;q=0, *;q=0") is None
+    assert negotiate("deflate") is None
+    assert negotiate("") is None
+    assert encoded_etag(b'"abc"', "br") == b'"abc-br"'
+    assert encoded_etag(b'W/"abc"', "br") == b'W/"abc"'
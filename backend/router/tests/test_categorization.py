@@ -79,3 +79,86 @@ def test_search_multi_word(db_session, helpers):
         ]
     }
     
+
+def test_search_special_characters(db_session, helpers):
+    db_session.add_all([
+        CategoriesTB(cat_id="OCC028000", cat_path="Body, Mind & Spirit|Magick Studies"),
+        CategoriesTB(cat_id="COM051010", cat_path="Computers|Languages|C++"),
+        CategoriesTB(cat_id="COM051000", cat_path="Computers|Languages|Cobol"),
+    ])
+    db_session.commit()
+    
+    client = helpers.get_client(db_session)
+    
+    # Punctuation is matched literally
+    response = client.get("/api/v1/categories/search?query=c%2B%2B")
+    assert response.status_code == 200
+    assert response.json() == {"result": [{"id": "COM051010", "name": "Computers / Languages / C++"}]}
+    
+    response = client.get("/api/v1/categories/search?query=body,")
+    assert response.status_code == 200
+    assert response.json() == {"result": [{"id": "OCC028000", "name": "Body, Mind & Spirit / Magick Studies"}]}
+    
+    response = client.get("/api/v1/categories/search?query=(")
+    assert response.status_code == 200
+    assert response.json() == {"result": []}
+    
+    # Nothing to search for
+    response = client.get("/api/v1/categories/search?query=%20%26%20")
+    assert response.status_code == 200
+    assert response.json() == {"result": []}
+
+def test_browse_children(db_session, helpers):
+    db_session.add_all([
+        CategoriesTB(cat_id="FIC000000", cat_path="Fiction|General"),
+        CategoriesTB(cat_id="FIC027000", cat_path="Fiction|Romance|General"),
+        CategoriesTB(cat_id="FIC027150", cat_path="Fiction|Romance|History|Medieval"),
+        CategoriesTB(cat_id="FIC027170", cat_path="Fiction|Romance|History|Victorian"),
+        CategoriesTB(cat_id="HIS002020", cat_path="History|Ancient|Rome"),
+        CategoriesTB(cat_id="HIS002000", cat_path="History|Ancient"),
+    ])
+    db_session.commit()
+    
+    client = helpers.get_client(db_session)
+    
+    # Top level has no codes of its own
+    response = client.get("/api/v1/categories/children")
+    assert response.status_code == 200
+    assert response.json() == {
+        "result": [
+            {"id": None, "name": "Fiction", "has_children": True},
+            {"id": None, "name": "History", "has_children": True},
+        ]
+    }
+    
+    # Browse by name
+    response = client.get("/api/v1/categories/children?path=Fiction / Romance")
+    assert response.status_code == 200
+    assert response.json() == {
+        "result": [
+            {"id": "FIC027000", "name": "Fiction / Romance / General", "has_children": False},
+            {"id": None, "name": "Fiction / Romance / History", "has_children": True},
+        ]
+    }
+    
+    # Browse by code
+    response = client.get("/api/v1/categories/HIS002000/children")
+    assert response.status_code == 200
+    assert response.json() == {"result": [{"id": "HIS002020", "name": "History / Ancient / Rome", "has_children": False}]}
+    
+    response = client.get("/api/v1/categories/HIS002020/children")
+    assert response.status_code == 200
+    assert response.json() == {"result": []}
+    
+    # Unknown categories
+    assert client.get("/api/v1/categories/XXX000000/children").status_code == 404
+    assert client.get("/api/v1/categories/children?path=Nothing").status_code == 404
+    
+    # Nothing is read from the database once the index is built
+    db_session.add(CategoriesTB(cat_id="HIS002010", cat_path="History|Ancient|Egypt"))
+    db_session.commit()
+    response = client.get("/api/v1/categories/HIS002000/children")
+    assert len(response.json()["result"]) == 1
+    helpers.reload_categories(db_session)
+    response = client.get("/api/v1/categories/HIS002000/children")
+    assert [it["id"] for it in response.json()["result"]] == ["HIS002010", "HIS002020"]
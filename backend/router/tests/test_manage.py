@@ -0,0 +1,214 @@
+from csv import DictReader, DictWriter
+from json import loads
+from uuid import uuid3, NAMESPACE_OID
+
+from sqlalchemy import select, text
+
+from ...covers import cover_hash
+from ...models import BooksTB, CategoriesTB
+
+BOOK_FIELDS = ["id", "title", "author", "isbn", "category", "cover_art"]
+
+def write_csv(path, field_names, rows):
+    with open(path, "w", newline="") as ofile:
+        writer = DictWriter(ofile, fieldnames=field_names)
+        writer.writeheader()
+        writer.writerows(rows)
+    return path
+
+def read_csv(path) -> list:
+    with open(path, newline="") as infile:
+        return list(DictReader(infile))
+
+def book_row(idx: int, **values) -> dict:
+    return {"id": str(uuid3(NAMESPACE_OID, f"test {idx}")), "title": f"Book {idx}", "author": "Someone", **values}
+
+def test_ingest_categories_rejected(db_session, manage, tmp_path):
+    source = write_csv(tmp_path / "categories.csv", ["cat_id", "cat_path"], [
+        {"cat_id": "CAT001000", "cat_path": "Category / Sub Category"},
+        {"cat_id": "BAD", "cat_path": "Category / Bad"},
+        {"cat_id": "CAT002000", "cat_path": ""},
+        {"cat_id": "CAT001000", "cat_path": "Category / Again"},
+        {"cat_id": "CAT003000", "cat_path": "Category / Sub Category"},
+        {"cat_id": "CAT004000", "cat_path": "Category / Other"},
+    ])
+    manage("ingest", source, "--type", "categories")
+    assert db_session.execute(select(CategoriesTB.cat_id, CategoriesTB.cat_path).order_by(CategoriesTB.cat_id)).all() == [
+        ("CAT001000", "Category|Sub Category"),
+        ("CAT004000", "Category|Other"),
+    ]
+    assert read_csv(tmp_path / "categories.rejected.csv") == [
+        {"cat_id": "BAD", "cat_path": "Category / Bad", "error": "malformed cat_id"},
+        {"cat_id": "CAT002000", "cat_path": "", "error": "missing cat_path"},
+        {"cat_id": "CAT001000", "cat_path": "Category / Again", "error": "duplicate cat_id"},
+        {"cat_id": "CAT003000", "cat_path": "Category / Sub Category", "error": "duplicate cat_path"},
+    ]
+
+    # Loaded again, existing ids and paths conflict with what is stored
+    source = write_csv(tmp_path / "categories.csv", ["cat_id", "cat_path"], [
+        {"cat_id": "CAT001000", "cat_path": "Category / Renamed"},
+        {"cat_id": "CAT005000", "cat_path": "Category / Other"},
+        {"cat_id": "CAT006000", "cat_path": "Category / New"},
+    ])
+    manage("ingest", source, "--type", "categories")
+    assert read_csv(tmp_path / "categories.rejected.csv") == [
+        {"cat_id": "CAT001000", "cat_path": "Category / Renamed", "error": "cat_id already exists"},
+        {"cat_id": "CAT005000", "cat_path": "Category / Other", "error": "cat_path belongs to CAT004000"},
+    ]
+    db_session.expire_all()
+    paths = dict(db_session.execute(select(CategoriesTB.cat_id, CategoriesTB.cat_path)).all())
+    assert paths == {"CAT001000": "Category|Sub Category", "CAT004000": "Category|Other", "CAT006000": "Category|New"}
+
+def test_ingest_books_rejected(db_session, manage, tmp_path):
+    db_session.add(CategoriesTB(cat_id="CAT001000", cat_path="Category|Sub Category"))
+    db_session.commit()
+    db_session.add(BooksTB(title="Stored Book", author="Someone", id=uuid3(NAMESPACE_OID, "test 0")))
+    db_session.commit()
+
+    source = write_csv(tmp_path / "books.csv", BOOK_FIELDS, [
+        book_row(0),
+        book_row(1, category="CAT001000"),
+        book_row(2, id="not-a-uuid"),
+        book_row(3, title=""),
+        book_row(4, category="ZZZ000000"),
+        book_row(1, title="Book 1 again"),
+        book_row(5, cover_art="missing.jpg"),
+    ])
+    result = manage("ingest", source, "--type", "books", "--batch-size", "3")
+    assert "7 rows read, 1 books added, 0 updated, 6 rejected" in result.stdout
+    rejected = read_csv(tmp_path / "books.rejected.csv")
+    # Rows failing validation come before those refused by the database within a batch
+    assert [(it["title"], it["error"]) for it in rejected] == [
+        ("Book 2", "invalid id not-a-uuid"),
+        ("Book 0", "duplicate id"),
+        ("", "missing title"),
+        ("Book 4", "unknown category ZZZ000000"),
+        ("Book 1 again", "duplicate id"),
+        ("Book 5", "unreadable cover: No such file or directory"),
+    ]
+    assert set(rejected[0]) == set(BOOK_FIELDS) | {"error"}
+    db_session.expire_all()
+    assert db_session.execute(select(BooksTB.title).order_by(BooksTB.title)).scalars().all() == ["Book 1", "Stored Book"]
+
+def test_ingest_books_resume(db_session, manage, tmp_path):
+    rows = [book_row(it) for it in range(6)]
+    rows[1]["author"] = ""
+    # Text with NUL cannot be stored, failing the third batch
+    rows[4]["title"] = "Broken\x00Title"
+    source = write_csv(tmp_path / "books.csv", BOOK_FIELDS, rows)
+    result = manage("ingest", source, "--type", "books", "--batch-size", "2", check=False)
+    assert result.returncode != 0
+    assert db_session.execute(text("SELECT rows_done FROM ingest_checkpoints")).scalar() == 4
+    assert db_session.execute(select(BooksTB.title).order_by(BooksTB.title)).scalars().all() == ["Book 0", "Book 2", "Book 3"]
+
+    # Fixed and resumed, the committed batches are not loaded again
+    rows[4]["title"] = "Book 4"
+    write_csv(source, BOOK_FIELDS, rows)
+    result = manage("ingest", source, "--type", "books", "--batch-size", "2", "--resume")
+    assert "6 rows read, 2 books added, 0 updated, 0 rejected" in result.stdout
+    assert [(it["title"], it["error"]) for it in read_csv(tmp_path / "books.rejected.csv")] == [("Book 1", "missing author")]
+    db_session.expire_all()
+    assert db_session.execute(select(BooksTB.title).order_by(BooksTB.title)).scalars().all() == ["Book 0", "Book 2", "Book 3", "Book 4", "Book 5"]
+    assert db_session.execute(text("SELECT count(*) FROM ingest_checkpoints")).scalar() == 0
+
+def test_ingest_books_upsert(db_session, manage, tmp_path):
+    db_session.add(CategoriesTB(cat_id="CAT001000", cat_path="Category|Sub Category"))
+    db_session.commit()
+    (tmp_path / "cover.jpg").write_bytes(b"\xff\xd8\xff\xe0 upsert cover")
+    rows = [book_row(0, category="CAT001000", cover_art="cover.jpg"), book_row(1, isbn="9780000000001")]
+    source = write_csv(tmp_path / "books.csv", BOOK_FIELDS, rows)
+    result = manage("ingest", source, "--type", "books", "--mode", "upsert")
+    assert "2 rows read, 2 books added, 0 updated, 0 rejected" in result.stdout
+    hashes = dict(db_session.execute(select(BooksTB.title, BooksTB.row_hash)).all())
+
+    # Nothing changed, and covers listed in the manifest are not read again
+    assert "cover.jpg" in loads((tmp_path / "books.covers.json").read_text())
+    (tmp_path / "cover.jpg").chmod(0)
+    result = manage("ingest", source, "--type", "books", "--mode", "upsert")
+    assert "2 rows read, 0 books added, 0 updated, 0 rejected" in result.stdout
+    (tmp_path / "cover.jpg").chmod(0o644)
+
+    rows[1]["title"] = "Book 1, Revised"
+    write_csv(source, BOOK_FIELDS, rows)
+    result = manage("ingest", source, "--type", "books", "--mode", "upsert")
+    assert "2 rows read, 0 books added, 1 updated, 0 rejected" in result.stdout
+    db_session.expire_all()
+    changed = dict(db_session.execute(select(BooksTB.title, BooksTB.row_hash)).all())
+    assert changed["Book 0"] == hashes["Book 0"]
+    assert changed["Book 1, Revised"] != hashes["Book 1"]
+
+def test_covers_manifest_after_dump(db_session, manage, tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    write_csv(source / "categories.csv", ["cat_id", "cat_path"], [{"cat_id": "CAT001000", "cat_path": "Category / Sub Category"}])
+    cover = b"\xff\xd8\xff\xe0 manifest cover"
+    (source / "cover.jpg").write_bytes(cover)
+    write_csv(source / "books.csv", BOOK_FIELDS, [book_row(0, category="CAT001000", cover_art="cover.jpg"), book_row(1)])
+    manage("ingest", source / "categories.csv", "--type", "categories")
+    manage("ingest", source / "books.csv", "--type", "books")
+
+    # The dump loads back unchanged, its covers known by their new names after that
+    manage("dump", tmp_path / "dump")
+    dump = tmp_path / "dump"
+    for _ in range(2):
+        result = manage("ingest", dump / "categories.csv", "--type", "categories", "--mode", "upsert")
+        assert "0 categories added or changed, 0 rejected" in result.stdout
+        result = manage("ingest", dump / "books.csv", "--type", "books", "--mode", "upsert")
+        assert "2 rows read, 0 books added, 0 updated, 0 rejected" in result.stdout
+        manifest = loads((dump / "books.covers.json").read_text())
+        assert list(manifest) == [f"{cover_hash(cover)}.jpg"]
+        for it in dump.glob("*.jpg"):
+            it.chmod(0)
+
+def test_dump_and_ingest(db_session, manage, tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    jpeg, png = b"\xff\xd8\xff\xe0 shared cover", b"\x89PNG\r\n\x1a\n other cover"
+    (source / "a.jpg").write_bytes(jpeg)
+    (source / "b.jpg").write_bytes(jpeg)
+    (source / "c.png").write_bytes(png)
+    write_csv(source / "categories.csv", ["cat_id", "cat_path"], [{"cat_id": "CAT001000", "cat_path": "Category / Sub Category"}])
+    write_csv(source / "books.csv", BOOK_FIELDS, [
+        book_row(0, category="CAT001000", cover_art="a.jpg", isbn="9780000000001"),
+        book_row(1, cover_art="b.jpg"),
+        book_row(2, category="CAT001000", cover_art="c.png"),
+        book_row(3),
+    ])
+    manage("ingest", source / "categories.csv", "--type", "categories")
+    manage("ingest", source / "books.csv", "--type", "books")
+    book_query = (
+        select(BooksTB.id, BooksTB.title, BooksTB.author, BooksTB.isbn, BooksTB.cover_id, CategoriesTB.cat_path)
+        .join(CategoriesTB, BooksTB.category == CategoriesTB.id, isouter=True)
+        .order_by(BooksTB.title)
+    )
+    books = db_session.execute(book_query).all()
+
+    # One file per distinct cover, named by the sha256 of its bytes
+    dump = tmp_path / "dump"
+    manage("dump", dump)
+    assert sorted(it.name for it in dump.iterdir()) == sorted([
+        "books.csv", "categories.csv", f"{cover_hash(jpeg)}.jpg", f"{cover_hash(png)}.png"
+    ])
+    assert (dump / f"{cover_hash(jpeg)}.jpg").read_bytes() == jpeg
+    assert [it["cover_art"] for it in sorted(read_csv(dump / "books.csv"), key=lambda it: it["title"])] == [
+        f"{cover_hash(jpeg)}.jpg", f"{cover_hash(jpeg)}.jpg", f"{cover_hash(png)}.png", ""
+    ]
+
+    # Loaded into an empty database it gives the same books back
+    db_session.execute(text("TRUNCATE books, covers, categories"))
+    db_session.commit()
+    result = manage("ingest", dump / "categories.csv", "--type", "categories")
+    assert "1 categories added or changed, 0 rejected" in result.stdout
+    result = manage("ingest", dump / "books.csv", "--type", "books")
+    assert "4 rows read, 4 books added, 0 updated, 0 rejected" in result.stdout
+    assert db_session.execute(book_query).all() == books
+    assert db_session.execute(text("SELECT count(*) FROM covers")).scalar() == 2
+
+def test_manage_rejects_bad_counts(db_session, manage, tmp_path):
+    source = write_csv(tmp_path / "books.csv", BOOK_FIELDS, [book_row(0)])
+    for option in ["--workers", "--batch-size"]:
+        for value in ["0", "-2"]:
+            result = manage("ingest", source, "--type", "books", option, value, check=False)
+            assert result.returncode == 2
+            assert "must be at least 1" in result.stderr
+    assert db_session.execute(select(BooksTB.id)).all() == []
@@ -0,0 +1,51 @@
+from uuid import uuid4
+from logging import WARNING
+
+from ... import metrics
+from ...metrics import request_metrics
+from ...models import BooksTB, CategoriesTB
+
+def test_metrics(db_session, helpers):
+    db_session.add(CategoriesTB(cat_id="CAT001000", cat_path="Category|Sub Category"))
+    db_session.commit()
+    db_session.add(BooksTB(title="Book 1", author="Someone", category="1", id=uuid4()))
+    db_session.commit()
+
+    client = helpers.get_client(db_session)
+    request_metrics.reset()
+    assert client.get("/api/v1/books/list").status_code == 200
+    assert client.get("/api/v1/books/list?fields=nope").status_code == 422
+    assert client.get("/no/such/path").status_code == 404
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert 'http_requests_total{method="GET",route="/api/v1/books/list",status="200"} 1' in lines
+    assert 'http_requests_total{method="GET",route="/api/v1/books/list",status="422"} 1' in lines
+    assert 'http_requests_total{method="GET",route="unmatched",status="404"} 1' in lines
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/v1/books/list"} 2' in lines
+    # The listing reads the table versions and the page of books
+    assert 'db_queries_per_request_bucket{method="GET",route="/api/v1/books/list",le="0"} 1' in lines
+    assert 'db_queries_per_request_sum{method="GET",route="/api/v1/books/list"} 2.0' in lines
+    assert any(it.startswith('db_statement_duration_seconds_count{statement="select"}') for it in lines)
+    assert any(it.startswith("db_pool_checkouts ") for it in lines)
+
+    # Large responses are compressed on the way out
+    response = client.get("/metrics", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert "http_requests_total" in response.text
+
+def test_slow_query_log(db_session, helpers, monkeypatch, caplog):
+    client = helpers.get_client(db_session)
+    monkeypatch.setattr(metrics, "slow_query_seconds", 1e-9)
+    monkeypatch.setattr(metrics, "slow_query_explain", True)
+    request_metrics.reset()
+
+    with caplog.at_level(WARNING, logger=metrics.__name__):
+        response = client.get("/api/v1/books/list")
+    assert response.status_code == 200
+    slow = [it.getMessage() for it in caplog.records if it.getMessage().startswith("Slow query")]
+    assert any("FROM books" in it and "Execution Time" in it for it in slow)
+    assert 'db_slow_statements_total{statement="select"}' in client.get("/metrics").text
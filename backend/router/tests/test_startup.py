@@ -0,0 +1,68 @@
+from asyncio import Event, run
+from logging import INFO
+from uuid import uuid4
+
+import pytest
+
+from ... import backendManager, database
+from ...models import BooksTB, CategoriesTB
+from ...versioning import response_cache
+
+def test_lifespan_warms_up(db_session, helpers, monkeypatch, caplog):
+    db_session.add(CategoriesTB(cat_id="CAT001000", cat_path="Category|Sub Category"))
+    db_session.commit()
+    db_session.add(BooksTB(title="Book 1", author="Someone", category="1", id=uuid4()))
+    db_session.commit()
+
+    client = helpers.get_client(db_session)
+    # The pool, index and listener use the configured database, the warm-up
+    # requests go through the overrides to the test database
+    calls = []
+    async def warm_async_pool():
+        calls.append("warm_async_pool")
+    async def load_category_index():
+        calls.append("load_category_index")
+    async def listen_for_category_changes():
+        await Event().wait()
+    async def close_pools():
+        calls.append("close_pools")
+    monkeypatch.setattr(backendManager, "warm_async_pool", warm_async_pool)
+    monkeypatch.setattr(backendManager, "load_category_index", load_category_index)
+    monkeypatch.setattr(backendManager, "listen_for_category_changes", listen_for_category_changes)
+    monkeypatch.setattr(backendManager, "close_pools", close_pools)
+    monkeypatch.setattr(backendManager, "WARM_UP_PATHS", ["/api/v1/books/list", "/api/v1/books/list?fields=title"])
+
+    with caplog.at_level(INFO, logger=backendManager.__name__):
+        with client:
+            assert calls == ["warm_async_pool", "load_category_index"]
+            assert "Warmed /api/v1/books/list: 200" in caplog.messages
+            assert "Warmed /api/v1/books/list?fields=title: 200" in caplog.messages
+            # One body per path, too small to be compressed
+            assert len(response_cache) == 2
+            response = client.get("/api/v1/books/list?fields=title")
+            assert response.json()["result"] == [{"title": "Book 1"}]
+            assert len(response_cache) == 2
+    assert calls[-1] == "close_pools"
+
+def test_warm_async_pool_closes_on_failure(monkeypatch):
+    class Engine:
+        def __init__(self, connections: int):
+            self.connections = connections
+            self.opened = []
+        async def connect(self):
+            if len(self.opened) == self.connections:
+                raise OSError("connection refused")
+            self.opened.append(Connection())
+            return self.opened[-1]
+    class Connection:
+        closed = False
+        async def close(self):
+            self.closed = True
+
+    engine = Engine(2)
+    monkeypatch.setattr(database, "get_async_engine", lambda: engine)
+    monkeypatch.setattr(database, "replicas", [])
+    with pytest.raises(OSError):
+        run(database.warm_async_pool())
+    assert len(engine.opened) == 2
+    assert all(it.closed for it in engine.opened)
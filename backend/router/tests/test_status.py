@@ -0,0 +1,19 @@
+
+from os import getpid
+
+from ...database import pool_monitor
+
+def test_pool_status(db_session, helpers):
+    client = helpers.get_client(db_session)
+    pool_monitor.reset()
+    pool_monitor.record(0.25)
+    pool_monitor.record(0.05)
+
+    response = client.get("/api/v1/status/pool")
+    assert response.status_code == 200
+    result = response.json()["result"]
+    assert result["worker"] == getpid()
+    assert result["checkouts"] == 2
+    assert result["slow_checkouts"] == 1
+    assert result["max_wait"] == 0.25
+    assert abs(result["avg_wait"] - 0.15) < 1e-9
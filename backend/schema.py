@@ -3,6 +3,8 @@ from typing import Optional
 from re import fullmatch
 from uuid import UUID, uuid4
 
+from .covers import parse_data_url, parse_cover_url
+
 class BookItem(BaseModel):
     id: UUID
     title: str
@@ -24,3 +26,10 @@ class BookCreate(BaseModel):
         if cat is not None and fullmatch(r"[A-Z]{3}[0-9]{6}", cat) is None:
             raise ValueError(f"Category must be formatted as [A-Z]{{3}}[0-9]{{6}}. Given: {cat:s}")
         return cat
+
+    @field_validator("cover_art")
+    def validate_cover_art(cls, cover: str):
+        # New art is sent as a data url, existing art may be sent back as its link
+        if cover is not None and parse_cover_url(cover) is None:
+            parse_data_url(cover)
+        return cover
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from io import BytesIO
+from os import utime
+from pathlib import Path
+from threading import Lock
+
+from PIL import Image
+
+# Bounding box edges offered to clients, covers are never scaled up
+THUMBNAIL_SIZES = (64, 160, 320)
+THUMBNAIL_TYPE = "image/webp"
+
+# Relative cache directories are taken from the repository root, so the api and
+# manageDatabase.py, run from backend/, share one cache
+CACHE_ROOT = Path(__file__).resolve().parents[1]
+
+def make_thumbnail(data: bytes, size: int) -> bytes:
+    """WebP copy of an image fitting in a size x size box"""
+    with Image.open(BytesIO(data)) as image:
+        image.thumbnail((size, size))
+        if image.mode not in ["RGB", "RGBA"]:
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        output = BytesIO()
+        image.save(output, "WEBP", quality=80, method=4)
+    return output.getvalue()
+
+class ThumbnailCache:
+    """Size bounded on-disk store of thumbnails, evicting the least recently used"""
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._entries: OrderedDict[str, int] = None
+        self._total = 0
+
+    def _load(self):
+        """Index files left by earlier runs, oldest first"""
+        if self._entries is not None:
+            return
+        with self._lock:
+            if self._entries is not None:
+                return
+            self.directory.mkdir(parents=True, exist_ok=True)
+            existing = sorted(
+                (it for it in self.directory.glob("*.webp") if it.is_file()),
+                key=lambda it: it.stat().st_mtime
+            )
+            self._entries = OrderedDict((it.name, it.stat().st_size) for it in existing)
+            self._total = sum(self._entries.values())
+            self._evict()
+
+    @staticmethod
+    def filename(cover_id: str, size: int) -> str:
+        return f"{cover_id}-{size}.webp"
+
+    @property
+    def total_bytes(self) -> int:
+        self._load()
+        return self._total
+
+    def __contains__(self, key: tuple) -> bool:
+        self._load()
+        return self.filename(*key) in self._entries
+
+    def get(self, cover_id: str, size: int) -> bytes:
+        self._load()
+        name = self.filename(cover_id, size)
+        with self._lock:
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+        try:
+            path = self.directory / name
+            data = path.read_bytes()
+            utime(path)
+            return data
+        except FileNotFoundError:
+            # Removed by another process sharing the directory
+            with self._lock:
+                self._total -= self._entries.pop(name, 0)
+            return None
+
+    def put(self, cover_id: str, size: int, data: bytes):
+        self._load()
+        name = self.filename(cover_id, size)
+        if len(data) > self.max_bytes:
+            return
+        temp = self.directory / f".{name}.tmp"
+        temp.write_bytes(data)
+        temp.replace(self.directory / name)
+        with self._lock:
+            self._total += len(data) - self._entries.pop(name, 0)
+            self._entries[name] = len(data)
+            self._evict()
+
+    def _evict(self):
+        while self._total > self.max_bytes and len(self._entries) > 0:
+            name, size = self._entries.popitem(last=False)
+            self._total -= size
+            (self.directory / name).unlink(missing_ok=True)
+
+def thumbnail_cache(config: dict) -> ThumbnailCache:
+    """Cache set up by COVER_CACHE_DIR and COVER_CACHE_MAX_BYTES of a .env"""
+    return ThumbnailCache(
+        CACHE_ROOT / (config.get("COVER_CACHE_DIR") or "cover_cache"),
+        int(config.get("COVER_CACHE_MAX_BYTES") or 256 * 2**20)
+    )
@@ -0,0 +1,165 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from re import findall
+
+from fastapi import Depends, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select, exc
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .compression import compress, compressible, negotiate
+from .config import config_value
+from .database import get_async_read_db
+from .models import TableVersionsTB
+from .responses import OrjsonResponse
+
+class ResponseCache:
+    """Serialized response bodies, evicting the least recently used past max_bytes
+
+    Keys include the table versions, so entries are never stale, only unused.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple, bytes] = OrderedDict()
+        self._total = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: tuple) -> bytes:
+        body = self._entries.get(key)
+        if body is not None:
+            self._entries.move_to_end(key)
+        return body
+
+    def put(self, key: tuple, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        self._total += len(body) - len(self._entries.pop(key, b""))
+        self._entries[key] = body
+        while self._total > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._total -= len(evicted)
+
+    def clear(self):
+        self._entries.clear()
+        self._total = 0
+
+response_cache = ResponseCache(config_value("RESPONSE_CACHE_MAX_BYTES", 64 * 2**20))
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match list holds etag or "*"
+
+    Tags are compared weakly, ignoring W/ prefixes, as RFC 9110 asks for
+    If-None-Match.
+    """
+    opaque = etag.removeprefix("W/")
+    return any(it == "*" or it.removeprefix("W/") == opaque for it in findall(r'(?:W/)?"[^"]*"|\*', if_none_match))
+
+class DataVersion:
+    """Versions of the tables a response is built from, keyed by table name"""
+    def __init__(self, request: Request, versions: dict[str, int] = None, modified: datetime = None):
+        self.request = request
+        self.versions = versions or {}
+        self.modified = modified.astimezone(timezone.utc) if modified is not None else None
+        self.encoding = negotiate(request.headers.get("accept-encoding"))
+        # Each content coding is a representation of its own and needs its own
+        # strong tag. Bodies too small to compress keep the suffix, a 304 is
+        # answered before their size is known.
+        suffix = "" if self.encoding is None else f"-{self.encoding}"
+        self.etag = None if versions is None else '"' + ".".join(str(it) for it in versions.values()) + suffix + '"'
+
+    @property
+    def headers(self) -> dict:
+        if self.etag is None:
+            return {}
+        headers = {"ETag": self.etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if self.modified is not None:
+            headers["Last-Modified"] = format_datetime(self.modified, usegmt=True)
+        return headers
+
+    @property
+    def key(self) -> tuple:
+        # Params in the order sent, batch reads answer in the order of their ids
+        return (self.request.url.path, tuple(self.request.query_params.multi_items()), tuple(self.versions.items()))
+
+    def not_modified(self) -> bool:
+        """Whether the client already holds this version"""
+        if self.etag is None:
+            return False
+        if "if-none-match" in self.request.headers:
+            return etag_matches(self.request.headers["if-none-match"], self.etag)
+        if self.modified is None or "if-modified-since" not in self.request.headers:
+            return False
+        try:
+            since = parsedate_to_datetime(self.request.headers["if-modified-since"])
+        except (TypeError, ValueError):
+            return False
+        # Dates are whole seconds, a copy from the second of the change may predate it
+        return since > self.modified
+
+    async def cached(self) -> Response:
+        """Response stored for this request and version, None when not cached"""
+        if self.etag is None:
+            return None
+        if self.encoding is not None:
+            compressed = response_cache.get(self.key + (self.encoding,))
+            if compressed is not None:
+                return self._response(compressed, self.encoding)
+        body = response_cache.get(self.key)
+        if body is None:
+            return None
+        return await self.encode(body)
+
+    async def respond(self, content) -> Response:
+        """Serialize content, keeping it for later requests of the same version"""
+        body = OrjsonResponse(content=content).body
+        if self.etag is not None:
+            response_cache.put(self.key, body)
+        return await self.encode(body)
+
+    async def encode(self, body: bytes) -> Response:
+        """Response in the client's encoding, compressed once per version and encoding
+
+        Compressing a large listing takes a while, it runs in a thread so the
+        event loop keeps serving other requests.
+        """
+        if self.encoding is None or not compressible("application/json", len(body)):
+            return self._response(body)
+        compressed = await run_in_threadpool(compress, body, self.encoding)
+        if self.etag is not None:
+            response_cache.put(self.key + (self.encoding,), compressed)
+        return self._response(compressed, self.encoding)
+
+    def _response(self, body: bytes, encoding: str = None) -> Response:
+        headers = self.headers if encoding is None else {**self.headers, "Content-Encoding": encoding}
+        return Response(content=body, media_type="application/json", headers=headers)
+
+def table_version(*tables: str):
+    """Dependency giving the version of tables, answering 304 when the client has it
+
+    Only the small table_versions table is read, never the tables themselves.
+    It is read with the session of the route, so the version matches the data.
+    """
+    async def dependency(request: Request, db: AsyncSession = Depends(get_async_read_db)) -> DataVersion:
+        sql_query = (
+            select(TableVersionsTB.name, TableVersionsTB.version, TableVersionsTB.modified)
+            .where(TableVersionsTB.name.in_(tables))
+        )
+        try:
+            rows = {it.name: it for it in (await db.execute(sql_query)).all()}
+        except exc.ProgrammingError:
+            # Databases without table_versions are served uncached until init is run
+            await db.rollback()
+            return DataVersion(request)
+
+        version = DataVersion(
+            request,
+            {it: rows[it].version if it in rows else 0 for it in tables},
+            max((it.modified for it in rows.values()), default=None)
+        )
+        if version.not_modified():
+            raise HTTPException(status_code=304, headers=version.headers)
+        return version
+    return dependency
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, ArgumentTypeError
+from asyncio import run, create_task, gather, sleep, Semaphore
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from json import dump
+from pathlib import Path
+from random import Random
+from time import perf_counter
+
+import httpx
+
+# Words typed into the category search, a request per keystroke. Keystrokes of
+# this many words interleave, like users typing at the same time.
+AUTOCOMPLETE_TYPISTS = 5
+AUTOCOMPLETE_WORDS = [
+    "history", "fiction", "science", "cooking", "poetry", "travel", "religion",
+    "juvenile", "business", "computers", "biography", "medical", "music", "nature",
+]
+
+DEFAULT_MIX = "list=40,book=30,autocomplete=25,write=5"
+
+# Sent by the backend after a write, keeping the writer's reads on the primary
+PRIMARY_COOKIE = "db_primary_until"
+
+class Stats:
+    """Latencies and failures of one kind of request"""
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.errors: dict[str, int] = {}
+
+    def record(self, latency: float, error: str = None):
+        self.latencies.append(latency)
+        if error is not None:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def summary(self, duration: float) -> dict:
+        ordered = sorted(self.latencies)
+        def percentile(pct: float) -> float:
+            if len(ordered) == 0:
+                return 0.0
+            return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+        failed = sum(self.errors.values())
+        return {
+            "requests": len(ordered),
+            "per_second": len(ordered) / duration,
+            "error_rate": failed / len(ordered) if len(ordered) > 0 else 0.0,
+            "errors": self.errors,
+            "p50": percentile(50),
+            "p95": percentile(95),
+            "p99": percentile(99),
+            "max": ordered[-1] if len(ordered) > 0 else 0.0,
+        }
+
+class PoolUsage:
+    """Samples of /api/v1/status/pool taken while the load runs
+
+    With several workers each sample is the pool of whichever worker answered,
+    so the counters are only compared between samples of the same worker.
+    """
+    def __init__(self):
+        self.samples: list[dict] = []
+
+    async def sample(self, client: httpx.AsyncClient):
+        try:
+            response = await client.get("/api/v1/status/pool")
+            if response.status_code == 200:
+                self.samples.append(response.json()["result"])
+        except httpx.HTTPError:
+            pass
+
+    async def watch(self, client: httpx.AsyncClient, interval: float):
+        while True:
+            await self.sample(client)
+            await sleep(interval)
+
+    def summary(self) -> dict:
+        workers: dict[str, list[dict]] = {}
+        for it in self.samples:
+            if it.get("initialized"):
+                workers.setdefault(str(it.get("worker")), []).append(it)
+        return {"samples": len(self.samples), "workers": {worker: self.worker_summary(it) for worker, it in workers.items()}}
+
+    @staticmethod
+    def worker_summary(samples: list[dict]) -> dict:
+        """Pool usage of one worker between its first and last sample"""
+        first, last = samples[0], samples[-1]
+        # The counters run from worker start, so the run is the difference
+        checkouts = last["checkouts"] - first["checkouts"]
+        waited = last["avg_wait"] * last["checkouts"] - first["avg_wait"] * first["checkouts"]
+        reads = {}
+        if "replicas" in last:
+            reads["primary"] = last["primary_reads"] - first["primary_reads"]
+            for before, after in zip(first["replicas"], last["replicas"]):
+                reads[after["host"]] = after["reads"] - before["reads"]
+        return {
+            "reads": reads,
+            "samples": len(samples),
+            "size": last["size"],
+            "max_overflow": last["max_overflow"],
+            "max_checked_out": max(it["checked_out"] for it in samples),
+            "max_saturation": max(it["saturation"] for it in samples),
+            "max_overflow_used": max(it["overflow"] for it in samples),
+            "checkouts": checkouts,
+            "slow_checkouts": last["slow_checkouts"] - first["slow_checkouts"],
+            "avg_wait": waited / checkouts if checkouts > 0 else 0.0,
+        }
+
+class LoadTest:
+    """Replays a mix of api requests against a running backend"""
+    def __init__(self, client: httpx.AsyncClient, mix: dict[str, float], seed: int):
+        self.client = client
+        self.mix = mix
+        self.rng = Random(seed)
+        self.stats: dict[str, Stats] = {it: Stats() for it in mix}
+        if "write" in mix:
+            self.stats["own_read"] = Stats()
+        self.book_ids: list[str] = []
+        self.cursors: list[str] = []
+        self.written: list[dict] = []
+        # [word, letters typed] of the words being typed
+        self.typing: list[list] = []
+
+    async def discover(self):
+        """Collect book ids to read from the first pages of the listing"""
+        url = "/api/v1/books/list?limit=500&fields=unique_id"
+        for _ in range(4):
+            response = await self.client.get(url)
+            response.raise_for_status()
+            page = response.json()
+            self.book_ids.extend(it["unique_id"] for it in page["result"])
+            if page["next"] is None:
+                break
+            self.cursors.append(page["next"])
+            url = f"/api/v1/books/list?limit=500&fields=unique_id&after={page['next']}"
+
+    async def request(self, kind: str, method: str, url: str, scheduled: float, **kwargs) -> httpx.Response | None:
+        """Send a request, timed from when it was due so queueing is counted"""
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.stats[kind].record(perf_counter() - scheduled, type(e).__name__)
+            return None
+        error = None if response.status_code < 400 else str(response.status_code)
+        self.stats[kind].record(perf_counter() - scheduled, error)
+        return response
+
+    async def list_books(self, scheduled: float):
+        # Half the listings continue from a page someone already read
+        url = "/api/v1/books/list?limit=50"
+        if len(self.cursors) > 0 and self.rng.random() < 0.5:
+            url += f"&after={self.rng.choice(self.cursors)}"
+        response = await self.request("list", "GET", url, scheduled)
+        if response is not None and response.status_code == 200 and response.json()["next"] is not None:
+            self.cursors = self.cursors[-999:] + [response.json()["next"]]
+
+    async def get_book(self, scheduled: float):
+        if len(self.book_ids) == 0:
+            await self.list_books(scheduled)
+            return
+        await self.request("book", "GET", f"/api/v1/books/?book_id={self.rng.choice(self.book_ids)}", scheduled)
+
+    async def autocomplete(self, scheduled: float):
+        """Type the next letter of a word, sending the search with what is typed so far
+
+        Every keystroke is an arrival of its own, so the rate counts each request.
+        """
+        if len(self.typing) < AUTOCOMPLETE_TYPISTS:
+            self.typing.append([self.rng.choice(AUTOCOMPLETE_WORDS), 0])
+        typed = self.rng.choice(self.typing)
+        typed[1] += 1
+        if typed[1] == len(typed[0]):
+            self.typing.remove(typed)
+        await self.request("autocomplete", "GET", f"/api/v1/categories/search?query={typed[0][:typed[1]]}", scheduled)
+
+    async def write_book(self, scheduled: float):
+        """Add a book, or update one added earlier in the run, then read it back
+
+        Only the writer's own read carries the cookie the write set, the client
+        keeps no cookies so other reads are routed as for any other user.
+        """
+        if len(self.written) > 0 and self.rng.random() < 0.5:
+            book = {**self.rng.choice(self.written), "title": f"Load test {self.rng.random():.6f}"}
+            response = await self.request("write", "PUT", "/api/v1/books/", scheduled, json=book)
+        else:
+            book = {"title": f"Load test {self.rng.random():.6f}", "author": "Load, Test"}
+            response = await self.request("write", "POST", "/api/v1/books/add", scheduled, json=book)
+            if response is not None and response.status_code == 200:
+                book = {**book, "id": response.json()["id"]}
+                self.written.append(book)
+        if response is None or response.status_code != 200:
+            return
+        headers = {}
+        if PRIMARY_COOKIE in response.cookies:
+            headers["Cookie"] = f"{PRIMARY_COOKIE}={response.cookies[PRIMARY_COOKIE]}"
+        await self.request("own_read", "GET", f"/api/v1/books/?book_id={book['id']}", perf_counter(), headers=headers)
+
+    async def run(self, rate: float, duration: float, concurrency: int):
+        """Start requests at rate per second for duration seconds, at most concurrency at once"""
+        scenarios = {
+            "list": self.list_books,
+            "book": self.get_book,
+            "autocomplete": self.autocomplete,
+            "write": self.write_book,
+        }
+        kinds = list(self.mix)
+        weights = [self.mix[it] for it in kinds]
+        slots = Semaphore(concurrency)
+        async def start(kind: str, scheduled: float):
+            async with slots:
+                await scenarios[kind](scheduled)
+
+        tasks = []
+        begin = perf_counter()
+        for idx in range(int(rate * duration)):
+            # Arrivals follow the schedule however slow responses get
+            scheduled = begin + idx / rate
+            delay = scheduled - perf_counter()
+            if delay > 0:
+                await sleep(delay)
+            tasks.append(create_task(start(self.rng.choices(kinds, weights)[0], scheduled)))
+        await gather(*tasks)
+        return perf_counter() - begin
+
+def parse_mix(value: str) -> dict[str, float]:
+    mix = {}
+    for it in value.split(","):
+        kind, _, weight = it.partition("=")
+        if kind.strip() not in ["list", "book", "autocomplete", "write"]:
+            raise ArgumentTypeError(f"unknown request kind {kind!r}")
+        if float(weight) > 0:
+            mix[kind.strip()] = float(weight)
+    return mix
+
+def print_report(report: dict):
+    print(f"\n{'kind':<14}{'requests':>10}{'per sec':>10}{'errors':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind, it in report["requests"].items():
+        print(
+            f"{kind:<14}{it['requests']:>10}{it['per_second']:>10.1f}{it['error_rate']:>9.2%}"
+            f"{it['p50'] * 1000:>10.1f}{it['p95'] * 1000:>10.1f}{it['p99'] * 1000:>10.1f}{it['max'] * 1000:>10.1f}"
+        )
+        for error, count in it["errors"].items():
+            print(f"{'':<14}{count:>10} x {error}")
+
+    pool = report["pool"]
+    if len(pool["workers"]) == 0:
+        print(f"\nPool not in use by the workers sampled ({pool['samples']} samples)")
+        return
+    for worker, it in pool["workers"].items():
+        print(
+            f"\nPool of worker {worker}: size {it['size']} + {it['max_overflow']} overflow, at most {it['max_checked_out']} "
+            f"checked out ({it['max_saturation']:.0%}) in {it['samples']} samples, {it['checkouts']} checkouts waiting "
+            f"{it['avg_wait'] * 1000:.2f}ms on average, {it['slow_checkouts']} slow"
+        )
+        if len(it["reads"]) > 0:
+            print("Reads served by " + ", ".join(f"{target} {count}" for target, count in it["reads"].items()))
+
+async def load_test(url: str, rate: float, duration: float, concurrency: int, mix: dict, seed: int, output: Path):
+    limits = httpx.Limits(max_connections=concurrency + 1, max_keepalive_connections=concurrency + 1)
+    # Requests come from many users, a shared cookie jar would send one writer's
+    # cookie with everyone's reads and keep them all on the primary
+    cookies = CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30, cookies=cookies) as client:
+        test = LoadTest(client, mix, seed)
+        try:
+            await test.discover()
+        except httpx.HTTPError as e:
+            raise SystemExit(f"Cannot list books at {url}: {e}")
+        print(f"Sending {rate:g} requests/s for {duration:g}s to {url}, {len(test.book_ids)} books to read")
+
+        pool = PoolUsage()
+        watcher = create_task(pool.watch(client, 1.0))
+        elapsed = await test.run(rate, duration, concurrency)
+        watcher.cancel()
+        await pool.sample(client)
+
+    report = {
+        "url": url,
+        "rate": rate,
+        "duration": elapsed,
+        "concurrency": concurrency,
+        "mix": mix,
+        "requests": {kind: it.summary(elapsed) for kind, it in test.stats.items()},
+        "pool": pool.summary(),
+    }
+    print_report(report)
+    if output is not None:
+        with open(output, "w") as outfile:
+            dump(report, outfile, indent=2)
+
+def main():
+    parser = ArgumentParser(description="Load test a running backend", formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--url", help="Address of the backend", default="http://localhost:8530", type=str)
+    parser.add_argument("--rate", help="Requests started per second", default=50.0, type=float)
+    parser.add_argument("--duration", help="Seconds to send requests for", default=30.0, type=float)
+    parser.add_argument("--concurrency", help="Requests in flight at most, later ones queue", default=100, type=int)
+    parser.add_argument("--mix", help="Relative weights of list, book, autocomplete and write requests", default=DEFAULT_MIX, type=parse_mix)
+    parser.add_argument("--seed", help="Seed of the request sequence", default=0, type=int)
+    parser.add_argument("--output", help="Also write the report as json", type=Path)
+    run(load_test(**vars(parser.parse_args())))
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import uvicorn
 from fastapi.responses import RedirectResponse
 
 from backend.backendManager import api
+from backend.config import config_value
 
 @api.get("/api/v1")
 async def home() -> dict:
@@ -12,8 +13,19 @@ async def redirect():
     return RedirectResponse("/api/v1")
 
 if __name__ == "__main__":
+    # Each worker is a process with its own pool, so the database sees
+    # API_WORKERS * (DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW) connections at most
     uvicorn.run(
         "runBackend:api",
-        host="0.0.0.0",
-        port=8530,
+        host=config_value("API_HOST", "0.0.0.0", str),
+        port=config_value("API_PORT", 8530),
+        workers=config_value("API_WORKERS", 1),
+        # uvloop and httptools when installed, as with uvicorn[standard]
+        loop=config_value("API_LOOP", "auto", str),
+        http=config_value("API_HTTP", "auto", str),
+        backlog=config_value("API_BACKLOG", 2048),
+        timeout_keep_alive=config_value("API_KEEP_ALIVE", 5),
+        # In flight requests get this long to finish on shutdown
+        timeout_graceful_shutdown=config_value("API_GRACEFUL_TIMEOUT", 30),
+        access_log=config_value("API_ACCESS_LOG", True, bool),
     )